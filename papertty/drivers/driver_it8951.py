@@ -3,9 +3,161 @@ import array
 import struct
 import time
 
+# Optional dependency - speeds up packing images for the controller
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from papertty.drivers.drivers_base import WaveshareEPD
 from papertty.drivers.drivers_base import GPIO
 from papertty.drivers.drivers_base import SpiDev
+from papertty.drivers.drivers_base import Simulator
+
+
+class IT8951Transaction:
+    """Collects commands and their arguments so they can be sent together.
+
+    Every command costs one CS cycle for the command word and one for all of
+    its arguments, instead of one per argument. Register writes that would
+    not change the cached register value are dropped."""
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.commands = []
+        self.registers = {}
+
+    def command(self, command, *args):
+        self.commands.append((command, args))
+        return self
+
+    def register(self, register_address, value):
+        value &= 0xFFFF
+        if self.registers.get(register_address, self.driver.registers.get(register_address)) != value:
+            self.registers[register_address] = value
+            self.command(self.driver.CMD_WRITE_REGISTER, register_address, value)
+        return self
+
+    def send(self):
+        for command, args in self.commands:
+            self.driver.write_command(command)
+            if args:
+                self.driver.write_data_half_words(args)
+        self.driver.cache_registers(self.registers)
+        self.commands = []
+        self.registers = {}
+
+
+class IT8951Waveforms:
+    """Chooses the update mode of each refresh and keeps track of ghosting.
+
+    The panel is divided into cells. Each refresh heats up the cells it covers
+    (the heat decays over time) and adds to their ghosting:
+    - grayscale content gets GC16, which also clears the ghosting
+    - black and white content gets DU, or A2 where the cells are hot - eg.
+      the line being typed on - as A2 is the fastest but ghosts the most
+    Once cells reach the ghosting budget, they are cleaned up with GC16 - but
+    only when they have cooled down, so typing isn't held up by flashes. A
+    clean-up refreshes the image memory in the current bpp mode, so it's left
+    for later in cells which were last loaded (even partly) in the other one."""
+
+    CELL_WIDTH = 64
+    CELL_HEIGHT = 32
+    # ghosting added by a refresh in each mode, the rest clear it
+    GHOSTING = {"A2": 2, "DU": 1}
+    # ghosting which triggers a clean-up
+    BUDGET = 20
+    # ...and which triggers one even in hot cells
+    HARD_LIMIT = 40
+    # number of recent refreshes that makes cells hot, and the half-life of that in seconds
+    HOT = 3
+    HALF_LIFE = 2.0
+
+    def __init__(self, width, height, clock=time.monotonic):
+        self.width = width
+        self.height = height
+        # seconds, as a float - a simulated panel passes its simulated time
+        self.clock = clock
+        self.cols = (width + self.CELL_WIDTH - 1) // self.CELL_WIDTH
+        self.rows = (height + self.CELL_HEIGHT - 1) // self.CELL_HEIGHT
+        self.ghosting = [[0] * self.cols for _ in range(self.rows)]
+        self.heat = [[0.0] * self.cols for _ in range(self.rows)]
+        self.heated = [[0.0] * self.cols for _ in range(self.rows)]
+        # bpp mode of the image memory of each cell, None if it's mixed or unknown
+        self.bpp = [[None] * self.cols for _ in range(self.rows)]
+
+    def cells(self, box):
+        left, top, right, bottom = box
+        for row in range(max(0, top // self.CELL_HEIGHT), min(self.rows, (bottom + self.CELL_HEIGHT - 1) // self.CELL_HEIGHT)):
+            for col in range(max(0, left // self.CELL_WIDTH), min(self.cols, (right + self.CELL_WIDTH - 1) // self.CELL_WIDTH)):
+                yield row, col
+
+    def temperature(self, row, col, now):
+        return self.heat[row][col] * 0.5 ** ((now - self.heated[row][col]) / self.HALF_LIFE)
+
+    def choose(self, box, binary, a2):
+        """Pick "A2", "DU" or "GC16" for refreshing the box"""
+        if not binary:
+            return "GC16"
+        now = self.clock()
+        # count this refresh too
+        if a2 and all(self.temperature(row, col, now) + 1 >= self.HOT for row, col in self.cells(box)):
+            return "A2"
+        return "DU"
+
+    def refreshed(self, box, mode):
+        """Record a refresh of the box in the given mode"""
+        now = self.clock()
+        for row, col in self.cells(box):
+            self.heat[row][col] = self.temperature(row, col, now) + 1
+            self.heated[row][col] = now
+            if mode in self.GHOSTING:
+                self.ghosting[row][col] += self.GHOSTING[mode]
+            else:
+                self.ghosting[row][col] = 0
+
+    def loaded(self, box, bpp):
+        """Record an image loaded into the box in the given bpp mode"""
+        left, top, right, bottom = box
+        for row, col in self.cells(box):
+            whole = (left <= col * self.CELL_WIDTH and top <= row * self.CELL_HEIGHT and
+                     right >= min((col + 1) * self.CELL_WIDTH, self.width) and
+                     bottom >= min((row + 1) * self.CELL_HEIGHT, self.height))
+            self.bpp[row][col] = bpp if whole or self.bpp[row][col] == bpp else None
+
+    def cleanup(self, bpp=None):
+        """Return the boxes which are due a clean-up, and consider them clean.
+        With `bpp`, only cells whose memory is all in that bpp mode are due."""
+        now = self.clock()
+        due = set()
+        for row in range(self.rows):
+            for col in range(self.cols):
+                if bpp is not None and self.bpp[row][col] != bpp:
+                    continue
+                ghosting = self.ghosting[row][col]
+                if ghosting >= self.HARD_LIMIT or (ghosting >= self.BUDGET and self.temperature(row, col, now) < 1):
+                    due.add((row, col))
+                    self.ghosting[row][col] = 0
+        # join the cells into runs on each row, then runs on consecutive rows
+        boxes = []
+        for row in range(self.rows):
+            col = 0
+            while col < self.cols:
+                if (row, col) not in due:
+                    col += 1
+                    continue
+                start = col
+                while (row, col) in due:
+                    col += 1
+                run = (start * self.CELL_WIDTH, row * self.CELL_HEIGHT,
+                       min(col * self.CELL_WIDTH, self.width), min((row + 1) * self.CELL_HEIGHT, self.height))
+                for i, box in enumerate(boxes):
+                    if (box[0], box[2], box[3]) == (run[0], run[2], run[1]):
+                        boxes[i] = (box[0], box[1], box[2], run[3])
+                        break
+                else:
+                    boxes.append(run)
+        return boxes
 
 
 class IT8951(WaveshareEPD):
@@ -36,6 +188,11 @@ class IT8951(WaveshareEPD):
     REG_MEMORY_CONV = REG_MEMORY_CONV_BASE_ADDR + 0x0000
     REG_MEMORY_CONV_LISAR = REG_MEMORY_CONV_BASE_ADDR + 0x0008
 
+    #Registers which only change when we write them, so their values can be
+    #cached instead of read back. Anything holding status (eg. LUTAFSR) must not be here.
+    CACHED_REGISTERS = (REG_I80CPCR, REG_UP1SR + 2, REG_BGVR,
+                        REG_MEMORY_CONV_LISAR, REG_MEMORY_CONV_LISAR + 2)
+
     ROTATE_0   = 0
     ROTATE_90  = 1
     ROTATE_180 = 2
@@ -69,6 +226,14 @@ class IT8951(WaveshareEPD):
     Back_Gray_Val = 0xF0
     Front_Gray_Val = 0x00
 
+    #Translation tables used by pack_image to reverse the order of the
+    #1, 2 or 4 bit pixels within a byte.
+    PACK_ORDER = {
+        1: bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256)),
+        2: bytes(((i & 0x03) << 6) | ((i & 0x0C) << 2) | ((i & 0x30) >> 2) | ((i & 0xC0) >> 6) for i in range(256)),
+        4: bytes(((i & 0x0F) << 4) | ((i & 0xF0) >> 4) for i in range(256)),
+    }
+
     def __init__(self):
         super().__init__("IT8951", None, None)
         self.supports_partial = True
@@ -77,6 +242,8 @@ class IT8951(WaveshareEPD):
         self.align_1bpp_width = 32
         self.align_1bpp_height = 16
         self.supports_multi_draw = True
+        self.registers = {}
+        self.waveforms = None
 
     def delay_ms(self, delaytime):
         time.sleep(float(delaytime) / 1000.0)
@@ -98,13 +265,11 @@ class IT8951(WaveshareEPD):
         GPIO.output(self.CS_PIN, GPIO.HIGH)
 
     def write_data_bytes(self, data):
-        max_transfer_size = 4096
         self.wait_for_ready()
         GPIO.output(self.CS_PIN, GPIO.LOW)
         self.spi_write([0x00, 0x00])
         self.wait_for_ready()
-        for i in range(0, len(data), max_transfer_size):
-            self.spi_write(data[i: i + max_transfer_size])
+        self.SPI.writebuffer(data)
         GPIO.output(self.CS_PIN, GPIO.HIGH)
 
     def read_bytes(self, n):
@@ -126,27 +291,40 @@ class IT8951(WaveshareEPD):
         """
         self.write_data_bytes([(half_word >> 8) & 0xFF, half_word & 0xFF])
 
+    def write_data_half_words(self, half_words):
+        """Writes several half words in a single data transfer."""
+        self.write_data_bytes(struct.pack(">%dH" % len(half_words), *half_words))
+
     def read_half_word(self):
         """Reads a half word of from the controller."""
         return struct.unpack(">H", self.read_bytes(2))[0]
 
+    def transaction(self):
+        return IT8951Transaction(self)
+
+    def cache_registers(self, registers):
+        for register_address, value in registers.items():
+            if register_address in self.CACHED_REGISTERS:
+                self.registers[register_address] = value
+
     def write_register(self, register_address, value):
-        self.write_command(self.CMD_WRITE_REGISTER)
-        self.write_data_half_word(register_address)
-        self.write_data_half_word(value)
+        self.transaction().register(register_address, value).send()
 
     def read_register(self, register_address):
+        if register_address in self.registers:
+            return self.registers[register_address]
         self.write_command(self.CMD_READ_REGISTER)
         self.write_data_half_word(register_address)
-        return self.read_half_word()
+        value = self.read_half_word()
+        self.cache_registers({register_address: value})
+        return value
 
     def wait_for_ready(self):
         """Waits for the busy pin to drop.
 
         When the busy pin is high the controller is busy and may drop any
         commands that are sent to it."""
-        while GPIO.input(self.BUSY_PIN) == 0:
-            self.delay_ms(100)
+        GPIO.wait_for(self.BUSY_PIN, GPIO.HIGH)
 
     def wait_for_display_ready(self):
         """Waits for the display to be finished updating.
@@ -182,11 +360,9 @@ class IT8951(WaveshareEPD):
             return -1
 
         mhz = kwargs.get('mhz', None)
-        if mhz:
-            self.SPI.max_speed_hz = int(mhz * 1000000)
-        else:
-            self.SPI.max_speed_hz = 2000000
-        print("SPI Speed = %.02f Mhz" % (self.SPI.max_speed_hz / 1000.0 / 1000.0))
+        speed = int(mhz * 1000000) if mhz else 2000000
+        self.SPI.setSpeed(speed)
+        print("SPI Speed = %.02f Mhz" % (speed / 1000.0 / 1000.0))
         
         # It is unclear why this is necessary but it appears to be. The sample
         # code from WaveShare [1] manually controls the CS bin and has its state
@@ -202,6 +378,7 @@ class IT8951(WaveshareEPD):
         self.delay_ms(500)
         GPIO.output(self.RST_PIN, GPIO.HIGH)
         self.delay_ms(500)
+        self.registers = {}
 
         self.write_command(self.CMD_GET_DEVICE_INFO);
 
@@ -289,18 +466,26 @@ class IT8951(WaveshareEPD):
             print("adjusted width = %d" % self.width)
             print("adjusted height = %d" % self.height)
 
-    def display_area(self, x, y, w, h, display_mode):
-        self.write_command(self.CMD_DISPLAY_AREA)
-        self.write_data_half_word(x)
-        self.write_data_half_word(y)
-        self.write_data_half_word(w)
-        self.write_data_half_word(h)
-        self.write_data_half_word(display_mode)
+        #Grayscale images can't be shadowed, so those are always drawn
+        self.enable_shadow(convert=False)
+        self.waveforms = IT8951Waveforms(self.width, self.height)
+
+    def display_area(self, x, y, w, h, display_mode, transaction=None):
+        transaction = transaction or self.transaction()
+        transaction.command(self.CMD_DISPLAY_AREA, x, y, w, h, display_mode)
+        transaction.send()
 
     def draw_multi(self, imageArray):
 
         """This function performs multiple draws in a single panel refresh"""
 
+        #Leave out the images which are already on the panel
+        if self.shadow:
+            regions = [self.shadow.draw(item["x"], item["y"], item["image"]) for item in imageArray]
+            imageArray = [{"x": r[0], "y": r[1], "image": r[2]} for r in regions if r]
+            if not imageArray:
+                return
+
         #First, calculate the bounds of the panel area which is being refreshed.
         #ie. a rectangle within which all of the images in imageArray would fit.
         smallest_x = -1
@@ -334,6 +519,16 @@ class IT8951(WaveshareEPD):
             self.draw(x, y, image, update_mode_override, isFirst, isLast, bbox)
 
     def draw(self, x, y, image, update_mode_override=None, isFirst=True, isLast=True, bbox=None):
+        #A draw on its own goes through the shadow framebuffer here - draw_multi
+        #(which always passes bbox) has done it already.
+        #Draws with an explicit update mode, eg. clear(), always go through.
+        if self.shadow and bbox is None:
+            region = self.shadow.draw(x, y, image)
+            if update_mode_override is None:
+                if not region:
+                    return
+                x, y, image = region
+
         width = image.size[0]
         height = image.size[1]
 
@@ -341,6 +536,9 @@ class IT8951(WaveshareEPD):
         if isFirst:
             self.wait_for_display_ready()
 
+        #Register writes and the load command are sent together once the mode is known
+        setup = self.transaction()
+
         #Set to 4bpp by default
         bpp = 4
 
@@ -372,11 +570,12 @@ class IT8951(WaveshareEPD):
                 #register to put it into 1bpp mode.
                 #This is the important bit which actually puts it in 1bpp in spite of the 8bpp flag
                 if not self.in_bpp1_mode:
-                    self.write_register(self.REG_UP1SR+2, self.read_register(self.REG_UP1SR+2) | (1<<2) )
+                    setup.register(self.REG_UP1SR+2, self.read_register(self.REG_UP1SR+2) | (1<<2) )
                     self.in_bpp1_mode = True
                 
                 #Also write the black and white color table for 1bpp mode
-                self.write_register(self.REG_BGVR, (self.Front_Gray_Val<<8) | self.Back_Gray_Val)
+                #(skipped by the register cache unless it changed)
+                setup.register(self.REG_BGVR, (self.Front_Gray_Val<<8) | self.Back_Gray_Val)
 
         else:
             #If we're not in 1bpp mode, default to 4bpp.
@@ -394,177 +593,216 @@ class IT8951(WaveshareEPD):
 
                 #If the last write was in 1bpp mode, unset that register to take it out of 1bpp mode.
                 if self.in_bpp1_mode:
-                    self.write_register(self.REG_UP1SR+2, self.read_register(self.REG_UP1SR+2) & ~(1<<2) )
+                    setup.register(self.REG_UP1SR+2, self.read_register(self.REG_UP1SR+2) & ~(1<<2) )
                     self.in_bpp1_mode = False
 
                 #Then write the expected registers for 4bpp mode.
-                self.write_register(
+                setup.register(
                         self.REG_MEMORY_CONV_LISAR + 2, (self.img_addr >> 16) & 0xFFFF)
-                self.write_register(self.REG_MEMORY_CONV_LISAR, self.img_addr & 0xFFFF)
+                setup.register(self.REG_MEMORY_CONV_LISAR, self.img_addr & 0xFFFF)
 
         # Define the region being loaded.
-        self.write_command(self.CMD_LOAD_IMAGE_AREA)
-        self.write_data_half_word(
+        # x and width are set to value//8 if using 1bpp mode.
+        setup.command(self.CMD_LOAD_IMAGE_AREA,
                 (self.LOAD_IMAGE_L_ENDIAN << 8) |
                 (bpp_mode << 4) |
-                self.ROTATE_0)
-
-        # x and width are set to value//8 if using 1bpp mode.
-        self.write_data_half_word((x//8) if bpp == 1 else x)
-        self.write_data_half_word(y)
-        self.write_data_half_word((width//8) if bpp == 1 else width)
-        self.write_data_half_word(height)
+                self.ROTATE_0,
+                (x//8) if bpp == 1 else x,
+                y,
+                (width//8) if bpp == 1 else width,
+                height)
+        setup.send()
 
         packed_image = self.pack_image(image, bpp)
         self.write_data_bytes(packed_image)
-        self.write_command(self.CMD_LOAD_IMAGE_END);
+        finish = self.transaction().command(self.CMD_LOAD_IMAGE_END)
+        if self.waveforms:
+            self.waveforms.loaded((x, y, x + width, y + height), bpp)
 
         #If this is the last (or only) image to draw, refresh the panel.
         if isLast:
 
+            # If bbox has been passed in (eg. if performing multiple draws at once)
+            # then we should update that area.
+            # Otherwise, refresh the panel based on the image's bounds.
+            if not bbox:
+                bbox = (x, y, x + width, y + height)
+            modes = {
+                "A2": self.DISPLAY_UPDATE_MODE_A2,
+                "DU": self.DISPLAY_UPDATE_MODE_DU,
+                "GC16": self.DISPLAY_UPDATE_MODE_GC16,
+            }
+            a2 = bpp == 1 and self.supports_a2 and self.enable_a2
+
             if update_mode_override is not None:
                 update_mode = update_mode_override
+                mode_name = next((name for name, mode in modes.items() if mode == update_mode), "INIT")
+            elif self.waveforms:
+                # Fast modes for black and white images (A2 where the panel is
+                # updated all the time), the slower, flashy GC16 for gray scale
+                mode_name = self.waveforms.choose(bbox, image.mode == "1", a2)
+                update_mode = modes[mode_name]
             elif image.mode == "1":
                 # Use a faster, non-flashy update mode for pure black and white
                 # images.
-                if bpp == 1 and self.supports_a2 and self.enable_a2:
-                    update_mode = self.DISPLAY_UPDATE_MODE_A2
-                else:
-                    update_mode = self.DISPLAY_UPDATE_MODE_DU
+                mode_name = "A2" if a2 else "DU"
+                update_mode = modes[mode_name]
             else:
                 # Use a slower, flashy update mode for gray scale images.
-                update_mode = self.DISPLAY_UPDATE_MODE_GC16
+                mode_name = "GC16"
+                update_mode = modes[mode_name]
 
             # Blit the image to the display.
-            # If bbox has been passed in (eg. if performing multiple draws at once)
-            # then we should update that area.
-            # Otherwise, refresh the panel based on the image's bounds.
-            if bbox:
-                (left, top, right, bottom) = bbox
-                self.display_area(left, top, right-left, bottom-top, update_mode)
-            else:
-                self.display_area(x, y, width, height, update_mode)
+            (left, top, right, bottom) = bbox
+            self.display_area(left, top, right-left, bottom-top, update_mode, finish)
+
+            # Clean up the ghosting in the areas which have had enough fast updates
+            if self.waveforms:
+                self.waveforms.refreshed(bbox, mode_name)
+                #Only where the memory is all in the bpp mode the panel is in now
+                for (left, top, right, bottom) in self.waveforms.cleanup(1 if self.in_bpp1_mode else 4):
+                    self.display_area(left, top, right-left, bottom-top, self.DISPLAY_UPDATE_MODE_GC16)
+        else:
+            finish.send()
 
     def clear(self):
         image = Image.new('1', (self.width, self.height), self.white)
         self.draw(0, 0, image, self.DISPLAY_UPDATE_MODE_INIT)
 
     def pack_image(self, image, bpp):
-        """Packs a PIL image for transfer over SPI to the driver board."""
-        if image.mode == '1':
-            # B/W pictured can be processed more quickly
-            frame_buffer = list(image.getdata())
-        else:
+        """Packs a PIL image for transfer over SPI to the driver board.
+
+        Every pixel is reduced to on or off (any non-zero value is on) and
+        packed `bpp` bits at a time, with the first pixel in the least
+        significant bits of each byte. The pixels are treated as one
+        continuous stream, so rows don't need to end on a byte boundary.
+
+        The driver board assumes all data is read in as 16bit ints. So in
+        order to match the endianness, every pair of bytes is swapped.
+
+        The whole image is packed in one go - with NumPy if it is installed,
+        otherwise with PIL's raw encoders - instead of pixel by pixel.
+        The result can be passed straight to write_data_bytes.
+
+        A note on 2bpp: its utility is questionable, as it only works properly
+        with GC16 mode. DU mode causes artifacts to remain. The waveshare
+        reference code only ever uses GC16 mode with 2bpp, so perhaps it's a
+        bug within the IT8951 controller? Regardless, 1bpp is faster, and 4bpp
+        works with DU mode. So chances are you'd be better off using one of those.
+        """
+        if image.mode != '1':
             # old packing code for grayscale (VNC)
             bpp = 4
-            image_grey = image.convert("L")
-            frame_buffer = list(image_grey.getdata())
-
-
-        #Step is the number of bytes we need to read to create a word.
-        #A word is 2 bytes (16 bits) in size.
-        #However, the input data we use to create the word will vary
-        #in length depending on the bpp.
-        #eg. If bpp is 1, that means we only grab 1 bit from each
-        #input byte. So we would need 16 bytes to get the needed
-        #16 bits.
-        #Whereas if bpp is 4, then we grab 4 bits from each byte.
-        #So we'd only need to read 4 bytes to get 16 bits.
-        step = 16 // bpp
+            image = image.convert("L")
 
-        #A halfstep is how many input bytes we need to read from
-        #frame_buffer in order to pack a single output byte
-        #into packed_buffer.
-        halfstep = step // 2
+        if numpy is not None:
+            return self.pack_image_numpy(image, bpp)
+        return self.pack_image_pil(image, bpp)
 
-        #Set the size of packed_buffer to be the length of the
-        #frame buffer (total input bytes) divided by a halfstep
-        #(input bytes needed per packed byte).
-        packed_buffer = [0x00] * (len(frame_buffer) // halfstep)
+    def pack_image_numpy(self, image, bpp):
+        """Packs an image (mode '1' or 'L') with NumPy. See pack_image."""
+
+        #Step is the number of pixels needed to create a word (2 bytes).
+        #Pad the pixel stream so that it ends on a word boundary.
+        step = 16 // bpp
+        pixels = numpy.asarray(image).reshape(-1) != 0
+        padding = -len(pixels) % step
+        if padding:
+            pixels = numpy.concatenate((pixels, numpy.zeros(padding, dtype=bool)))
 
-        #Select the packing function based on which bpp
-        #mode we're using.
         if bpp == 1:
-            packfn = self.pack_1bpp
-        elif bpp == 2:
-            packfn = self.pack_2bpp
+            packed = numpy.packbits(pixels, bitorder='little')
         else:
-            packfn = self.pack_4bpp
+            #Each pixel becomes either all ones or all zeros in its bpp-bit
+            #slot, with the first pixel of each byte in the lowest bits.
+            per_byte = 8 // bpp
+            levels = (1 << bpp) - 1
+            weights = numpy.array([levels << (bpp * i) for i in range(per_byte)], dtype=numpy.uint8)
+            packed = (pixels.reshape(-1, per_byte) * weights).sum(axis=1, dtype=numpy.uint8)
+
+        #Swap every pair of bytes to match the controller's 16bit words.
+        return packed.reshape(-1, 2)[:, ::-1].tobytes()
+
+    def pack_image_pil(self, image, bpp):
+        """Packs an image (mode '1' or 'L') with PIL's raw encoders. See pack_image."""
+        step = 16 // bpp
+        width = image.size[0]
 
-        #Step through the frame buffer and pack its bytes
-        #into packed_buffer.
-        for i in range(0, len(frame_buffer), step):
-            packfn(packed_buffer, i // halfstep, frame_buffer[i:i+step])
-        return packed_buffer
+        if bpp == 1 and width % 8 == 0:
+            #Rows already end on a byte boundary, so PIL's own 1bpp packing
+            #of a mode '1' image can be used as-is.
+            packed = image.tobytes('raw', '1')
+        else:
+            #Threshold every pixel to all ones or all zeros, then pack the
+            #pixels as a single row so that the stream isn't padded at the
+            #end of each image row.
+            if image.mode == '1':
+                image = image.convert('L')
+            levels = (1 << bpp) - 1
+            data = image.tobytes().translate(bytes([0] + [levels] * 255))
+            data += bytes(-len(data) % step)
+            packed = Image.frombytes('P', (len(data), 1), data).tobytes('raw', 'P;%d' % bpp)
+
+        #PIL puts the first pixel in the most significant bits, whereas
+        #the controller expects it in the least significant bits.
+        packed = bytearray(packed.translate(self.PACK_ORDER[bpp]))
+        if len(packed) % 2:
+            packed.append(0x00)
+
+        #Swap every pair of bytes to match the controller's 16bit words.
+        packed[0::2], packed[1::2] = packed[1::2], packed[0::2]
+        return packed
+
+
+class SimulatedIT8951(Simulator):
+    """Simulated 10.3" IT8951 panel - prints the SPI bytes and refresh time used on exit"""
+
+    # each command waits for the controller to be ready (HRDY)
+    command_bytes = 40
+    command_time = 0.001
+    refresh_times = {'A2': 0.12, 'DU': 0.26, 'GC16': 0.45}
+    shadowed = True
+
+    def __init__(self, realtime=False):
+        super().__init__(name='Simulated IT8951 10.3"', width=1872, height=1404, realtime=realtime)
+        self.supports_partial = True
+        self.supports_1bpp = True
+        self.align_1bpp_width = 32
+        self.align_1bpp_height = 16
+        self.supports_multi_draw = True
+        # the 10.3" panel is one of the models the IT8951 driver enables A2 for
+        self.supports_a2 = True
 
-    def pack_1bpp(self, packed_buffer, i, sixteenBytes):
-        """Pack an image in 1bpp format.
+    def bpp(self, x, image):
+        """Same rules as the IT8951 driver for loading in 1bpp mode"""
+        if self.enable_1bpp and image.mode == "1" and x % self.align_1bpp_width == 0:
+            if (image.width, image.height) == (self.width, self.height):
+                return 1
+            if image.width % self.align_1bpp_width == 0 and image.height % self.align_1bpp_height == 0:
+                return 1
+        return 4
 
-        This only works for black and white images.
-        This code would look nicer with a loop, but using bitwise operators
-        like this is significantly faster. So the ugly code stays ;)
+    def transfer_size(self, x, y, image):
+        # the pixels are sent as one stream of 16bit words
+        bits = image.width * image.height * self.bpp(x, image)
+        return (bits + 15) // 16 * 2
 
-        Bytes are read in reverse order because the driver board assumes all
-        data is read in as 16bit ints. So in order to match the endianness,
-        every pair of bytes must be swapped.
-        """
-        packed_buffer[i] = \
-            (1 if sixteenBytes[8] else 0) | \
-            (2 if sixteenBytes[9] else 0) | \
-            (4 if sixteenBytes[10] else 0) | \
-            (8 if sixteenBytes[11] else 0) | \
-            (16 if sixteenBytes[12] else 0) | \
-            (32 if sixteenBytes[13] else 0) | \
-            (64 if sixteenBytes[14] else 0) | \
-            (128 if sixteenBytes[15] else 0)
-        packed_buffer[i+1] = \
-            (1 if sixteenBytes[0] else 0) | \
-            (2 if sixteenBytes[1] else 0) | \
-            (4 if sixteenBytes[2] else 0) | \
-            (8 if sixteenBytes[3] else 0) | \
-            (16 if sixteenBytes[4] else 0) | \
-            (32 if sixteenBytes[5] else 0) | \
-            (64 if sixteenBytes[6] else 0) | \
-            (128 if sixteenBytes[7] else 0)
-
-    def pack_2bpp(self, packed_buffer, i, eightBytes):
-        """Pack an image in 2bpp format.
-
-        The utility of 2bpp format is questionable, as it only works properly
-        with GC16 mode. DU mode causes artifacts to remain.
-        It seems unlikely that this is a bug in driver_it8951.py given that
-        GC16 mode works correctly.
-
-        The waveshare reference code only ever uses GC16 mode with 2bpp, so
-        perhaps it's a bug within the IT8951 controller? Regardless, 1bpp is
-        faster, and 4bpp works with DU mode. So chances are you'd be better off
-        using one of those.
-
-        Bytes are read in reverse order because the driver board assumes all
-        data is read in as 16bit ints. So in order to match the endianness,
-        every pair of bytes must be swapped.
-        """
-        packed_buffer[i] = \
-            (3 if eightBytes[4] else 0) | \
-            (12 if eightBytes[5] else 0) | \
-            (48 if eightBytes[6] else 0) | \
-            (192 if eightBytes[7] else 0)
-        packed_buffer[i+1] = \
-            (3 if eightBytes[0] else 0) | \
-            (12 if eightBytes[1] else 0) | \
-            (48 if eightBytes[2] else 0) | \
-            (192 if eightBytes[3] else 0)
-
-    def pack_4bpp(self, packed_buffer, i, fourBytes):
-        """Pack an image in 4bpp format.
-
-        Bytes are read in reverse order because the driver board assumes all
-        data is read in as 16bit ints. So in order to match the endianness,
-        every pair of bytes must be swapped.
-        """
-        packed_buffer[i] = \
-            (15 if fourBytes[2] else 0) | \
-            (240 if fourBytes[3] else 0)
-        packed_buffer[i+1] = \
-            (15 if fourBytes[0] else 0) | \
-            (240 if fourBytes[1] else 0)
+    def init(self, **kwargs):
+        super().init(**kwargs)
+        # heat decays in simulated time, so realtime or not the same modes get picked
+        self.waveforms = IT8951Waveforms(self.width, self.height, clock=lambda: self.total_time)
+
+    def waveform(self, bbox, x, y, image):
+        a2 = self.bpp(x, image) == 1 and self.supports_a2 and self.enable_a2
+        return self.waveforms.choose(bbox, image.mode == "1", a2)
+
+    def account(self, loads, bbox):
+        for x, y, image in loads:
+            self.waveforms.loaded((x, y, x + image.width, y + image.height), self.bpp(x, image))
+        # the first image sets the bpp mode, as in IT8951.draw
+        self.bpp_mode = self.bpp(loads[0][0], loads[0][2])
+        super().account(loads, bbox)
+
+    def refreshed(self, bbox, mode):
+        self.waveforms.refreshed(bbox, mode)
+        return ["GC16" for box in self.waveforms.cleanup(self.bpp_mode)]
@@ -18,6 +18,7 @@
 from PIL import Image
 
 from papertty.drivers.drivers_base import GPIO
+from papertty.drivers.drivers_base import Simulator
 from papertty.drivers.drivers_consts import EPD4in2const
 from papertty.drivers.drivers_partial import WavesharePartial
 
@@ -62,6 +63,9 @@ class EPD4in2(WavesharePartial, EPD4in2const):
     # note: this code is outside of drivers_partial.py because the class has to
     # override many methdos and therefore is way to long
 
+    # translation table that inverts every bit of a byte
+    INVERT = bytes(range(255, -1, -1))
+
     def __init__(self):
         super(WavesharePartial, self).__init__(name='4.2"',
                                                width=400,
@@ -69,7 +73,10 @@ class EPD4in2(WavesharePartial, EPD4in2const):
         self.supports_partial = True
 
         # this is the memory buffer that will be updated!
-        self.frame_buffer = [0x00] * (self.width * self.height // 8)
+        self.frame_buffer = bytearray(self.width * self.height // 8)
+        # whether the buffer is known to match the panel, so that unchanged
+        # parts can be left out of partial refreshes
+        self.synced = False
 
     # TODO: universal?
     def set_setting(self, command, data):
@@ -109,11 +116,15 @@ class EPD4in2(WavesharePartial, EPD4in2const):
             self.spi_transfer([data])
         self.digital_write(self.CS_PIN, GPIO.HIGH)
 
+    def send_data_multi(self, dataArray):
+        self.digital_write(self.CS_PIN, GPIO.LOW)
+        super().send_data_multi(dataArray)
+        self.digital_write(self.CS_PIN, GPIO.HIGH)
+
     def wait_until_idle(self):
         self.send_command(self.GET_STATUS)
-        while self.digital_read(self.BUSY_PIN) == 0:
+        while not self.digital_wait(self.BUSY_PIN, 1, timeout=0.1):
             self.send_command(self.GET_STATUS)
-            self.delay_ms(100)
 
     def turn_on_display(self):
         self.send_command(self.DISPLAY_REFRESH)
@@ -177,6 +188,7 @@ class EPD4in2(WavesharePartial, EPD4in2const):
     def init(self, partial=True, gray=False):
         self.partial_refresh = partial
         self.gray = gray
+        self.synced = False
 
         if self.epd_init() != 0:
             return -1
@@ -193,17 +205,18 @@ class EPD4in2(WavesharePartial, EPD4in2const):
         height = int(self.height)
 
         self.send_command(self.DATA_START_TRANSMISSION_1)
-        for i in range(width * height):
-            self.send_data(0xff)
+        self.send_data_multi(b'\xff' * (width * height))
 
         self.send_command(self.DATA_START_TRANSMISSION_2)
-        for i in range(width * height):
-            self.send_data(0xff)
+        self.send_data_multi(b'\xff' * (width * height))
 
         self.send_command(self.DISPLAY_REFRESH)
         self.delay_ms(10)
         self.turn_on_display()
 
+        self.frame_buffer[:] = b'\xff' * (width * height)
+        self.synced = True
+
     # Writing outside the range of the display will cause an error.
     def fill(self, color, fillsize):
         """Slow fill routine"""
@@ -220,26 +233,21 @@ class EPD4in2(WavesharePartial, EPD4in2const):
 
     def display_full(self):
 
-        # TODO: optimize this as (needs performance check):
-        # self.send_command(self.DATA_START_TRANSMISSION_2, self.frame_buffer)
-
-        width = int(self.width // 8)
-        height = int(self.height)
-
         self.send_command(self.DATA_START_TRANSMISSION_2)
-        for i in range(height):
-            for j in range(width):
-                self.send_data(self.frame_buffer[i * width + j])
+        self.send_data_multi(self.frame_buffer)
 
         self.turn_on_display()
+        self.synced = True
 
     def display_partial(self, x_start, y_start, x_end, y_end):
 
         width = self.width // 8
 
-        # TODO: use x_start // 8 * 9
-        x_start = int(x_start if x_start % 8 == 0 else x_start // 8 * 8 + 8)
-        x_end = int(x_end if x_end % 8 == 0 else x_end // 8 * 8 + 8)
+        # the window has to start and end on whole bytes
+        x_start = max(x_start // 8 * 8, 0)
+        x_end = min((x_end + 7) // 8 * 8, self.width)
+        y_start = max(y_start, 0)
+        y_end = min(y_end, self.height)
 
         self.set_setting(self.VCOM_AND_DATA_INTERVAL_SETTING, [0xf7])
         self.delay_ms(100)
@@ -256,21 +264,19 @@ class EPD4in2(WavesharePartial, EPD4in2const):
                           (y_end - 1) // 256, (y_end - 1) % 256,
                           0x28])
 
+        # the rows of the window, copied out of the frame buffer in one piece
+        view = memoryview(self.frame_buffer)
+        rowbytes = (x_end - x_start) // 8
+        window = b''.join(view[i:i + rowbytes]
+                          for i in range(y_start * width + x_start // 8, y_end * width, width))
+
         # writes old data to sram for programming
         self.send_command(self.DATA_START_TRANSMISSION_1)
-        for j in range(y_end - y_start):
-            idx = (y_start + j) * width + x_start // 8
-            # TODO: optimize this by using send_data(array[from:to])
-            for i in range((x_end - x_start) // 8):
-                self.send_data(self.frame_buffer[idx + i])
+        self.send_data_multi(window)
 
-        # writes new data to sram.
+        # writes new data (inverted) to sram.
         self.send_command(self.DATA_START_TRANSMISSION_2)
-        for j in range(y_end - y_start):
-            idx = (y_start + j) * width + x_start // 8
-            # TODO: optimize this by using send_data(array[from:to])
-            for i in range((x_end - x_start) // 8):
-                self.send_data(~self.frame_buffer[idx + i])
+        self.send_data_multi(window.translate(self.INVERT))
 
         self.send_command(self.DISPLAY_REFRESH)   # display refresh
         self.delay_ms(10)  # the delay here is necessary, 200us at least!!!
@@ -286,43 +292,125 @@ class EPD4in2(WavesharePartial, EPD4in2const):
     def frame_buffer_to_image(self):
         """Returns self.frame_buffer as a PIL.Image"""
 
-        im = Image.new('1', (self.width, self.height), "white")
-        pi = im.load()
+        return Image.frombytes('1', (self.width, self.height), bytes(self.frame_buffer))
 
-        for j in range(self.height):
-            idxj = j * self.width // 8
-            for i in range(self.width):
-                idiv, irem = divmod(i, 8)
-                mask = 0b10000000 >> irem
-                idxi = idiv
-                pi[i, j] = self.frame_buffer[idxi + idxj] & mask
+    def set_frame_buffer(self, x, y, image):
+        """Updates self.frame_buffer with image at (x, y)
+        Returns the area that changed, widened to whole bytes, as
+        (x_start, y_start, x_end, y_end) - or None if nothing did"""
 
-        return im
+        imwidth, imheight = image.size
+        width = self.width // 8
 
-    def set_frame_buffer(self, x, y, image):
-        """Updates self.frame_buffer with image at (x, y)"""
-
-        image_monocolor = image.convert('1')
-        imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-
-        for j in range(imheight):
-            idxj = (y + j) * self.width // 8
-            for i in range(imwidth):
-                idiv, irem = divmod(x + i, 8)
-                mask = 0b10000000 >> irem
-                idxi = idiv
-                if pixels[i, j] != 0:
-                    self.frame_buffer[idxi + idxj] |= mask
-                else:
-                    self.frame_buffer[idxi + idxj] &= ~mask
+        x_start = x // 8
+        x_end = min((x + imwidth + 7) // 8, width)
+        y_end = min(y + imheight, self.height)
+        rowbytes = x_end - x_start
+        if rowbytes <= 0 or y_end <= y:
+            return None
+
+        view = memoryview(self.frame_buffer)
+        rows = range(y * width + x_start, y_end * width, width)
+        old = b''.join(view[i:i + rowbytes] for i in rows)
+
+        if x % 8 == 0 and x_end * 8 == x + imwidth and y_end == y + imheight:
+            # the image covers whole bytes, so it can be packed as it is
+            packed = self.pack_frame_buffer(image)
+        else:
+            # the frame buffer can only be updated a byte at a time, so paste the
+            # image onto the current contents of the bytes it covers and pack those
+            region = Image.frombytes('1', (rowbytes * 8, y_end - y), old)
+            region.paste(image.convert('1'), (x - x_start * 8, 0))
+            packed = self.pack_frame_buffer(region)
+
+        if not self.synced:
+            # the panel could differ from the buffer anywhere, refresh all of it
+            if (x, y, imwidth, imheight) == (0, 0, self.width, self.height):
+                view[:] = packed
+                return 0, 0, self.width, self.height
+            for j, i in enumerate(rows):
+                view[i:i + rowbytes] = packed[j * rowbytes:(j + 1) * rowbytes]
+            return x_start * 8, y, x_end * 8, y_end
+        if packed == old:
+            return None
+
+        # copy the changed rows, and collect the changed bits of all of them to
+        # find the first and last changed byte
+        packed = memoryview(packed)
+        changed = 0
+        first = last = None
+        for j, i in enumerate(rows):
+            new = packed[j * rowbytes:(j + 1) * rowbytes]
+            if new != view[i:i + rowbytes]:
+                changed |= int.from_bytes(new, 'big') ^ int.from_bytes(view[i:i + rowbytes], 'big')
+                if first is None:
+                    first = j
+                last = j
+                view[i:i + rowbytes] = new
+
+        left = rowbytes - (changed.bit_length() + 7) // 8
+        right = rowbytes - ((changed & -changed).bit_length() - 1) // 8
+        return (x_start + left) * 8, y + first, (x_start + right) * 8, y + last + 1
 
     def draw(self, x, y, image):
         """replace a particular area on the display with an image"""
 
         if self.partial_refresh:
-            self.set_frame_buffer(x, y, image)
-            self.display_partial(x, y, x + image.width, y + image.height)
+            # only the bytes that changed are sent and refreshed
+            box = self.set_frame_buffer(x, y, image)
+            if box:
+                self.display_partial(*box)
+                if box == (0, 0, self.width, self.height):
+                    self.synced = True
         else:
             self.set_frame_buffer(0, 0, image)
             self.display_full()
+
+
+class SimulatedEPD4in2(Simulator):
+    """Simulated EPD 4.2" panel - prints the SPI bytes and refresh time used on exit"""
+
+    # a partial refresh sends the five LUTs and waits 100ms
+    command_bytes = 5 * 44
+    command_time = 0.1
+    refresh_times = {'partial': 0.45, 'full': 4.0}
+
+    def __init__(self, realtime=False):
+        super().__init__(name='Simulated EPD 4.2"', width=400, height=300, realtime=realtime)
+        self.supports_partial = True
+        # the real driver keeps the frame buffer, and finds what changed in it
+        self.panel = EPD4in2()
+
+    def init(self, **kwargs):
+        super().init(**kwargs)
+        self.panel.partial_refresh = self.partial_refresh
+        self.panel.synced = False
+        # a full refresh doesn't send the partial LUTs nor wait for them
+        if self.partial_refresh:
+            self.command_bytes, self.command_time = type(self).command_bytes, type(self).command_time
+        else:
+            self.command_bytes, self.command_time = 0, 0.0
+
+    def transfer_size(self, x, y, image):
+        if not self.partial_refresh:
+            return self.width * self.height // 8
+        # the window is widened to whole bytes and sent twice (old and new data)
+        rowbytes = (x + image.width + 7) // 8 - x // 8
+        return 2 * rowbytes * image.height
+
+    def waveform(self, bbox, x, y, image):
+        return "partial" if self.partial_refresh else "full"
+
+    def draw(self, x, y, image):
+        """Same steps as EPD4in2.draw, sending the changed window or the whole frame"""
+        if not self.partial_refresh:
+            self.panel.set_frame_buffer(0, 0, image)
+            self.account([(0, 0, image)], (0, 0, self.width, self.height))
+            return
+        box = self.panel.set_frame_buffer(x, y, image)
+        if not box:
+            return
+        window = self.panel.frame_buffer_to_image().crop(box)
+        self.account([(box[0], box[1], window)], box)
+        if box == (0, 0, self.width, self.height):
+            self.panel.synced = True
@@ -17,6 +17,10 @@
 from abc import ABC, abstractmethod
 from PIL import Image
 
+import atexit
+import json
+import queue
+import threading
 import time
 
 # if rpi libs are not found, don't care - hope that we don't end up
@@ -29,9 +33,15 @@ except ImportError:
 except RuntimeError as e:
     print(str(e))
 
+# Optional dependency - speeds up packing frame buffers
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Optional dependency
 try:
-    from gpiozero import OutputDevice, InputDevice, Device, SPIDevice
+    from gpiozero import OutputDevice, DigitalInputDevice, Device, SPIDevice
     print("gpiozero found - using that instead of RPi.GPIO")
 except ImportError:
     print("gpiozero not found - defaulting to RPi.GPIO")
@@ -47,7 +57,12 @@ class SpiDev:
     gpiozero = False
     spi = False
 
-    def __init__(self):
+    # Largest single transfer the spidev kernel module accepts, unless
+    # it has been changed with the 'bufsiz' module parameter
+    BUFSIZ = 4096
+    BUFSIZ_PATH = '/sys/module/spidev/parameters/bufsiz'
+
+    def __init__(self, chunk_size=None):
         try:
             factory = Device._default_pin_factory()
             self.spi = SPIDevice(pin_factory=factory)
@@ -55,6 +70,19 @@ class SpiDev:
         except Exception as e:
             print("Failed to init gpiozero spi device")
             self.spi = spidev.SpiDev(0, 0)
+        self.bufsiz = self.get_bufsiz()
+        self.chunk_size = chunk_size or self.bufsiz
+        # writebytes2 (spidev >= 3.4) takes any buffer and splits it at bufsiz itself
+        self.buffered = not self.gpiozero and hasattr(self.spi, 'writebytes2')
+
+    @staticmethod
+    def get_bufsiz():
+        """Read the transfer size limit of the spidev kernel module"""
+        try:
+            with open(SpiDev.BUFSIZ_PATH) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return SpiDev.BUFSIZ
 
     def writebytes(self, data):
         if self.gpiozero:
@@ -62,6 +90,24 @@ class SpiDev:
         else:
             self.spi.writebytes(data)
 
+    def writebuffer(self, data):
+        """Write a list or bytes-like object of any length, in transfers of
+        at most chunk_size bytes. Buffers are sliced without copying."""
+        if not isinstance(data, list):
+            data = memoryview(data).cast('B')
+        if self.buffered:
+            chunk_size = self.chunk_size
+            write = self.spi.writebytes2
+        else:
+            # writebytes and xfer2 fail on anything larger than bufsiz
+            chunk_size = min(self.chunk_size, self.bufsiz)
+            write = self.writebytes
+        if len(data) <= chunk_size:
+            write(data)
+            return
+        for i in range(0, len(data), chunk_size):
+            write(data[i: i + chunk_size])
+
     def readbytes(self, n):
         if self.gpiozero:
             return self.spi._spi.read(n)
@@ -92,6 +138,14 @@ class GPIO:
     LOW = 0
     HIGH = 1
 
+    # Polling used by wait_for when edge detection isn't available:
+    # spin for SPIN_TIME, then sleep for intervals growing up to MAX_POLL_INTERVAL
+    SPIN_TIME = 0.0005
+    MIN_POLL_INTERVAL = 0.00005
+    MAX_POLL_INTERVAL = 0.01
+    # Longest single edge wait before the pin is read again, in case an edge was missed
+    EDGE_WAIT_SLICE = 0.1
+
     pins = {}
 
     @staticmethod
@@ -120,7 +174,7 @@ class GPIO:
             if ioType == GPIO.OUT:
                 GPIO.pins[str(pin)] = OutputDevice(pin)
             else:
-                GPIO.pins[str(pin)] = InputDevice(pin)
+                GPIO.pins[str(pin)] = DigitalInputDevice(pin)
         except Exception as e:
             GPIO.pins[str(pin)] = False
             if ioType == GPIO.OUT:
@@ -144,6 +198,149 @@ class GPIO:
         else:
             pin.on() if value == 1 else pin.off()
 
+    @staticmethod
+    def wait_for(pinNo, value, timeout=None):
+        """Block until the input pin reads `value`, e.g. until a BUSY pin goes idle.
+        Waits for the edge where the backend supports it and falls back to polling.
+        Returns False if `timeout` (in seconds) ran out first."""
+        if GPIO.input(pinNo) == value:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pin = GPIO.pins[str(pinNo)]
+        try:
+            if pin == False:
+                return GPIO.wait_for_rpi_edge(pinNo, value, deadline)
+            if value == GPIO.HIGH:
+                return pin.wait_for_active(timeout)
+            return pin.wait_for_inactive(timeout)
+        except (AttributeError, RuntimeError):
+            #No edge detection for this pin (or it's already in use) - poll instead
+            return GPIO.poll_for(pinNo, value, deadline)
+
+    @staticmethod
+    def wait_for_rpi_edge(pinNo, value, deadline):
+        """RPi.GPIO can miss an edge that happens right before wait_for_edge
+        starts, so wait in slices and read the pin in between"""
+        edge = rpiGPIO.RISING if value == GPIO.HIGH else rpiGPIO.FALLING
+        while rpiGPIO.input(pinNo) != value:
+            wait = GPIO.EDGE_WAIT_SLICE
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    return False
+            rpiGPIO.wait_for_edge(pinNo, edge, timeout=max(1, int(wait * 1000)))
+        return True
+
+    @staticmethod
+    def poll_for(pinNo, value, deadline):
+        """Spin briefly, then poll with exponentially growing sleeps"""
+        start = time.monotonic()
+        interval = GPIO.MIN_POLL_INTERVAL
+        while GPIO.input(pinNo) != value:
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                return False
+            if now - start < GPIO.SPIN_TIME:
+                continue
+            time.sleep(interval)
+            interval = min(interval * 2, GPIO.MAX_POLL_INTERVAL)
+        return True
+
+class ShadowFramebuffer:
+    """A packed 1-bit copy of what is on the panel, used to skip redundant draws.
+    Rows are padded to whole bytes, most significant bit first and set bits are
+    white - the layout WaveshareEPD.pack_frame_buffer produces."""
+
+    def __init__(self, width, height, alignment=(8, 1), convert=True):
+        self.width = width
+        self.height = height
+        self.stride = (width + 7) // 8
+        self.buffer = bytearray(b'\xff' * (self.stride * height))
+        # changed regions are widened to this, x in whole bytes
+        self.align_x = max(8, alignment[0] - alignment[0] % 8)
+        self.align_y = max(1, alignment[1])
+        # whether other image modes are converted to 1-bit (as the driver would do)
+        # or just passed through
+        self.convert = convert
+        # the panel contents are unknown until the first full-screen draw
+        self.valid = False
+
+    def draw(self, x, y, image):
+        """Record an image drawn at (x,y). Returns the (x, y, image) that still needs
+        to be drawn - the changed region only - or None if the panel already shows it."""
+        if image.mode != '1':
+            if not self.convert:
+                self.valid = False
+                return x, y, image
+            image = image.convert('1')
+        width, height = image.size
+        if x < 0 or y < 0 or x + width > self.width or y + height > self.height:
+            self.valid = False
+            return x, y, image
+        changed = self.update(x, y, image)
+        if not self.valid:
+            self.valid = (x, y, width, height) == (0, 0, self.width, self.height)
+            return x, y, image
+        if not changed:
+            return None
+        box = self.align(changed)
+        return box[0], box[1], self.crop(box)
+
+    def update(self, x, y, image):
+        """Write an image into the buffer, return the box of bytes that changed"""
+        width, height = image.size
+        stride, buf = self.stride, self.buffer
+        first, last = x // 8, (x + width + 7) // 8
+        n = last - first
+        rows = range(y * stride + first, (y + height) * stride + first, stride)
+        old = b''.join(buf[i: i + n] for i in rows)
+        if x % 8 == 0 and width % 8 == 0:
+            new = image.tobytes()
+        else:
+            region = Image.frombytes('1', (n * 8, height), old)
+            region.paste(image, (x - first * 8, 0))
+            new = region.tobytes()
+        if old == new:
+            return None
+        if numpy:
+            diff = numpy.frombuffer(old, numpy.uint8).reshape(height, n) != \
+                   numpy.frombuffer(new, numpy.uint8).reshape(height, n)
+            changed_rows = numpy.flatnonzero(diff.any(axis=1))
+            changed_cols = numpy.flatnonzero(diff.any(axis=0))
+            top, bottom = int(changed_rows[0]), int(changed_rows[-1]) + 1
+            left, right = int(changed_cols[0]), int(changed_cols[-1]) + 1
+        else:
+            top = bottom = None
+            left, right = n, 0
+            for r in range(height):
+                a, b = old[r * n: (r + 1) * n], new[r * n: (r + 1) * n]
+                if a == b:
+                    continue
+                if top is None:
+                    top = r
+                bottom = r + 1
+                left = min(left, next(i for i in range(n) if a[i] != b[i]))
+                right = max(right, next(i for i in range(n, 0, -1) if a[i - 1] != b[i - 1]))
+        for r, i in enumerate(rows[top:bottom], top):
+            buf[i: i + n] = new[r * n: (r + 1) * n]
+        return ((first + left) * 8, y + top, min((first + right) * 8, self.width), y + bottom)
+
+    def align(self, box):
+        """Widen a box to the alignment, staying on the panel"""
+        left, top, right, bottom = box
+        left -= left % self.align_x
+        top -= top % self.align_y
+        right = min(right + -right % self.align_x, self.width)
+        bottom = min(bottom + -bottom % self.align_y, self.height)
+        return (left, top, right, bottom)
+
+    def crop(self, box):
+        """Get a region of the buffer as an image"""
+        left, top, right, bottom = box
+        rows = bytes(self.buffer[top * self.stride: bottom * self.stride])
+        return Image.frombytes('1', (self.stride * 8, bottom - top), rows).crop((left, 0, right, bottom - top))
+
+
 class DisplayDriver(ABC):
     """Abstract base class for a display driver - be it Waveshare e-Paper, PaPiRus, OLED..."""
 
@@ -165,6 +362,7 @@ class DisplayDriver(ABC):
         self.align_1bpp_width = None
         self.align_1bpp_height = None
         self.supports_multi_draw = None
+        self.shadow = None
 
     @abstractmethod
     def init(self, **kwargs):
@@ -176,6 +374,16 @@ class DisplayDriver(ABC):
         """Draw an image object on the display at (x,y)"""
         pass
 
+    def enable_shadow(self, convert=True):
+        """Opt in to a shadow framebuffer - call at the end of init(), once the size is known.
+        draw() should then pass its arguments through self.shadow.draw() first.
+        Set `convert` if the driver turns all images into 1-bit anyway."""
+        if self.enable_1bpp and self.align_1bpp_width:
+            alignment = (self.align_1bpp_width, self.align_1bpp_height)
+        else:
+            alignment = (8, 1)
+        self.shadow = ShadowFramebuffer(self.width, self.height, alignment, convert)
+
     def scrub(self, fillsize=16):
         """Scrub display - only works properly with partial refresh"""
         self.fill(self.black, fillsize=fillsize)
@@ -232,24 +440,200 @@ class Dummy(SpecialDriver):
 
 
 class Bitmap(SpecialDriver):
-    """Output a bitmap for each frame - overwrite old ones"""
+    """Output a bitmap for each frame - overwrite old ones
+
+    Frames are copied into a ring buffer of `ring_size` entries and written by
+    a background thread, so drawing isn't held up by encoding. The draw only
+    waits if the ring is full. Besides image formats Pillow can save (eg.
+    "png"), `file_format` can be "pbm" or "raw" (packed 1-bit rows, no header)
+    which need no compression. With `damage_only`, just the rectangle that was
+    drawn is written, with its position in a .json file next to it."""
 
-    def __init__(self, maxfiles=5, file_format="png"):
+    def __init__(self, maxfiles=5, file_format="png", damage_only=False, ring_size=16):
         super().__init__(name="Bitmap output driver", width=self.default_width, height=self.default_height, )
         self.maxfiles = maxfiles
         self.current_frame = 0
         self.frame_buffer = None
         self.file_format = file_format
+        self.damage_only = damage_only
+        self.ring = queue.Queue(ring_size)
+        self.error = None
+        self.thread = None
 
     def init(self, **kwargs):
+        self.flush()
         self.frame_buffer = Image.new('1', (self.width, self.height), 255)
         self.current_frame = 0
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='bitmap', daemon=True)
+            self.thread.start()
+            # write the frames still in the ring on exit
+            atexit.register(self.flush)
 
     def draw(self, x, y, image):
+        self.check()
         self.frame_buffer.paste(image, box=(x, y))
-        self.frame_buffer.save("bitmap_frame_{}.{}".format(self.current_frame, self.file_format))
+        if self.damage_only:
+            box = (x, y, x + image.width, y + image.height)
+            frame = self.frame_buffer.crop(box)
+        else:
+            box = None
+            frame = self.frame_buffer.copy()
+        self.ring.put((self.current_frame, box, frame))
         self.current_frame = (self.current_frame + 1) % self.maxfiles
 
+    def flush(self):
+        """Wait until all the frames in the ring have been written"""
+        self.ring.join()
+        self.check()
+
+    def check(self):
+        """Re-raise an exception from the writer thread"""
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+
+    def run(self):
+        while True:
+            number, box, frame = self.ring.get()
+            try:
+                self.write(number, box, frame)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.ring.task_done()
+
+    def write(self, number, box, frame):
+        name = "bitmap_frame_{}".format(number)
+        if self.file_format == "raw":
+            with open(name + ".raw", "wb") as f:
+                f.write(frame.convert('1').tobytes())
+        elif self.file_format == "pbm":
+            frame.convert('1').save(name + ".pbm", "PPM")
+        else:
+            frame.save("{}.{}".format(name, self.file_format))
+        if box:
+            with open(name + ".json", "w") as f:
+                json.dump({"x": box[0], "y": box[1], "width": box[2] - box[0], "height": box[3] - box[1]}, f)
+
+
+class Simulator(SpecialDriver):
+    """Simulated panel - base class, subclasses model a real one
+
+    Nothing is displayed. Each draw works out how many bytes the modeled panel
+    would be sent over SPI, how long that takes at its bus speed and how long
+    the refresh with the waveform it'd use would take, and adds them up in
+    `stats` - printed on exit. With `realtime`, draw also sleeps for the
+    simulated time, so that pipelined drawing can be measured as well."""
+
+    # panel model - set these in the subclasses
+    spi_hz = 2000000
+    # bytes of commands, LUTs etc. sent and fixed delays per image loaded
+    command_bytes = 0
+    command_time = 0.0
+    # waveform name -> refresh time in seconds
+    refresh_times = {}
+    # whether the real driver leaves out the draws that change nothing
+    shadowed = False
+
+    def __init__(self, name, width, height, realtime=False):
+        super().__init__(name=name, width=width, height=height)
+        self.type = 'Simulated display driver'
+        self.realtime = realtime
+        self.stats = None
+        self.reported = False
+
+    def init(self, **kwargs):
+        self.partial_refresh = bool(self.supports_partial and kwargs.get('partial', True))
+        self.enable_1bpp = bool(self.supports_1bpp and kwargs.get('enable_1bpp', True))
+        self.enable_a2 = kwargs.get('enable_a2', True)
+        mhz = kwargs.get('mhz', None)
+        if mhz:
+            self.spi_hz = int(mhz * 1000000)
+        if self.shadowed:
+            self.enable_shadow(convert=False)
+        self.reset_stats()
+        if not self.reported:
+            atexit.register(lambda: print(self.report()))
+            self.reported = True
+
+    def reset_stats(self):
+        self.stats = {'draws': 0, 'loads': 0, 'bytes': 0, 'pixels': 0,
+                      'transfer_time': 0.0, 'refresh_time': 0.0, 'refreshes': {}}
+
+    @property
+    def total_time(self):
+        """Simulated time spent on all the draws so far, in seconds"""
+        return self.stats['transfer_time'] + self.stats['refresh_time']
+
+    def report(self):
+        """Summary of the totals as a printable string"""
+        stats = self.stats
+        refreshes = ", ".join("{} {}".format(n, mode) for mode, n in sorted(stats['refreshes'].items()))
+        return ("{}: {} draws ({} images, {} pixels), {} bytes in {:.3f}s, "
+                "refreshes ({}) in {:.3f}s, total {:.3f}s").format(
+                    self.name, stats['draws'], stats['loads'], stats['pixels'], stats['bytes'],
+                    stats['transfer_time'], refreshes or "none", stats['refresh_time'], self.total_time)
+
+    @abstractmethod
+    def transfer_size(self, x, y, image):
+        """Bytes of image data sent when loading the image at (x, y)"""
+        pass
+
+    @abstractmethod
+    def waveform(self, bbox, x, y, image):
+        """Name of the waveform used to refresh bbox after loading image last, at (x, y)"""
+        pass
+
+    def refreshed(self, bbox, mode):
+        """Called after each refresh, returns the waveforms of any extra refreshes it causes"""
+        return []
+
+    def draw(self, x, y, image):
+        if self.shadow:
+            region = self.shadow.draw(x, y, image)
+            if not region:
+                return
+            x, y, image = region
+        self.account([(x, y, image)], (x, y, x + image.width, y + image.height))
+
+    def draw_multi(self, imageArray):
+        """Load all the images, then refresh the area around them once"""
+        if not self.supports_multi_draw:
+            for item in imageArray:
+                self.draw(item["x"], item["y"], item["image"])
+            return
+        loads = [(item["x"], item["y"], item["image"]) for item in imageArray]
+        if self.shadow:
+            loads = [region for region in (self.shadow.draw(*load) for load in loads) if region]
+        if loads:
+            bbox = (min(x for x, y, image in loads), min(y for x, y, image in loads),
+                    max(x + image.width for x, y, image in loads),
+                    max(y + image.height for x, y, image in loads))
+            self.account(loads, bbox)
+
+    def account(self, loads, bbox):
+        stats = self.stats
+        size = sum(self.transfer_size(x, y, image) for x, y, image in loads)
+        size += self.command_bytes * len(loads)
+        transfer_time = size * 8 / self.spi_hz + self.command_time * len(loads)
+        mode = self.waveform(bbox, *loads[-1])
+        # eg. clean-ups the driver schedules after the refresh - no new image data, only the command
+        modes = [mode] + self.refreshed(bbox, mode)
+        transfer_time += self.command_time * (len(modes) - 1)
+        refresh_time = sum(self.refresh_times[mode] for mode in modes)
+
+        stats['draws'] += 1
+        stats['loads'] += len(loads)
+        stats['bytes'] += size
+        stats['pixels'] += sum(image.width * image.height for x, y, image in loads)
+        stats['transfer_time'] += transfer_time
+        stats['refresh_time'] += refresh_time
+        for mode in modes:
+            stats['refreshes'][mode] = stats['refreshes'].get(mode, 0) + 1
+        if self.realtime:
+            time.sleep(transfer_time + refresh_time)
+
 
 class WaveshareEPD(DisplayDriver):
     """Base class for Waveshare displays with common code for all - the 'epdif.py'
@@ -277,6 +661,8 @@ class WaveshareEPD(DisplayDriver):
     ROTATE_270 = 0x03
 
     # SPI device, bus = 0, device = 0
+    # Bytes per SPI transfer for bulk data, None = the spidev 'bufsiz'
+    spi_chunk_size = None
 
     # SPI methods
 
@@ -288,6 +674,10 @@ class WaveshareEPD(DisplayDriver):
     def epd_digital_read(pin):
         return GPIO.input(pin)
 
+    @staticmethod
+    def epd_digital_wait(pin, value, timeout=None):
+        return GPIO.wait_for(pin, value, timeout)
+
     @staticmethod
     def epd_delay_ms(delaytime):
         time.sleep(float(delaytime) / 1000.0)
@@ -299,7 +689,7 @@ class WaveshareEPD(DisplayDriver):
 
         #SpiDev init must come first, otherwise CS_PIN read conflicts
         #will sometimes occur during startup.
-        self.SPI = SpiDev()
+        self.SPI = SpiDev(chunk_size=self.spi_chunk_size)
         self.SPI.setSpeed(2000000)
         self.SPI.setMode(0b00)
 
@@ -327,6 +717,10 @@ class WaveshareEPD(DisplayDriver):
     def digital_read(self, pin):
         return self.epd_digital_read(pin)
 
+    def digital_wait(self, pin, value, timeout=None):
+        """Wait until the pin reads value, False if the timeout (seconds) ran out"""
+        return self.epd_digital_wait(pin, value, timeout)
+
     def delay_ms(self, delaytime):
         self.epd_delay_ms(delaytime)
 
@@ -342,11 +736,21 @@ class WaveshareEPD(DisplayDriver):
         # so use [data] instead of data
         self.spi_transfer([data])
 
+    @staticmethod
+    def pack_frame_buffer(image, reverse=False):
+        """Pack an image into the frame buffer format used by most of the controllers:
+        1 bit per pixel, most significant bit first, each row padded to a full byte.
+        Set bits are white, or black if `reverse` is set."""
+        if image.mode != '1':
+            image = image.convert('1')
+        if numpy:
+            pixels = numpy.asarray(image)
+            return numpy.packbits(~pixels if reverse else pixels, axis=1).tobytes()
+        return image.tobytes('raw', '1;I' if reverse else '1')
+
     def send_data_multi(self, dataArray):
         self.digital_write(self.DC_PIN, GPIO.HIGH)
-        max_transfer_size = 4096
-        for i in range(0, len(dataArray), max_transfer_size):
-            self.spi_transfer(dataArray[i: i + max_transfer_size])
+        self.SPI.writebuffer(dataArray)
 
     def reset(self):
         self.digital_write(self.RST_PIN, GPIO.LOW)
@@ -28,6 +28,27 @@ class WaveshareColor(WaveshareFull):
 
     VCM_DC_SETTING = 0x82
 
+    # gray levels of an image without a red plane: black < RED_LEVEL <= red < WHITE_LEVEL <= white
+    RED_LEVEL = 64
+    WHITE_LEVEL = 192
+    # gray level that splits black from white (and red from no red) when the red plane is given
+    THRESHOLD = 128
+
+    # the pixel classes, in the order of their gray levels
+    BLACK = 0
+    RED = 1
+    WHITE = 2
+
+    # how the controller takes a frame:
+    # 'planes' - a black and a red plane, 1 bit per pixel each, most significant bit first
+    # 'nibbles' - a single plane, 4 bits per pixel, first pixel in the high nibble
+    frame_format = 'planes'
+    # value of the bit for a black pixel in the black plane, and for a red one in the red plane
+    black_bit = 0
+    red_bit = 0
+    # codes of black, red and white pixels in the nibbles
+    NIBBLES = (0x0, 0x4, 0x3)
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.colors = 3
@@ -38,10 +59,48 @@ class WaveshareColor(WaveshareFull):
     def init(self, **kwargs):
         pass
 
-    def draw(self, x, y, image):
+    def draw(self, x, y, image, red=None):
         """Display an image - this module does not support partial refresh: x, y are ignored
-        IMPORTANT NOTE: this method IGNORES the red buffer completely!"""
-        self.display_frame(self.get_frame_buffer(image))
+        Dark pixels of the optional `red` image are drawn red (or yellow). Without it,
+        the gray levels between black and white of `image` are drawn red instead."""
+        self.display_frame(*self.get_frame_buffers(image, red))
+
+    def classify(self, image, red=None):
+        """An 'L' image with the BLACK, RED or WHITE class of each pixel"""
+        if red is None:
+            levels = [self.BLACK if v < self.RED_LEVEL else self.RED if v < self.WHITE_LEVEL else self.WHITE
+                      for v in range(256)]
+            return image.convert('L').point(levels)
+        classes = image.convert('L').point([self.BLACK if v < self.THRESHOLD else self.WHITE for v in range(256)])
+        mask = red.convert('L').point([255 if v < self.THRESHOLD else 0 for v in range(256)], '1')
+        classes.paste(self.RED, mask=mask)
+        return classes
+
+    def get_frame_buffers(self, image, red=None):
+        """Encode the image (and red plane) in the controller's format, in one
+        pass over the pixels - returns the arguments for display_frame"""
+        if image.size != (self.width, self.height):
+            raise ValueError('Image must be same dimensions as display: required ({0}x{1}), got ({2}x{3})'
+                             .format(self.width, self.height, image.width, image.height))
+        if red is not None and red.size != image.size:
+            raise ValueError('Red plane must be same dimensions as the image')
+        classes = self.classify(image, red)
+
+        if self.frame_format == 'nibbles':
+            codes = classes.tobytes().translate(bytes(self.NIBBLES) + bytes(256 - len(self.NIBBLES)))
+            # P;4 packs the first pixel of each pair into the high nibble
+            return (Image.frombytes('P', image.size, codes).tobytes('raw', 'P;4'),)
+
+        def plane(cls, bit):
+            """Bits set to `bit` where the pixel is of class `cls`"""
+            on, off = (255, 0) if bit else (0, 255)
+            return classes.point([on if v == cls else off for v in range(256)], '1').tobytes('raw', '1')
+
+        return plane(self.BLACK, self.black_bit), plane(self.RED, self.red_bit)
+
+    def get_frame_buffer(self, image, reverse=False):
+        """The frame - or the black plane - for display_frame"""
+        return self.get_frame_buffers(image)[0]
 
 
 class EPD4in2b(WaveshareColor):
@@ -82,22 +141,18 @@ class EPD4in2b(WaveshareColor):
         self.send_command(self.PANEL_SETTING)
         self.send_data(0x0F)  # LUT from OTP
 
-    def get_frame_buffer(self, image, reverse=True):
-        super().get_frame_buffer(image, reverse=reverse)
-
     def display_frame(self, frame_buffer_black, *args):
         frame_buffer_red = args[0] if args else None
+        size = int(self.width * self.height / 8)
         if frame_buffer_black:
             self.send_command(self.DATA_START_TRANSMISSION_1)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(frame_buffer_black[i])
+            self.send_data_multi(frame_buffer_black[:size])
             self.delay_ms(2)
         if frame_buffer_red:
             self.send_command(self.DATA_START_TRANSMISSION_2)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(frame_buffer_red[i])
+            self.send_data_multi(frame_buffer_red[:size])
             self.delay_ms(2)
 
         self.send_command(self.DISPLAY_REFRESH)
@@ -116,6 +171,8 @@ class EPD4in2b(WaveshareColor):
 class EPD7in5b(WaveshareColor):
     """Waveshare 7.5" B - black / white / red"""
 
+    frame_format = 'nibbles'
+
     IMAGE_PROCESS = 0x13
     LUT_BLUE = 0x21
     LUT_GRAY_1 = 0x23
@@ -169,53 +226,9 @@ class EPD7in5b(WaveshareColor):
         self.send_command(0xe5)  # FLASH MODE
         self.send_data(0x03)
 
-    def get_frame_buffer(self, image, reverse=False):
-        buf = [0x00] * int(self.width * self.height / 4)
-        # Set buffer to value of Python Imaging Library image.
-        # Image must be in mode L.
-        image_grayscale = image.convert('L')
-        imwidth, imheight = image_grayscale.size
-        if imwidth != self.width or imheight != self.height:
-            raise ValueError('Image must be same dimensions as display \
-                ({0}x{1}).'.format(self.width, self.height))
-
-        pixels = image_grayscale.load()
-        for y in range(self.height):
-            for x in range(self.width):
-                # Set the bits for the column of pixels at the current position.
-                if pixels[x, y] < 64:  # black
-                    buf[int((x + y * self.width) / 4)] &= ~(0xC0 >> (x % 4 * 2))
-                elif pixels[x, y] < 192:  # convert gray to red
-                    buf[int((x + y * self.width) / 4)] &= ~(0xC0 >> (x % 4 * 2))
-                    buf[int((x + y * self.width) / 4)] |= 0x40 >> (x % 4 * 2)
-                else:  # white
-                    buf[int((x + y * self.width) / 4)] |= 0xC0 >> (x % 4 * 2)
-        return buf
-
     def display_frame(self, frame_buffer, *args):
         self.send_command(self.DATA_START_TRANSMISSION_1)
-        for i in range(0, int(self.width / 4 * self.height)):
-            temp1 = frame_buffer[i]
-            j = 0
-            while j < 4:
-                if (temp1 & 0xC0) == 0xC0:
-                    temp2 = 0x03
-                elif (temp1 & 0xC0) == 0x00:
-                    temp2 = 0x00
-                else:
-                    temp2 = 0x04
-                temp2 = (temp2 << 4) & 0xFF
-                temp1 = (temp1 << 2) & 0xFF
-                j += 1
-                if (temp1 & 0xC0) == 0xC0:
-                    temp2 |= 0x03
-                elif (temp1 & 0xC0) == 0x00:
-                    temp2 |= 0x00
-                else:
-                    temp2 |= 0x04
-                temp1 = (temp1 << 2) & 0xFF
-                self.send_data(temp2)
-                j += 1
+        self.send_data_multi(frame_buffer[:int(self.width / 2 * self.height)])
         self.send_command(self.DISPLAY_REFRESH)
         self.delay_ms(100)
         self.wait_until_idle()
@@ -246,6 +259,9 @@ class EPD7in5b_V2(WaveshareColor):
     TCON_RESOLUTION = 0x61
     TEMPERATURE_CALIBRATION = 0x41
 
+    # no red is all zeros
+    red_bit = 1
+
     def __init__(self):
         super().__init__(name='7.5" B V2', width=800, height=480)
         print("!! You are using an EXPERIMENTAL DRIVER, USE AT OWN RISK !!")
@@ -303,22 +319,19 @@ class EPD7in5b_V2(WaveshareColor):
                 # return a blank buffer
             return [0x00] * (int(self.width/8) * self.height)
 
-        buf = bytearray(img.tobytes('raw'))
-            # The bytes need to be inverted, because in the PIL world 0=black and 1=white, but
-            # in the e-paper world 0=white and 1=black.
-        for i in range(len(buf)):
-            buf[i] ^= 0xFF
-        return buf
+        # The bytes need to be inverted, because in the PIL world 0=black and 1=white, but
+        # in the e-paper world 0=white and 1=black.
+        return bytearray(self.pack_frame_buffer(img, reverse=True))
 
     def display_frame(self, frame_buffer, *args):
         frame_buffer_red = args[0] if args else None
 
+        size = int(self.width * self.height / 8)
+
         if frame_buffer:
             self.send_command(self.DATA_START_TRANSMISSION_1)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(frame_buffer[i])
-                ## self.send_data(0)
+            self.send_data_multi(frame_buffer[:size])
             self.delay_ms(2)
 
         self.send_command(0x13)
@@ -326,12 +339,10 @@ class EPD7in5b_V2(WaveshareColor):
         if frame_buffer_red:
             #self.send_command(self.DATA_START_TRANSMISSION_2)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(frame_buffer_red[i])
+            self.send_data_multi(frame_buffer_red[:size])
             self.delay_ms(2)
         else:
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(0x00)
+            self.send_data_multi(bytes(size))
                 
         self.send_command(0x12)
         self.send_command(self.DISPLAY_REFRESH)
@@ -358,8 +369,18 @@ class EPD5in65f(WaveshareColor):
     TCON_RESOLUTION = 0x61
     TEMPERATURE_CALIBRATION = 0x41
 
-    def __init__(self):
+    # the colors in the order of their codes: black, white, green, blue, red, yellow, orange
+    COLORS = [0, 0, 0, 255, 255, 255, 0, 255, 0, 0, 0, 255, 255, 0, 0, 255, 255, 0, 255, 128, 0]
+    # palette index -> color code, for the palette below: the colors and black, 32 times over
+    COLOR_CODES = (bytes(range(7)) + bytes(1)) * 32
+
+    def __init__(self, dither=True):
         super().__init__(name='5.65" F', width=600, height=448)
+        # Floyd-Steinberg dithering for the colors in between, or nearest color
+        self.dither = dither
+        self.palette = Image.new('P', (1, 1))
+        # multiply by 32 to pad palette to reach required length of 768
+        self.palette.putpalette((self.COLORS + [0, 0, 0]) * 32)
 
     def reset(self):
         self.digital_write(self.RST_PIN, 1)
@@ -381,13 +402,16 @@ class EPD5in65f(WaveshareColor):
         self.spi_transfer([data])
         self.digital_write(self.CS_PIN, 1)
 
+    def send_data_multi(self, dataArray):
+        self.digital_write(self.CS_PIN, 0)
+        super().send_data_multi(dataArray)
+        self.digital_write(self.CS_PIN, 1)
+
     def wait_until_busy(self):
-        while self.digital_read(self.BUSY_PIN) == 0:  # 0: idle, 1: busy
-            self.delay_ms(100)
+        self.digital_wait(self.BUSY_PIN, 1)  # 0: idle, 1: busy
 
     def wait_until_idle(self):
-        while self.digital_read(self.BUSY_PIN) == 1:  # 0: idle, 1: busy
-            self.delay_ms(100)
+        self.digital_wait(self.BUSY_PIN, 0)  # 0: idle, 1: busy
 
     def init(self, **kwargs):
         if self.epd_init() != 0:
@@ -432,46 +456,26 @@ class EPD5in65f(WaveshareColor):
         self.send_data(0x37)
 
     def get_frame_buffer(self, image, reverse=False):
-        buf = [0x00] * int(self.width * self.height / 2)
-
-        # quantize image with palette of possible colors
-        image_palette = Image.new('P', (1, 1))
-        image_palette.putpalette(([0, 0, 0, 255, 255, 255, 0, 255, 0, 0, 0, 255, 255, 0, 0, 255, 255, 0, 255, 128, 0]
-                                  + [0, 0, 0]) * 32) # multiply by 32 to pad palette to reach required length of 768
-        image_rgb = image.quantize(palette=image_palette).convert('RGB')
-
-        imwidth, imheight = image_rgb.size
-
-        if imwidth != self.width or imheight != self.height:
+        """Quantize the image to the 7 colors and pack two pixels per byte.
+        The palette indices from quantize are mapped to the panel's color codes
+        through a lookup table and packed by PIL, without a per pixel loop."""
+        if image.size != (self.width, self.height):
             raise ValueError('Image must be same dimensions as display \
                 ({0}x{1}).'.format(self.width, self.height))
 
-        pixels = image_rgb.load()
-
-        for y in range(self.height):
-            for x in range(self.width):
-                pos = int((x + y * self.width) / 2)
-                color = 0
-
-                if pixels[x, y][0] == 0 and pixels[x, y][1] == 0 and pixels[x, y][2] == 0:
-                    color = 0
-                elif pixels[x, y][0] == 255 and pixels[x, y][1] == 255 and pixels[x, y][2] == 255:
-                    color = 1
-                elif pixels[x, y][0] == 0 and pixels[x, y][1] == 255 and pixels[x, y][2] == 0:
-                    color = 2
-                elif pixels[x, y][0] == 0 and pixels[x, y][1] == 0 and pixels[x, y][2] == 255:
-                    color = 3
-                elif pixels[x, y][0] == 255 and pixels[x, y][1] == 0 and pixels[x, y][2] == 0:
-                    color = 4
-                elif pixels[x, y][0] == 255 and pixels[x, y][1] == 255 and pixels[x, y][2] == 0:
-                    color = 5
-                elif pixels[x, y][0] == 255 and pixels[x, y][1] == 128 and pixels[x, y][2] == 0:
-                    color = 6
-
-                data_t = buf[pos] & (~(0xF0 >> ((x % 2) * 4)))
-                buf[pos] = data_t | ((color << 4) >> ((x % 2) * 4))
-
-        return buf
+        # only RGB and L images can be quantized to a palette
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        dither = Image.FLOYDSTEINBERG if self.dither else Image.NONE
+        indices = image.quantize(palette=self.palette, dither=dither)
+        codes = indices.tobytes().translate(self.COLOR_CODES)
+
+        # P;4 packs the first pixel of each pair into the high nibble
+        return Image.frombytes('P', image.size, codes).tobytes('raw', 'P;4')
+
+    def get_frame_buffers(self, image, red=None):
+        """All the colors come from the image - there's no separate red plane"""
+        return (self.get_frame_buffer(image),)
 
     def display_frame(self, frame_buffer, *args):
         self.send_command(self.TCON_RESOLUTION)
@@ -480,9 +484,7 @@ class EPD5in65f(WaveshareColor):
         self.send_data(0x01)
         self.send_data(0xC0)
         self.send_command(self.DATA_START_TRANSMISSION_1)
-        for i in range(0, int(self.height)):
-            for j in range(0, int(self.width / 2)):
-                self.send_data((frame_buffer[j + (int(self.width / 2) * i)]))
+        self.send_data_multi(frame_buffer[:int(self.width / 2) * self.height])
         self.send_command(self.POWER_ON)
         self.wait_until_busy()
         self.send_command(self.DISPLAY_REFRESH)
@@ -585,39 +587,3 @@ class EPD5in83b(EPD5in83):
         self.send_data(0x20)  # decide by LUT file
         self.send_command(0xe5)  # FLASH MODE
         self.send_data(0x03)
-
-    def get_frame_buffer(self, image, reverse=True):
-        super().get_frame_buffer(image, reverse=reverse)
-
-    def display_frame(self, frame_buffer_black, *args):
-        frame_buffer_red = args[0] if args else None
-        self.send_command(self.DATA_START_TRANSMISSION_1)
-        for i in range(0, int(self.width / 8 * self.height)):
-            temp1 = frame_buffer_black[i]
-            temp2 = frame_buffer_red[i]
-            j = 0
-            while j < 8:
-                if (temp2 & 0x80) == 0x00:
-                    temp3 = 0x04  # red
-                elif (temp1 & 0x80) == 0x00:
-                    temp3 = 0x00  # black
-                else:
-                    temp3 = 0x03  # white
-
-                temp3 = (temp3 << 4) & 0xFF
-                temp1 = (temp1 << 1) & 0xFF
-                temp2 = (temp2 << 1) & 0xFF
-                j += 1
-                if (temp2 & 0x80) == 0x00:
-                    temp3 |= 0x04  # red
-                elif (temp1 & 0x80) == 0x00:
-                    temp3 |= 0x00  # black
-                else:
-                    temp3 |= 0x03  # white
-                temp1 = (temp1 << 1) & 0xFF
-                temp2 = (temp2 << 1) & 0xFF
-                self.send_data(temp3)
-                j += 1
-        self.send_command(self.DISPLAY_REFRESH)
-        self.delay_ms(100)
-        self.wait_until_idle()
@@ -167,37 +167,137 @@ class WaveshareColorDraw(WaveshareColor):
         0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00
     ]
 
+    # The drawing methods below work on packed frame buffers (1 bit per pixel, rows of
+    # EPD_WIDTH pixels, as from new_frame_buffer or get_frame_buffers) in the coordinates
+    # of the current rotation. Each primitive is rotated as a whole, and horizontal runs
+    # of pixels are filled a byte at a time.
+
+    def new_frame_buffer(self, colored=False):
+        """A frame buffer filled with colored or uncolored pixels"""
+        fill = 0xFF if bool(colored) == bool(self.black_bit) else 0x00
+        return bytearray([fill]) * (self.EPD_WIDTH // 8 * self.EPD_HEIGHT)
+
+    def rotation(self):
+        """Coefficients (a, b, c, d, e, f) of the mapping of (x, y) in the current
+        rotation to the panel: (a * x + b * y + c, d * x + e * y + f)"""
+        if self.rotate == self.ROTATE_90:
+            return 0, -1, self.EPD_WIDTH, 1, 0, 0
+        if self.rotate == self.ROTATE_180:
+            return -1, 0, self.EPD_WIDTH, 0, -1, self.EPD_HEIGHT
+        if self.rotate == self.ROTATE_270:
+            return 0, 1, 0, -1, 0, self.EPD_HEIGHT
+        return 1, 0, 0, 0, 1, 0
+
+    def to_absolute(self, x, y):
+        """Position on the panel of the pixel at (x, y) in the current rotation"""
+        a, b, c, d, e, f = self.rotation()
+        return a * x + b * y + c, d * x + e * y + f
+
     def set_pixel(self, frame_buffer, x, y, colored):
         if x < 0 or x >= self.width or y < 0 or y >= self.height:
             return
-        if self.rotate == self.ROTATE_0:
-            self.set_absolute_pixel(frame_buffer, x, y, colored)
-        elif self.rotate == self.ROTATE_90:
-            point_temp = x
-            x = self.EPD_WIDTH - y
-            y = point_temp
-            self.set_absolute_pixel(frame_buffer, x, y, colored)
-        elif self.rotate == self.ROTATE_180:
-            x = self.EPD_WIDTH - x
-            y = self.EPD_HEIGHT - y
-            self.set_absolute_pixel(frame_buffer, x, y, colored)
-        elif self.rotate == self.ROTATE_270:
-            point_temp = x
-            x = y
-            y = self.EPD_HEIGHT - point_temp
-            self.set_absolute_pixel(frame_buffer, x, y, colored)
-
-    # overridden in EPD2in7b
-    def set_absolute_pixel(self, frame_buffer, x, y, colored, reverse=False):
+        x, y = self.to_absolute(x, y)
+        self.set_absolute_pixel(frame_buffer, x, y, colored)
+
+    def set_absolute_pixel(self, frame_buffer, x, y, colored, reverse=None):
         # To avoid display orientation effects
         # use EPD_WIDTH instead of self.width
         # use EPD_HEIGHT instead of self.height
         if x < 0 or x >= self.EPD_WIDTH or y < 0 or y >= self.EPD_HEIGHT:
             return
+        # colored pixels are cleared bits, unless reversed (as on EPD2in7b)
+        if reverse is None:
+            reverse = self.black_bit
         if not colored if reverse else colored:
-            frame_buffer[(x + y * self.EPD_WIDTH) / 8] &= ~(0x80 >> (x % 8))
+            frame_buffer[(x + y * self.EPD_WIDTH) // 8] &= ~(0x80 >> (x % 8))
         else:
-            frame_buffer[(x + y * self.EPD_WIDTH) / 8] |= 0x80 >> (x % 8)
+            frame_buffer[(x + y * self.EPD_WIDTH) // 8] |= 0x80 >> (x % 8)
+
+    def set_points(self, frame_buffer, points, colored):
+        """Set a list of (x, y) pixels in the current rotation"""
+        width, height = self.width, self.height
+        a, b, c, d, e, f = self.rotation()
+        for x, y in points:
+            if 0 <= x < width and 0 <= y < height:
+                self.set_absolute_pixel(frame_buffer, a * x + b * y + c, d * x + e * y + f, colored)
+
+    def fill_rectangle(self, frame_buffer, x0, y0, x1, y1, colored):
+        """Fill the rectangle between the corners (x0, y0) and (x1, y1), inclusive, in
+        the current rotation - a rotated rectangle is still a rectangle on the panel"""
+        x0, x1 = max(min(x0, x1), 0), min(max(x0, x1), self.width - 1)
+        y0, y1 = max(min(y0, y1), 0), min(max(y0, y1), self.height - 1)
+        if x0 > x1 or y0 > y1:
+            return
+        (ax0, ay0), (ax1, ay1) = self.to_absolute(x0, y0), self.to_absolute(x1, y1)
+        self.fill_absolute_rectangle(frame_buffer, min(ax0, ax1), min(ay0, ay1), max(ax0, ax1), max(ay0, ay1),
+                                     colored)
+
+    def fill_absolute_rectangle(self, frame_buffer, x0, y0, x1, y1, colored):
+        """Fill the rectangle from (x0, y0) to (x1, y1), inclusive, in panel coordinates"""
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.EPD_WIDTH - 1), min(y1, self.EPD_HEIGHT - 1)
+        if x0 > x1 or y0 > y1:
+            return
+        set_bits = bool(colored) == bool(self.black_bit)
+        stride = self.EPD_WIDTH // 8
+        first, last = x0 // 8, x1 // 8
+        # partial bytes at the ends of the run, whole bytes in between
+        first_mask = 0xFF >> (x0 % 8)
+        last_mask = (0xFF << (7 - x1 % 8)) & 0xFF
+        if first == last:
+            first_mask &= last_mask
+        run = bytes([0xFF if set_bits else 0x00]) * (last - first - 1)
+        for row in range(y0 * stride, (y1 + 1) * stride, stride):
+            if set_bits:
+                frame_buffer[row + first] |= first_mask
+                if last != first:
+                    frame_buffer[row + last] |= last_mask
+            else:
+                frame_buffer[row + first] &= ~first_mask
+                if last != first:
+                    frame_buffer[row + last] &= ~last_mask
+            if run:
+                frame_buffer[row + first + 1:row + last] = run
+
+    def blit(self, frame_buffer, x, y, mask, colored):
+        """Set the pixels of a '1' mask image at (x, y) in the current rotation"""
+        box = (max(-x, 0), max(-y, 0), min(mask.width, self.width - x), min(mask.height, self.height - y))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return
+        mask = mask.crop(box)
+        x, y = x + box[0], y + box[1]
+        corners = self.to_absolute(x, y), self.to_absolute(x + mask.width - 1, y + mask.height - 1)
+        transpose = {self.ROTATE_90: Image.ROTATE_270,
+                     self.ROTATE_180: Image.ROTATE_180,
+                     self.ROTATE_270: Image.ROTATE_90}.get(self.rotate)
+        if transpose is not None:
+            mask = mask.transpose(transpose)
+        self.blit_absolute(frame_buffer, min(corners[0][0], corners[1][0]), min(corners[0][1], corners[1][1]),
+                           mask, colored)
+
+    def blit_absolute(self, frame_buffer, x, y, mask, colored):
+        """Set the pixels of a '1' mask image at (x, y) in panel coordinates, a row at a time"""
+        box = (max(-x, 0), max(-y, 0), min(mask.width, self.EPD_WIDTH - x), min(mask.height, self.EPD_HEIGHT - y))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return
+        x, y = x + box[0], y + box[1]
+        # line the mask up with the bytes of the frame buffer
+        offset = x % 8
+        aligned = Image.new('1', ((offset + box[2] - box[0] + 7) // 8 * 8, box[3] - box[1]), 0)
+        aligned.paste(mask.crop(box), (offset, 0))
+        bits = aligned.tobytes('raw', '1')
+
+        set_bits = bool(colored) == bool(self.black_bit)
+        stride = self.EPD_WIDTH // 8
+        size = aligned.width // 8
+        start = y * stride + x // 8
+        for i in range(0, len(bits), size):
+            row = int.from_bytes(bits[i:i + size], 'big')
+            if row:
+                old = int.from_bytes(bytes(frame_buffer[start:start + size]), 'big')
+                new = old | row if set_bits else old & ~row
+                frame_buffer[start:start + size] = new.to_bytes(size, 'big')
+            start += stride
 
     def draw_circle(self, frame_buffer, x, y, radius, colored):
         # Bresenham algorithm
@@ -206,11 +306,10 @@ class WaveshareColorDraw(WaveshareColor):
         err = 2 - 2 * radius
         if x >= self.width or y >= self.height:
             return
+        points = []
         while True:
-            self.set_pixel(frame_buffer, x - x_pos, y + y_pos, colored)
-            self.set_pixel(frame_buffer, x + x_pos, y + y_pos, colored)
-            self.set_pixel(frame_buffer, x + x_pos, y - y_pos, colored)
-            self.set_pixel(frame_buffer, x - x_pos, y - y_pos, colored)
+            points += [(x - x_pos, y + y_pos), (x + x_pos, y + y_pos),
+                       (x + x_pos, y - y_pos), (x - x_pos, y - y_pos)]
             e2 = err
             if e2 <= y_pos:
                 y_pos += 1
@@ -222,48 +321,50 @@ class WaveshareColorDraw(WaveshareColor):
                 err += x_pos * 2 + 1
             if x_pos > 0:
                 break
+        self.set_points(frame_buffer, points, colored)
 
     # this only appears in EPD1in54b and EPD1in54c source
     def display_string_at(self, frame_buffer, x, y, text, font, colored):
         image = Image.new('1', (self.width, self.height))
         draw = ImageDraw.Draw(image)
         draw.text((x, y), text, font=font, fill=255)
-        # Set buffer to value of Python Imaging Library image.
-        # Image must be in mode 1.
-        pixels = image.load()
-        for y in range(self.height):
-            for x in range(self.width):
-                # Set the bits for the column of pixels at the current position.
-                if pixels[x, y] != 0:
-                    self.set_pixel(frame_buffer, x, y, colored)
+        # blit just the part of the screen that the text covers
+        bbox = image.getbbox()
+        if bbox:
+            self.blit(frame_buffer, bbox[0], bbox[1], image.crop(bbox), colored)
 
     # this, on the other hand, appears in the EPD2in7b source - same method, different name
     def draw_string_at(self, frame_buffer, x, y, text, font, colored):
         self.display_string_at(frame_buffer, x, y, text, font, colored)
 
     def draw_line(self, frame_buffer, x0, y0, x1, y1, colored):
+        if x0 == x1 or y0 == y1:
+            self.fill_rectangle(frame_buffer, x0, y0, x1, y1, colored)
+            return
         # Bresenham algorithm
         dx = abs(x1 - x0)
         sx = 1 if x0 < x1 else -1
         dy = -abs(y1 - y0)
         sy = 1 if y0 < y1 else -1
         err = dx + dy
-        while (x0 != x1) and (y0 != y1):
-            self.set_pixel(frame_buffer, x0, y0, colored)
+        points = [(x0, y0)]
+        while (x0 != x1) or (y0 != y1):
             if 2 * err >= dy:
                 err += dy
                 x0 += sx
             if 2 * err <= dx:
                 err += dx
                 y0 += sy
+            points.append((x0, y0))
+        self.set_points(frame_buffer, points, colored)
 
     def draw_horizontal_line(self, frame_buffer, x, y, width, colored):
-        for i in range(x, x + width):
-            self.set_pixel(frame_buffer, i, y, colored)
+        if width > 0:
+            self.fill_rectangle(frame_buffer, x, y, x + width - 1, y, colored)
 
     def draw_vertical_line(self, frame_buffer, x, y, height, colored):
-        for i in range(y, y + height):
-            self.set_pixel(frame_buffer, x, i, colored)
+        if height > 0:
+            self.fill_rectangle(frame_buffer, x, y, x, y + height - 1, colored)
 
     def draw_rectangle(self, frame_buffer, x0, y0, x1, y1, colored):
         min_x = x0 if x1 > x0 else x1
@@ -276,27 +377,18 @@ class WaveshareColorDraw(WaveshareColor):
         self.draw_vertical_line(frame_buffer, max_x, min_y, max_y - min_y + 1, colored)
 
     def draw_filled_rectangle(self, frame_buffer, x0, y0, x1, y1, colored):
-        min_x = x0 if x1 > x0 else x1
-        max_x = x1 if x1 > x0 else x0
-        min_y = y0 if y1 > y0 else y1
-        max_y = y1 if y1 > y0 else y0
-        for i in range(min_x, max_x + 1):
-            self.draw_vertical_line(frame_buffer, i, min_y, max_y - min_y + 1, colored)
+        self.fill_rectangle(frame_buffer, x0, y0, x1, y1, colored)
 
     def draw_filled_circle(self, frame_buffer, x, y, radius, colored):
-        # Bresenham algorithm
+        # Bresenham algorithm, filling the span of each row
         x_pos = -radius
         y_pos = 0
         err = 2 - 2 * radius
         if x >= self.width or y >= self.height:
             return
         while True:
-            self.set_pixel(frame_buffer, x - x_pos, y + y_pos, colored)
-            self.set_pixel(frame_buffer, x + x_pos, y + y_pos, colored)
-            self.set_pixel(frame_buffer, x + x_pos, y - y_pos, colored)
-            self.set_pixel(frame_buffer, x - x_pos, y - y_pos, colored)
-            self.draw_horizontal_line(frame_buffer, x + x_pos, y + y_pos, 2 * (-x_pos) + 1, colored)
-            self.draw_horizontal_line(frame_buffer, x + x_pos, y - y_pos, 2 * (-x_pos) + 1, colored)
+            self.fill_rectangle(frame_buffer, x + x_pos, y + y_pos, x - x_pos, y + y_pos, colored)
+            self.fill_rectangle(frame_buffer, x + x_pos, y - y_pos, x - x_pos, y - y_pos, colored)
             e2 = err
             if e2 <= y_pos:
                 y_pos += 1
@@ -354,9 +446,6 @@ class EPD1in54b(WaveshareColorDraw):
         self.set_lut_red()
         return 0
 
-    def get_frame_buffer(self, image, reverse=True):
-        super().get_frame_buffer(image, reverse=reverse)
-
     def display_frame(self, frame_buffer_black, *args):
         frame_buffer_red = args[0] if args else None
         if frame_buffer_black:
@@ -430,9 +519,6 @@ class EPD1in54c(WaveshareColorDraw):
         self.set_lut_red()
         return 0
 
-    def get_frame_buffer(self, image, reverse=True):
-        super().get_frame_buffer(image, reverse=reverse)
-
 
 class EPD2in13b(WaveshareColorDraw):
     """Waveshare 2.13" B - black / white / red"""
@@ -472,9 +558,6 @@ class EPD2in13b(WaveshareColorDraw):
         self.send_data(0x00)
         self.send_data(0xD4)
 
-    def get_frame_buffer(self, image, reverse=True):
-        super().get_frame_buffer(image, reverse=reverse)
-
     def sleep(self, sleepbyte=0x37):
         super().sleep(sleepbyte=sleepbyte)
 
@@ -548,6 +631,10 @@ class EPD2in7b(WaveshareColorDraw):
         0x00, 0x23, 0x00, 0x00, 0x00, 0x01
     ]
 
+    # unlike the others, this one takes set bits for colored pixels (see set_absolute_pixel)
+    black_bit = 1
+    red_bit = 1
+
     def __init__(self):
         super().__init__(name='2.7" B', width=176, height=264)
 
@@ -635,9 +722,6 @@ class EPD2in7b(WaveshareColorDraw):
         for count in range(0, 42):
             self.send_data(self.lut_wb[count])
 
-    def get_frame_buffer(self, image, reverse=True):
-        super().get_frame_buffer(image, reverse=reverse)
-
     def display_frame(self, frame_buffer_black, *args):
         frame_buffer_red = args[0] if args else None
         self.send_command(self.TCON_RESOLUTION)
@@ -662,9 +746,6 @@ class EPD2in7b(WaveshareColorDraw):
         self.send_command(self.DISPLAY_REFRESH)
         self.wait_until_idle()
 
-    def set_absolute_pixel(self, frame_buffer, x, y, colored, reverse=True):
-        super().set_absolute_pixel(frame_buffer, x, y, colored, reverse=reverse)
-
     # After this command is transmitted, the chip would enter the deep-sleep
     # mode to save power. The deep sleep mode would return to standby by
     # hardware reset. The only one parameter is a check code, the command would
@@ -709,8 +790,5 @@ class EPD2in9b(WaveshareColorDraw):
         self.send_command(self.VCM_DC_SETTING)
         self.send_data(0x0A)
 
-    def get_frame_buffer(self, image, reverse=True):
-        super().get_frame_buffer(image, reverse=reverse)
-
     def sleep(self, sleepbyte=0x37):
         super().sleep(sleepbyte=sleepbyte)
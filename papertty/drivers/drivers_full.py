@@ -16,6 +16,8 @@
 
 from abc import abstractmethod
 
+from PIL import Image
+
 from papertty.drivers.drivers_base import WaveshareEPD
 
 
@@ -55,8 +57,7 @@ class WaveshareFull(WaveshareEPD):
         self.supports_multi_draw = False
 
     def wait_until_idle(self):
-        while self.digital_read(self.BUSY_PIN) == 0:  # 0: busy, 1: idle
-            self.delay_ms(100)
+        self.digital_wait(self.BUSY_PIN, 1)  # 0: busy, 1: idle
 
     @abstractmethod
     def display_frame(self, frame_buffer, *args):
@@ -73,29 +74,16 @@ class WaveshareFull(WaveshareEPD):
 
     def draw(self, x, y, image):
         """Display an image - this module does not support partial refresh: x, y are ignored"""
+        if self.shadow and not self.shadow.draw(x, y, image):
+            return
         self.display_frame(self.get_frame_buffer(image))
 
     def get_frame_buffer(self, image, reverse=False):
-        buf = [0xFF if reverse else 0x00] * int(self.width * self.height / 8)
-        # Set buffer to value of Python Imaging Library image.
-        # Image must be in mode 1.
-        image_monocolor = image.convert('1')
-        imwidth, imheight = image_monocolor.size
+        imwidth, imheight = image.size
         if imwidth != self.width or imheight != self.height:
             raise ValueError('Image must be same dimensions as display: required ({0}x{1}), got ({2}x{3})'
                              .format(self.width, self.height, imwidth, imheight))
-
-        pixels = image_monocolor.load()
-        for y in range(self.height):
-            for x in range(self.width):
-                # Set the bits for the column of pixels at the current position.
-                if reverse:
-                    if pixels[x, y] == 0:
-                        buf[int((x + y * self.width) / 8)] &= ~(0x80 >> (x % 8))
-                else:
-                    if pixels[x, y] != 0:
-                        buf[int((x + y * self.width) / 8)] |= (0x80 >> (x % 8))
-        return buf
+        return self.pack_frame_buffer(image, reverse=reverse)
 
 
 class EPD2in7(WaveshareFull):
@@ -234,6 +222,7 @@ class EPD2in7(WaveshareFull):
         self.delay_ms(2)
         self.set_lut()
         # EPD hardware init end
+        self.enable_shadow()
         return 0
 
     def set_lut(self):
@@ -255,15 +244,14 @@ class EPD2in7(WaveshareFull):
 
     def display_frame(self, frame_buffer, *args):
         if frame_buffer:
+            size = int(self.width * self.height / 8)
             self.send_command(self.DATA_START_TRANSMISSION_1)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(0xFF)
+            self.send_data_multi(b'\xff' * size)
             self.delay_ms(2)
             self.send_command(self.DATA_START_TRANSMISSION_2)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(frame_buffer[i])
+            self.send_data_multi(frame_buffer[:size])
             self.delay_ms(2)
             self.send_command(self.DISPLAY_REFRESH)
             self.wait_until_idle()
@@ -335,8 +323,7 @@ class EPD3in7(WaveshareFull):
     ]
 
     def wait_until_idle(self):
-        while self.digital_read(self.BUSY_PIN) == 1:      #  0: idle, 1: busy
-            self.delay_ms(10)
+        self.digital_wait(self.BUSY_PIN, 0)      #  0: idle, 1: busy
 
     def init(self, **kwargs):
         if self.epd_init() != 0:
@@ -393,6 +380,7 @@ class EPD3in7(WaveshareFull):
         self.send_command(0x22) # Display Update Control 2
         self.send_data(0xCF)
         self.load_lut(self.lut_1Gray_A2)
+        self.enable_shadow()
         return 0
 
     def load_lut(self, lut):
@@ -414,7 +402,9 @@ class EPD3in7(WaveshareFull):
 
     def draw(self, x, y, image):
         """Display an image - this module does not support partial refresh: x, y are ignored"""
-        frame_buffer = self.pack_image(image)
+        if self.shadow and not self.shadow.draw(x, y, image):
+            return
+        frame_buffer = self.pack_frame_buffer(image)
         self.display_frame(frame_buffer, x, y)
 
     def display_partial(self, frame_buffer, x_start, y_start, x_end, y_end):
@@ -462,46 +452,6 @@ class EPD3in7(WaveshareFull):
         self.send_command(0x20)
         self.wait_until_idle()
 
-    def pack_image(self, image):
-        """Packs a PIL image for transfer over SPI to the driver board."""
-
-        #Load image into a frame buffer
-        frame_buffer = list(image.getdata())
-
-        #Step is the number of input bytes (bytes from the image) we
-        #can pack into a single byte of the output bytes (packed buffer).
-        #This is currently hard-coded to 8, because only 1bpp mode is supported.
-        step = 8
-
-        #Set the size of packed_buffer to be the length of the
-        #frame buffer (total input bytes) divided by a step
-        #(input bytes needed per packed byte).
-        packed_buffer = [0x00] * (len(frame_buffer) // step)
-
-        #Step through the frame buffer and pack its bytes
-        #into packed_buffer.
-        for i in range(0, len(frame_buffer), step):
-            self.pack_1bpp(packed_buffer, i // step, frame_buffer[i:i+step])
-
-        return packed_buffer
-
-    def pack_1bpp(self, packed_buffer, i, eightBytes):
-        """Pack an image in 1bpp format.
-
-        This only works for black and white images.
-        This code would look nicer with a loop, but using bitwise operators
-        like this is significantly faster. So the ugly code stays ;)
-        """
-        packed_buffer[i] = \
-            (128 if eightBytes[0] else 0) | \
-            (64 if eightBytes[1] else 0) | \
-            (32 if eightBytes[2] else 0) | \
-            (16 if eightBytes[3] else 0) | \
-            (8 if eightBytes[4] else 0) | \
-            (4 if eightBytes[5] else 0) | \
-            (2 if eightBytes[6] else 0) | \
-            (1 if eightBytes[7] else 0)
-
     def sleep(self):
         self.send_command(0X50) # DEEP_SLEEP_MODE
         self.send_data(0xf7)
@@ -585,27 +535,21 @@ class EPD7in5(WaveshareFull):
 
         self.send_command(0xe5)  # FLASH MODE
         self.send_data(0x03)
+        self.enable_shadow()
+
+    # 1 bpp frame buffer pixels (0 = black, 255 = white once unpacked) to 4 bpp pixels (0x0 / 0x3)
+    EXPAND_4BPP = bytes([0x03 if i else 0x00 for i in range(256)])
+
+    def expand_frame_buffer(self, frame_buffer):
+        """The controller takes 4 bits per pixel, so expand each bit of the frame buffer
+        to a nibble: 0x3 for white and 0x0 for black, 2 pixels per byte"""
+        pixels = Image.frombytes('1', (self.width, self.height), bytes(frame_buffer)).convert('L')
+        data = pixels.tobytes().translate(self.EXPAND_4BPP)
+        return Image.frombytes('P', (len(data), 1), data).tobytes('raw', 'P;4')
 
     def display_frame(self, frame_buffer, *args):
         self.send_command(self.DATA_START_TRANSMISSION_1)
-        for i in range(0, 30720):
-            temp1 = frame_buffer[i]
-            j = 0
-            while j < 8:
-                if temp1 & 0x80:
-                    temp2 = 0x03
-                else:
-                    temp2 = 0x00
-                temp2 = (temp2 << 4) & 0xFF
-                temp1 = (temp1 << 1) & 0xFF
-                j += 1
-                if temp1 & 0x80:
-                    temp2 |= 0x03
-                else:
-                    temp2 |= 0x00
-                temp1 = (temp1 << 1) & 0xFF
-                self.send_data(temp2)
-                j += 1
+        self.send_data_multi(self.expand_frame_buffer(frame_buffer))
         self.send_command(self.DISPLAY_REFRESH)
         self.delay_ms(100)
         self.wait_until_idle()
@@ -660,20 +604,24 @@ class EPD7in5v2(WaveshareFull):
 
         self.send_command(self.TCON_SETTING)
         self.send_data(0x22)
+        self.enable_shadow()
 
         print('Init finished.')
 
+    def get_frame_buffer(self, image, reverse=True):
+        """The controller takes 1 for black, so the frame buffer is inverted"""
+        return super().get_frame_buffer(image, reverse=reverse)
+
     def display_frame(self, frame_buffer, *args):
         if frame_buffer:
+            size = int(self.width * self.height / 8)
             self.send_command(self.DATA_START_TRANSMISSION_1)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(0xFF)
+            self.send_data_multi(b'\xff' * size)
             self.delay_ms(2)
             self.send_command(self.DATA_START_TRANSMISSION_2)
             self.delay_ms(2)
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(~frame_buffer[i])
+            self.send_data_multi(frame_buffer[:size])
             self.delay_ms(2)
 
             self.send_command(self.DISPLAY_REFRESH)
@@ -725,6 +673,5 @@ class EPD7in5v2(WaveshareFull):
         https://github.com/waveshare/e-Paper/blob/702def06bcb75983c98b0f9d25d43c552c248eb0/RaspberryPi%26JetsonNano/python/lib/waveshare_epd/epd7in5_V2.py#L68-L75
         """
         self.send_command(0x71)
-        while self.digital_read(self.BUSY_PIN) == 0:  # 0: busy, 1: idle
-            self.delay_ms(20)
+        while not self.digital_wait(self.BUSY_PIN, 1, timeout=0.02):  # 0: busy, 1: idle
             self.send_command(0x71)
@@ -14,6 +14,8 @@
 #     You should have received a copy of the GNU General Public License
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from papertty.drivers.drivers_base import WaveshareEPD
+from PIL import Image
+
 from papertty.drivers.drivers_base import GPIO
 
 
@@ -89,11 +91,11 @@ class WavesharePartial(WaveshareEPD):
         self.send_data(0x03)  # X increment Y increment
         self.set_lut(self.lut)
         # EPD hardware init end
+        self.enable_shadow()
         return 0
 
     def wait_until_idle(self):
-        while self.digital_read(self.BUSY_PIN) == 1:  # 0: idle, 1: busy
-            self.delay_ms(100)
+        self.digital_wait(self.BUSY_PIN, 0)  # 0: idle, 1: busy
 
     def set_lut(self, lut):
         self.lut = lut
@@ -103,22 +105,11 @@ class WavesharePartial(WaveshareEPD):
             self.send_data(self.lut[i])
 
     def get_frame_buffer(self, image):
-        buf = [0x00] * int(self.width * self.height / 8)
-        # Set buffer to value of Python Imaging Library image.
-        # Image must be in mode 1.
-        image_monocolor = image.convert('1')
-        imwidth, imheight = image_monocolor.size
+        imwidth, imheight = image.size
         if imwidth != self.width or imheight != self.height:
             raise ValueError('Image must be same dimensions as display \
                 ({0}x{1}).'.format(self.width, self.height))
-
-        pixels = image_monocolor.load()
-        for y in range(self.height):
-            for x in range(self.width):
-                # Set the bits for the column of pixels at the current position.
-                if pixels[x, y] != 0:
-                    buf[int((x + y * self.width) / 8)] |= 0x80 >> (x % 8)
-        return buf
+        return self.pack_frame_buffer(image)
 
     # this differs with 2.13" but is the same for 1.54" and 2.9"
     def set_frame_memory(self, image, x, y):
@@ -194,6 +185,11 @@ class WavesharePartial(WaveshareEPD):
 
     def draw(self, x, y, image):
         """Replace a particular area on the display with an image"""
+        if self.shadow:
+            region = self.shadow.draw(x, y, image)
+            if not region:
+                return
+            x, y, image = region
         self.set_frame_memory(image, x, y)
         self.display_frame()
         if self.partial_refresh:
@@ -427,9 +423,8 @@ class EPD2in13d(WavesharePartial):
 
     def wait_until_idle(self):
         """This particular model's code sends the GET_STATUS command while waiting - dunno why."""
-        while self.digital_read(self.BUSY_PIN) == 0:  # 0: idle, 1: busy
+        while not self.digital_wait(self.BUSY_PIN, 1, timeout=0.1):  # 0: busy, 1: idle
             self.send_command(self.GET_STATUS)
-            self.delay_ms(100)
 
     def init(self, **kwargs):
         if self.epd_init() != 0:
@@ -631,8 +626,7 @@ class EPD2in13v4(WavesharePartial):
         self.digital_write(self.CS_PIN, GPIO.HIGH)
     
     def wait_until_idle(self):
-        while self.digital_read(self.BUSY_PIN) == 1:  # 0: idle, 1: busy
-            self.delay_ms(10)
+        self.digital_wait(self.BUSY_PIN, 0)  # 0: idle, 1: busy
 
     def turn_on_display(self):
         self.send_command(self.DISPLAY_UPDATE_CONTROL_2)
@@ -672,7 +666,7 @@ class EPD2in13v4(WavesharePartial):
         self.send_command(self.SET_RAM_X_ADDRESS_COUNTER)
 
         # x point must be the multiple of 8 or the last 3 bits will be ignored
-        self.send_data(x & 0xFF)
+        self.send_data((x >> 3) & 0xFF)
         
         self.send_command(self.SET_RAM_Y_ADDRESS_COUNTER)
         self.send_data_multi([
@@ -763,7 +757,10 @@ class EPD2in13v4(WavesharePartial):
         self.send_data_multi(frame_buffer) 
         self.turn_on_display_fast()
 
-    def display_partial(self, frame_buffer, x_start, y_start, x_end, y_end):
+    def display_partial(self, frame_buffer, x_start, y_start, x_end, y_end, old_buffer=None):
+        """Write frame_buffer to the window from (x_start, y_start) to (x_end, y_end)
+        (x on byte boundaries) and refresh it. With old_buffer, the window of the
+        base image that the refresh compares against is written too."""
         self.digital_write(self.RST_PIN, GPIO.LOW)
         self.delay_ms(1)
         self.digital_write(self.RST_PIN, GPIO.HIGH)
@@ -777,24 +774,25 @@ class EPD2in13v4(WavesharePartial):
         self.send_command(0x11) # data entry mode
         self.send_data(0x03)
 
-        # Currently, `draw` always sets the start values to 0, and the
-        # end values to the panel's full size.
-        # This matches the waveshare docs/examples, but I suspect that
-        # it's wrong.
-        # After all, if it's always full-screen, how is the panel supposed
-        # to know which part of the display has changed for partial refresh?
-        #
-        # So what's currently in place works and matches the docs, and
-        # attempts to do it differently all failed.
-        # But I'm guessing there's a better way to do this.
-        # So if you want to make this panel's partial refresh faster, I'm
-        # thinking this might be part of the equation.
+        # The RAM window limits the writes below to the area that changed,
+        # like EPD3in7 does. Both RAMs are written so that the panel compares
+        # the new data in 0x24 against what it is actually showing.
         self.set_memory_area(x_start, y_start, x_end - 1, y_end - 1)
+
+        if old_buffer is not None:
+            self.set_memory_pointer(x_start, y_start)
+            self.send_command(0x26)
+            self.send_data_multi(old_buffer)
+
         self.set_memory_pointer(x_start, y_start)
-        
         self.send_command(self.WRITE_RAM)
         self.send_data_multi(frame_buffer)
 
+        # back to the full screen, which clear(), display_full() and
+        # displayPartBaseImage() write to
+        self.set_memory_area(0, 0, self.width - 1, self.height - 1)
+        self.set_memory_pointer(0, 0)
+
         self.turn_on_display_part()
 
     def displayPartBaseImage(self, frame_buffer):
@@ -812,8 +810,10 @@ class EPD2in13v4(WavesharePartial):
     
     def clear(self):
         self.send_command(self.WRITE_RAM)
-        self.send_data_multi([0xFF] * int(self.height * self.width//8))
+        self.send_data_multi(b'\xff' * int(self.height * self.width//8))
         self.turn_on_display()
+        # start over with a new base image on the next draw
+        self.cached_buffer = None
 
     def get_frame_buffer(self, image):
         # Convert the image to a byte array.
@@ -822,41 +822,72 @@ class EPD2in13v4(WavesharePartial):
         # If you try to use it with a grayscale image, it may not work.
         return bytearray(image.tobytes('raw'))
 
+    def update_cached_buffer(self, x, y, image):
+        """Copy the image into cached_buffer at (x, y)
+        Returns the old and new contents of the area that changed, widened to
+        whole bytes, and the area as (x_start, y_start, x_end, y_end) - or None"""
+
+        width = self.width // 8
+        x_start = x // 8
+        x_end = min((x + image.width + 7) // 8, width)
+        y_end = min(y + image.height, self.height)
+        rowbytes = x_end - x_start
+        if rowbytes <= 0 or y_end <= y:
+            return None
+
+        view = memoryview(self.cached_buffer)
+        rows = range(y * width + x_start, y_end * width, width)
+        if x % 8 == 0 and x_end * 8 == x + image.width and y_end == y + image.height:
+            packed = self.get_frame_buffer(image.convert('1'))
+        else:
+            # the buffer can only be updated a byte at a time, so paste the
+            # image onto the current contents of the bytes it covers
+            region = Image.frombytes('1', (rowbytes * 8, y_end - y),
+                                     b''.join(view[i:i + rowbytes] for i in rows))
+            region.paste(image.convert('1'), (x - x_start * 8, 0))
+            packed = self.get_frame_buffer(region)
+        packed = memoryview(packed)
+
+        # find the rows that changed, and collect their changed bits to find
+        # the first and last changed byte
+        changed = 0
+        first = last = None
+        for j, i in enumerate(rows):
+            new = packed[j * rowbytes:(j + 1) * rowbytes]
+            if new != view[i:i + rowbytes]:
+                changed |= int.from_bytes(new, 'big') ^ int.from_bytes(view[i:i + rowbytes], 'big')
+                if first is None:
+                    first = j
+                last = j
+        if first is None:
+            return None
+        left = rowbytes - (changed.bit_length() + 7) // 8
+        right = rowbytes - ((changed & -changed).bit_length() - 1) // 8
+
+        window = range((y + first) * width + x_start + left, (y + last + 1) * width, width)
+        size = right - left
+        old = b''.join(view[i:i + size] for i in window)
+        for j in range(first, last + 1):
+            view[rows[j]:rows[j] + rowbytes] = packed[j * rowbytes:(j + 1) * rowbytes]
+        new = b''.join(view[i:i + size] for i in window)
+        return old, new, ((x_start + left) * 8, y + first, (x_start + right) * 8, y + last + 1)
+
     def draw(self, x, y, image):
         """Replace a particular area on the display with an image"""
 
         # Partial refresh works a bit differently for this panel.
-        # In spite of being a partial refresh, the image still needs
-        # to be a full-screen image, and we still need to send all of
-        # the bytes across to the panel.
-        # So in terms of data transmission, it's no faster than a full refresh.
+        # It relies on the base image written to 0x26 via
+        # displayPartBaseImage, which the panel compares the new data in
+        # 0x24 against.
         #
-        # However, the refresh itself is much faster, and it relies on
-        # the data written to 0x26 via displayPartBaseImage in order to
-        # work properly.
-        #
-        # I'm sure there's some way to improve this, but after much
-        # experimenting this is the best I've got right now.
-
-
-        # First off, check if we have already written an image before.
-        # If not, build a buffer (self.cached_buffer) in memory.
-        # We do this for 2 reasons.
-        #
-        # First, because this panel requires a full-screen image each time.
+        # So keep a buffer (self.cached_buffer) of the whole screen in memory.
         # PaperTTY will send images which aren't the exact dimensions
         # of this screen, even if partial is turned off, due to banding.
-        # So building a full-screen image here for the initial buffer works
-        # around that, and also means the code works with partial refreshes.
-        #
-        # Second, for speed.
-        # By reusing the buffer from the previous frame we can just overwrite
-        # the parts which have changed.
-        # eg. If the buffer is 128x250, and we get a new draw for an image which
-        # is 64x64, then we can reuse most of the already processed image and only
-        # replace that small bit which changed.
+        # The buffer is needed for the full-screen image of a full refresh,
+        # and it tells which bytes a partial refresh actually changes - only
+        # that window is sent to the panel.
         if self.cached_buffer is None:
-            self.cached_buffer = [0xFF] * int(self.height * self.width//8)
+            self.cached_buffer = bytearray(b'\xff' * int(self.height * self.width//8))
 
             # If partial refresh is enabled, write the initial image to the
             # appropriate register.
@@ -865,26 +896,11 @@ class EPD2in13v4(WavesharePartial):
             if self.partial_refresh:
                 self.displayPartBaseImage(self.cached_buffer)
 
-        # Now build the new buffer.
-        # We do this by converting the image to a byte array, then replacing
-        # the bytes in the cache with the bytes from the new array in the
-        # appropriate positions.
-        # This isn't as "pretty" as pasting the image over the old one and
-        # converting the whole thing, but it is more efficient.
-        new_buffer = self.get_frame_buffer(image)
-        width = image.width
-        width_bytes = width // 8
-        panel_width_bytes = self.width // 8
-        height = image.height
-        for h in range(0, height):
-            src_start = h * width_bytes
-            src_end = src_start + width_bytes
-            dst_start = (y+h) * panel_width_bytes + (x // 8)
-            dst_end = dst_start + width_bytes
-            self.cached_buffer[dst_start:dst_end] = new_buffer[src_start:src_end]
-
-        # Finally, draw the image.
+        # Copy the image into the buffer, and draw it.
+        changed = self.update_cached_buffer(x, y, image)
         if self.partial_refresh:
-            self.display_partial(self.cached_buffer, 0, 0, self.width, self.height)
+            if changed:
+                old, new, (x_start, y_start, x_end, y_end) = changed
+                self.display_partial(new, x_start, y_start, x_end, y_end, old_buffer=old)
         else:
             self.display_full(self.cached_buffer)
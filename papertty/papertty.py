@@ -22,33 +22,851 @@ import papertty.drivers.drivers_4in2 as driver_4in2
 
 # for ioctl
 import fcntl
+# for mapping the framebuffer device
+import mmap
 # for validating type of and access to device files
 import os
 # for gracefully handling signals (systemd service)
 import signal
-# for unpacking virtual console data
+# for packing the TTY size
 import struct
 # for stdin and exit
 import sys
+# for waiting on virtual console changes
 import select
+# for checking the kernel version
+import re
 # for setting TTY size
 import termios
 # for sleeping
 import time
+# for scaling frames
+import math
+# for merging dirty regions
+import heapq
 # for command line usage
 import click
 # for drawing
 from PIL import Image, ImageChops, ImageDraw, ImageFont, ImageOps
 # for tidy driver list
 from collections import OrderedDict
+# for drawing in a separate thread
+import atexit
+import queue
+import threading
 # for VNC
 from vncdotool import api
 # for reading stdin data for use with Pillow
 from io import BytesIO
+# Optional dependency - speeds up comparing fb and VNC frames
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # resource path
 RESOURCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources")
 
+
+class GlyphAtlas:
+    """A cache of pre-rasterized glyphs, used to build lines of text by pasting
+    each character's 1-bit tile into place instead of having the font rasterize
+    every changed line again on each refresh.
+
+    Tiles are keyed by (font file, size, character, fill) and the least recently
+    used ones are evicted once max_glyphs is reached, so large Unicode sets don't
+    grow the cache without bounds."""
+
+    def __init__(self, font, fontfile, fontsize, font_width, font_height, max_glyphs=4096):
+        self.font = font
+        self.fontfile = fontfile
+        self.fontsize = fontsize
+        self.font_width = font_width
+        self.font_height = font_height
+        self.max_glyphs = max_glyphs
+        self.glyphs = OrderedDict()
+
+    def clear(self):
+        """Forget all the cached glyphs"""
+        self.glyphs.clear()
+
+    def rasterize(self, char, fill):
+        """Render a single character and return (advance, tile, offset_x, offset_y).
+           The tile is a mask of the glyph's ink cropped to its bounding box, or None
+           for blank glyphs such as spaces."""
+        # the size of a single character includes any overhang, the distance
+        # between two consecutive ones doesn't
+        advance = self.font.getsize(char * 2)[0] - self.font.getsize(char)[0]
+        # leave room around the glyph for anything that hangs outside its cell
+        margin_x, margin_y = self.font_width, self.font_height
+        canvas = Image.new('1', (advance + 2 * margin_x, 3 * self.font_height), 0)
+        ImageDraw.Draw(canvas).text((margin_x, margin_y), char, font=self.font, fill=255)
+        bbox = canvas.getbbox()
+        if not bbox:
+            return advance, None, 0, 0
+        return advance, canvas.crop(bbox), bbox[0] - margin_x, bbox[1] - margin_y
+
+    def get(self, char, fill):
+        """Return the cached glyph for a character, rasterizing it if needed"""
+        key = (self.fontfile, self.fontsize, char, fill)
+        glyph = self.glyphs.get(key)
+        if glyph is None:
+            glyph = self.rasterize(char, fill)
+            self.glyphs[key] = glyph
+            if len(self.glyphs) > self.max_glyphs:
+                self.glyphs.popitem(last=False)
+        else:
+            self.glyphs.move_to_end(key)
+        return glyph
+
+    def draw_text(self, image, xy, text, fill):
+        """Draw a line of text onto an image by pasting glyph tiles into place.
+           Returns False without drawing anything if a character isn't exactly one
+           cell wide (proportional fonts, combining characters...), in which case
+           the caller should let the font draw the line instead."""
+        glyphs = [self.get(char, fill) for char in text]
+        if any(glyph[0] != self.font_width for glyph in glyphs):
+            return False
+        x, y = xy
+        for advance, tile, offset_x, offset_y in glyphs:
+            if tile:
+                image.paste(fill, (x + offset_x, y + offset_y), tile)
+            x += advance
+        return True
+
+
+class ConsoleWatcher:
+    """Waits for a virtual console (/dev/vcsa*) to change.
+
+    On kernels that support it (4.14 and later) the vcsa device is polled for
+    POLLPRI, which the kernel raises whenever the console content or cursor is
+    updated, so nothing runs while the console is idle. Otherwise the console
+    is checked every `interval` seconds, backing off up to `max_interval`
+    seconds for as long as nothing changes."""
+
+    def __init__(self, vcsa, interval, max_interval=1.0):
+        self.interval = float(interval)
+        self.max_interval = max(float(max_interval), self.interval)
+        self.delay = self.interval
+        self.fd = os.open(vcsa, os.O_RDONLY)
+        # signal handlers use this pipe to interrupt a wait
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        os.set_blocking(self.wakeup_read, False)
+        os.set_blocking(self.wakeup_write, False)
+        self.poller = select.poll()
+        self.poller.register(self.wakeup_read, select.POLLIN)
+        self.event_driven = self.kernel_supports_poll()
+        if self.event_driven:
+            self.poller.register(self.fd, select.POLLPRI)
+
+    @staticmethod
+    def kernel_supports_poll():
+        """Check if the kernel notifies about changes to vcs devices (added in Linux 4.14)"""
+        match = re.match(r'(\d+)\.(\d+)', os.uname().release)
+        return bool(match) and tuple(map(int, match.groups())) >= (4, 14)
+
+    def wake(self):
+        """Make wait() return early - safe to call from a signal handler"""
+        try:
+            os.write(self.wakeup_write, b'\0')
+        except BlockingIOError:
+            pass
+
+    def wait(self, changed=False):
+        """Block until the console may have changed or wake() is called.
+           When polling, `changed` tells whether the last check found a change:
+           if so, return right away and reset the delay, otherwise back off."""
+        if self.event_driven:
+            events = self.poller.poll()
+        elif changed:
+            self.delay = self.interval
+            return
+        else:
+            events = self.poller.poll(self.delay * 1000)
+            self.delay = min(self.delay * 2, self.max_interval)
+
+        for fd, event in events:
+            if fd == self.wakeup_read:
+                while True:
+                    try:
+                        os.read(self.wakeup_read, 64)
+                    except BlockingIOError:
+                        break
+            elif event & (select.POLLERR | select.POLLHUP):
+                # the console was deallocated, it won't notify about changes anymore
+                print("Lost change notifications for the console, polling it instead.")
+                self.poller.unregister(self.fd)
+                self.event_driven = False
+
+        if self.event_driven:
+            # reading from the device acknowledges the notification
+            os.pread(self.fd, 4, 0)
+
+
+class ConsoleSnapshot:
+    """Reads the text and cursor position of a virtual console.
+
+    Both devices are kept open and read into a preallocated buffer with preadv,
+    or pread before Python 3.7. A hash of the raw bytes of each row is kept, and
+    rows are only decoded when their hash changes - those rows are listed in `dirty_rows`. Unchanged
+    frames therefore keep the same `text` object."""
+
+    def __init__(self, vcsa, vcsudev, character_width, encoding):
+        self.vcsa = os.open(vcsa, os.O_RDONLY)
+        self.vcsu = os.open(vcsudev, os.O_RDONLY)
+        self.character_width = character_width
+        self.encoding = 'utf_32' if character_width == 4 else encoding
+        self.header = bytearray(4)
+        self.cells = bytearray()
+        self.rows = 0
+        self.cols = 0
+        self.hashes = []
+        self.lines = []
+        self.dirty_rows = []
+        self.text = ''
+        self.previous_text = None
+        self.cursor = None
+
+    @staticmethod
+    def read_into(fd, buffer):
+        """Fill the buffer from the start of the device"""
+        view = memoryview(buffer)
+        offset = 0
+        while offset < len(buffer):
+            if hasattr(os, 'preadv'):
+                count = os.preadv(fd, [view[offset:]], offset)
+            else:
+                # preadv is Python 3.7+, copy out of a pread instead
+                data = os.pread(fd, len(buffer) - offset, offset)
+                count = len(data)
+                view[offset:offset + count] = data
+            if count == 0:
+                break
+            offset += count
+
+    @property
+    def row_size(self):
+        return self.cols * self.character_width
+
+    def row(self, index):
+        """Raw bytes of a row without copying - only valid until the next read()"""
+        return memoryview(self.cells)[index * self.row_size:(index + 1) * self.row_size]
+
+    def decode(self, data):
+        if self.character_width == 4:
+            # work around weird bug
+            data = data.replace(b'\x20\x20\x20\x20', b'\x20\x00\x00\x00')
+        return data.decode(self.encoding, 'replace')
+
+    def read(self):
+        """Take a new snapshot of the console"""
+        self.read_into(self.vcsa, self.header)
+        rows, cols, x, y = self.header
+        if (rows, cols) != (self.rows, self.cols):
+            # console was resized, start over
+            self.rows, self.cols = rows, cols
+            self.cells = bytearray(rows * self.row_size)
+            self.hashes = [None] * rows
+            self.lines = [''] * rows
+        self.read_into(self.vcsu, self.cells)
+
+        # `dirty_rows` is relative to `previous_text`
+        self.previous_text = self.text
+        self.dirty_rows = []
+        for i in range(rows):
+            line = self.row(i).tobytes()
+            row_hash = hash(line)
+            if row_hash != self.hashes[i]:
+                self.hashes[i] = row_hash
+                self.lines[i] = self.decode(line)
+                self.dirty_rows.append(i)
+        if self.dirty_rows:
+            self.text = ''.join([line + '\n' for line in self.lines])
+
+        # find character under cursor (in case using a non-fixed width font)
+        char_under_cursor = self.lines[y][x:x + 1] if y < rows else ''
+        self.cursor = (x, y, char_under_cursor)
+
+
+class DirtyRegionTracker:
+    """Collects the regions drawn while the display is busy, so they can all be
+    drawn in one go once it's ready.
+
+    The regions are aligned the way the driver needs them and overlapping ones
+    are united. If there are still more than the driver can draw in a single
+    refresh, the two regions whose union adds the least unchanged area are
+    merged until there aren't - the same idea as partialdraw_merge_text_blocks,
+    but in two dimensions."""
+
+    def __init__(self, driver, max_regions=8):
+        self.driver = driver
+        self.max_regions = max_regions
+        # newest content of everything added so far, kept between flushes, in
+        # panel coordinates - merged regions are drawn from it
+        self.canvas = None
+        # 255 where the canvas is known to hold what the panel shows
+        self.known = None
+        self.boxes = []
+
+    def add(self, x, y, image):
+        if self.canvas is None:
+            self.canvas = Image.new(image.mode, (self.driver.width, self.driver.height), self.driver.white)
+            self.known = Image.new('L', self.canvas.size, 0)
+        elif self.canvas.mode != image.mode:
+            self.canvas = self.canvas.convert(image.mode)
+        self.canvas.paste(image, (x, y))
+        box = self.clip((x, y, x + image.width, y + image.height))
+        if box[0] < box[2] and box[1] < box[3]:
+            self.known.paste(255, box)
+            self.boxes.append(box)
+
+    def clip(self, box):
+        return (max(box[0], 0), max(box[1], 0), min(box[2], self.driver.width), min(box[3], self.driver.height))
+
+    def is_known(self, box):
+        return self.known.crop(box).getextrema()[0] == 255
+
+    def alignment(self):
+        if self.driver.supports_1bpp and self.driver.enable_1bpp:
+            return self.driver.align_1bpp_width, self.driver.align_1bpp_height
+        return 8, 1
+
+    @staticmethod
+    def union(a, b):
+        return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+    @staticmethod
+    def area(box):
+        return (box[2] - box[0]) * (box[3] - box[1])
+
+    @staticmethod
+    def overlap(a, b):
+        return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+    @staticmethod
+    def gap(a, b):
+        """Unchanged area that uniting the two rectangles would add"""
+        area = DirtyRegionTracker.area
+        return area(DirtyRegionTracker.union(a, b)) - area(a) - area(b)
+
+    @staticmethod
+    def unite_overlapping(boxes):
+        """Replace overlapping rectangles with their union until none overlap
+
+        The rectangles are swept from left to right, and each is only compared
+        with the united ones which still reach it. A union may grow to the left
+        over rectangles which were already passed, so the sweep is repeated
+        until nothing more is united - usually once."""
+        united = True
+        while united:
+            united = False
+            boxes.sort()
+            done, active = [], []
+            for box in boxes:
+                still_active = []
+                for other in active:
+                    (still_active if other[2] > box[0] else done).append(other)
+                active = still_active
+                i = 0
+                while i < len(active):
+                    if DirtyRegionTracker.overlap(active[i], box):
+                        # the union may overlap rectangles which were already checked
+                        box = DirtyRegionTracker.union(box, active.pop(i))
+                        united = True
+                        i = 0
+                    else:
+                        i += 1
+                active.append(box)
+            boxes[:] = done + active
+        return boxes
+
+    def merge(self, boxes, max_regions=None):
+        """Merge the rectangles into at most `max_regions` aligned ones"""
+        xdiv, ydiv = self.alignment()
+        boxes = [PaperTTY.band(box, xdiv=xdiv, ydiv=ydiv) for box in OrderedDict.fromkeys(boxes)]
+        boxes = [self.clip(box) for box in boxes]
+        if max_regions == 1 and boxes:
+            return [(min(box[0] for box in boxes), min(box[1] for box in boxes),
+                     max(box[2] for box in boxes), max(box[3] for box in boxes))]
+        self.unite_overlapping(boxes)
+        if not max_regions or len(boxes) <= max_regions:
+            return boxes
+
+        # Keep the gaps between all pairs of rectangles in a heap, so that the
+        # pair with the smallest one is always at the top. Merged rectangles get
+        # a new id, and the pairs with the ids which are gone are skipped.
+        alive = dict(enumerate(boxes))
+        heap = [(self.gap(boxes[i], boxes[j]), i, j)
+                for i in range(len(boxes) - 1) for j in range(i + 1, len(boxes))]
+        heapq.heapify(heap)
+        next_id = len(boxes)
+        while len(alive) > max_regions:
+            gap, i, j = heapq.heappop(heap)
+            if i not in alive or j not in alive:
+                continue
+            box = self.union(alive.pop(i), alive.pop(j))
+            # unite the rectangles which the union overlaps, too
+            overlapping = [k for k, other in alive.items() if self.overlap(box, other)]
+            while overlapping:
+                for k in overlapping:
+                    box = self.union(box, alive.pop(k))
+                overlapping = [k for k, other in alive.items() if self.overlap(box, other)]
+            for k, other in alive.items():
+                heapq.heappush(heap, (self.gap(other, box), k, next_id))
+            alive[next_id] = box
+            next_id += 1
+
+        return list(alive.values())
+
+    def flush(self):
+        """Draw the collected regions with their newest content"""
+        if not self.boxes:
+            return
+        max_regions = self.max_regions if self.driver.supports_multi_draw else 1
+        boxes = []
+        for region in self.merge(self.boxes, max_regions=max_regions):
+            if self.is_known(region):
+                boxes.append(region)
+            else:
+                # the merged region covers pixels nothing was added for, and
+                # which would be drawn white - draw the boxes in it as they are
+                boxes.extend(box for box in OrderedDict.fromkeys(self.boxes)
+                             if region[0] <= box[0] and region[1] <= box[1]
+                             and box[2] <= region[2] and box[3] <= region[3])
+        if self.driver.supports_multi_draw:
+            self.driver.draw_multi([{"x":box[0], "y":box[1], "image":self.canvas.crop(box)} for box in boxes])
+        else:
+            for box in boxes:
+                self.driver.draw(box[0], box[1], self.canvas.crop(box))
+        self.boxes = []
+
+
+class DrawPipeline:
+    """Wraps a display driver so that its draw calls run in a separate thread.
+
+    The thread calling draw() or draw_multi() only queues the images, so it can
+    prepare the next frame while the display thread transfers the previous one
+    and waits for the panel. The regions of frames which pile up in the queue
+    while the panel is busy are collected in a DirtyRegionTracker and drawn
+    together with the newest content. Any other driver method, and setting a
+    driver attribute, waits for the queue to empty first. Reading an attribute
+    doesn't - those are settings, which only change that way."""
+
+    # attributes of the wrapper itself, the rest are set on the driver
+    own_attributes = ('driver', 'queue', 'regions', 'error', 'thread')
+
+    def __init__(self, driver, maxsize=4):
+        self.driver = driver
+        self.queue = queue.Queue(maxsize)
+        self.regions = DirtyRegionTracker(driver)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='display', daemon=True)
+        self.thread.start()
+        # don't lose queued frames (eg. clearing the display) on exit
+        atexit.register(self.flush)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.driver, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            self.flush()
+            return attribute(*args, **kwargs)
+        return call
+
+    def __setattr__(self, name, value):
+        if name in self.own_attributes:
+            super().__setattr__(name, value)
+        else:
+            self.flush()
+            setattr(self.driver, name, value)
+
+    def draw(self, x, y, image):
+        self.put([(x, y, image)])
+
+    def draw_multi(self, imageArray):
+        self.put([(arr["x"], arr["y"], arr["image"]) for arr in imageArray])
+
+    def put(self, draws):
+        self.check()
+        if draws:
+            self.queue.put(draws)
+
+    def flush(self):
+        """Wait until everything queued has been drawn"""
+        self.queue.join()
+        self.check()
+
+    def check(self):
+        """Re-raise an exception from the display thread"""
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+
+    def run(self):
+        while True:
+            frames = [self.queue.get()]
+            while True:
+                try:
+                    frames.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                for draws in frames:
+                    for x, y, image in draws:
+                        self.regions.add(x, y, image)
+                self.regions.flush()
+            except Exception as e:
+                self.regions.boxes = []
+                self.error = e
+            finally:
+                for _ in frames:
+                    self.queue.task_done()
+
+
+class FrameDiff:
+    """Finds the tiles of a frame which changed since the previous frame.
+
+    Used by showfb and showvnc, which get a whole new frame on each tick. The
+    previous frame is kept (as an array, if NumPy is available) and compared to
+    the new one tile by tile, so separate changes give separate tiles instead
+    of one bounding box around all of them. The default tile size matches the
+    IT8951 1bpp alignment."""
+
+    def __init__(self, tile_size=(32, 16)):
+        self.tile_width, self.tile_height = tile_size
+        self.previous = None
+
+    def tile_box(self, row, col, width, height):
+        left, top = col * self.tile_width, row * self.tile_height
+        return (left, top, min(left + self.tile_width, width), min(top + self.tile_height, height))
+
+    def diff(self, image):
+        """Return the boxes of the changed tiles in row-major order,
+        or None if there's no previous frame of the same size and mode to compare to"""
+        width, height = image.size
+        rows = (height + self.tile_height - 1) // self.tile_height
+        cols = (width + self.tile_width - 1) // self.tile_width
+        if numpy:
+            frame = numpy.asarray(image)
+            previous, self.previous = self.previous, frame
+            if previous is None or previous.shape != frame.shape or previous.dtype != frame.dtype:
+                return None
+            changed = frame != previous
+            if changed.ndim == 3:
+                changed = changed.any(axis=2)
+            changed = numpy.pad(changed, ((0, rows * self.tile_height - height), (0, cols * self.tile_width - width)))
+            grid = changed.reshape(rows, self.tile_height, cols, self.tile_width).any(axis=(1, 3))
+            return [self.tile_box(row, col, width, height) for row, col in zip(*numpy.nonzero(grid))]
+
+        previous, self.previous = self.previous, image.copy()
+        if previous is None or previous.size != image.size or previous.mode != image.mode:
+            return None
+        difference = ImageChops.difference(image, previous)
+        tiles = []
+        for row in range(rows):
+            band = difference.crop((0, row * self.tile_height, width, min((row + 1) * self.tile_height, height)))
+            bbox = band.getbbox()
+            if not bbox:
+                continue
+            for col in range(bbox[0] // self.tile_width, (bbox[2] + self.tile_width - 1) // self.tile_width):
+                box = self.tile_box(0, col, width, band.height)
+                if band.crop(box).getbbox():
+                    tiles.append(self.tile_box(row, col, width, height))
+        return tiles
+
+    @staticmethod
+    def regions(tiles):
+        """Join the runs of adjacent tiles in each row, and then runs of the
+        same width in consecutive rows, into larger rectangles"""
+        runs = []
+        for tile in tiles:
+            last = runs[-1] if runs else None
+            if last and last[1] == tile[1] and last[2] == tile[0]:
+                runs[-1] = (last[0], last[1], tile[2], last[3])
+            else:
+                runs.append(tile)
+        regions = []
+        # index of the region which a run starting at (left, right, top) continues
+        ends = {}
+        for run in runs:
+            i = ends.pop((run[0], run[2], run[1]), None)
+            if i is None:
+                i = len(regions)
+                regions.append(run)
+            else:
+                region = regions[i]
+                regions[i] = (region[0], region[1], region[2], run[3])
+            ends[(run[0], run[2], run[3])] = i
+        return regions
+
+
+class FramebufferSource:
+    """Reads frames from a framebuffer device which is mapped into memory once.
+
+    The mapped memory is compared to a snapshot of the previous frame tile by
+    tile, and only the tiles which changed are copied and converted to
+    grayscale in `image`. Any file laid out like a framebuffer can stand in
+    for the device, eg. when testing."""
+
+    def __init__(self, path, size, bpp, stride=None, tile_size=(32, 16)):
+        self.width, self.height = size
+        self.mode = "BGRX" if bpp == 32 else "BGR;16"
+        self.pixel_size = bpp // 8
+        self.row_size = self.width * self.pixel_size
+        self.stride = stride or self.row_size
+        self.tile_width, self.tile_height = tile_size
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), self.stride * self.height, mmap.MAP_SHARED, mmap.PROT_READ)
+        self.snapshot = None
+        self.image = Image.new("L", size)
+
+    @classmethod
+    def open(cls, fb_num, **kwargs):
+        """Open /dev/fbN with the geometry the kernel reports for it"""
+        config_dir = "/sys/class/graphics/fb%d/" % fb_num
+        with open(config_dir + "virtual_size", "r") as f:
+            size = tuple([int(t) for t in f.read().strip().split(",")])
+        with open(config_dir + "bits_per_pixel", "r") as f:
+            bpp = int(f.read().strip())
+        try:
+            with open(config_dir + "stride", "r") as f:
+                stride = int(f.read().strip())
+        except OSError:
+            stride = None
+        return cls("/dev/fb%d" % fb_num, size, bpp, stride, **kwargs)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def tile_box(self, row, col):
+        left, top = col * self.tile_width, row * self.tile_height
+        return (left, top, min(left + self.tile_width, self.width), min(top + self.tile_height, self.height))
+
+    def read(self):
+        """Update `image` from the framebuffer. Returns the boxes of the tiles which
+        changed, or None for the first frame (when everything is read)."""
+        if numpy:
+            tiles = self.compare_arrays()
+        else:
+            tiles = self.compare_bytes()
+        for box in (FrameDiff.regions(tiles) if tiles is not None else [(0, 0, self.width, self.height)]):
+            self.convert(box)
+        return tiles
+
+    def compare_arrays(self):
+        tile_bytes = self.tile_width * self.pixel_size
+        # compare whole words if the rows and tiles allow it
+        word = 8 if self.stride % 8 == 0 and tile_bytes % 8 == 0 else 1
+        dtype = numpy.uint64 if word == 8 else numpy.uint8
+        frame = numpy.frombuffer(self.map, dtype).reshape(self.height, self.stride // word)
+        if self.snapshot is None:
+            self.snapshot = frame.copy()
+            return None
+        rows = (self.height + self.tile_height - 1) // self.tile_height
+        cols = (self.row_size + tile_bytes - 1) // tile_bytes
+        tile_words = tile_bytes // word
+        changed = frame != self.snapshot
+        changed = numpy.pad(changed, ((0, rows * self.tile_height - self.height), (0, max(0, cols * tile_words - changed.shape[1]))))
+        grid = changed[:, :cols * tile_words].reshape(rows, self.tile_height, cols, tile_words).any(axis=(1, 3))
+        tiles = [self.tile_box(row, col) for row, col in zip(*numpy.nonzero(grid))]
+        for left, top, right, bottom in tiles:
+            start, end = left * self.pixel_size // word, (right * self.pixel_size + word - 1) // word
+            self.snapshot[top:bottom, start:end] = frame[top:bottom, start:end]
+        return tiles
+
+    def compare_bytes(self):
+        if self.snapshot is None:
+            self.snapshot = bytearray(self.map)
+            return None
+        tile_bytes = self.tile_width * self.pixel_size
+        tiles = []
+        for top in range(0, self.height, self.tile_height):
+            start, end = top * self.stride, min(top + self.tile_height, self.height) * self.stride
+            band = self.map[start:end]
+            if band == self.snapshot[start:end]:
+                continue
+            for left in range(0, self.row_size, tile_bytes):
+                rows = range(left, len(band), self.stride)
+                right = min(left + tile_bytes, self.row_size)
+                if any(band[i: i + right - left] != self.snapshot[start + i: start + i + right - left] for i in rows):
+                    tiles.append(self.tile_box(top // self.tile_height, left // tile_bytes))
+            self.snapshot[start:end] = band
+        return tiles
+
+    def convert(self, box):
+        """Convert a region of the snapshot into grayscale in `image`"""
+        left, top, right, bottom = box
+        snapshot = memoryview(self.snapshot).cast("B")
+        start, width = left * self.pixel_size, (right - left) * self.pixel_size
+        data = b"".join(snapshot[row * self.stride + start: row * self.stride + start + width] for row in range(top, bottom))
+        region = Image.frombytes("RGB", (right - left, bottom - top), data, "raw", self.mode)
+        self.image.paste(region.convert("L"), (left, top))
+
+
+class FrameTransform:
+    """Rotates, scales, inverts and optionally dithers fb/VNC frames for the display.
+
+    The geometry is fixed for a session, so the steps are worked out once: the
+    rotation becomes a transpose, invert a lookup table, and the position of
+    each source tile on the display is cached. apply() then only transforms
+    the tiles which changed into the persistent `image`. Rotations other than
+    multiples of 90 degrees transform the whole frame and find the changed
+    tiles afterwards.
+
+    With `dither` set, `image` is 1-bit, so drivers can use their fastest
+    modes (eg. 1bpp and A2 on IT8951). Threshold and ordered (Bayer) dithering
+    depend only on the pixel and its position, so dithering just the changed
+    tiles gives the same result as the whole frame. Floyd-Steinberg diffuses
+    the error within each tile only."""
+
+    TRANSPOSE = {90: Image.ROTATE_90, 180: Image.ROTATE_180, 270: Image.ROTATE_270}
+    DITHERS = ('threshold', 'bayer', 'floyd')
+
+    # 8x8 ordered dithering matrix, levels 0-63
+    BAYER = [[0]]
+    while len(BAYER) < 8:
+        BAYER = [[4 * v for v in row] + [4 * v + 2 for v in row] for row in BAYER] + \
+                [[4 * v + 3 for v in row] + [4 * v + 1 for v in row] for row in BAYER]
+
+    def __init__(self, size, rotate=None, invert=False, dither=None, threshold=128):
+        self.size = size
+        self.rotate = (rotate or 0) % 360
+        self.transpose = self.TRANSPOSE.get(self.rotate)
+        self.table = [255 - v for v in range(256)] if invert else None
+        self.dither = dither
+        self.threshold_table = [0 if v < threshold else 255 for v in range(256)]
+        self.bayer = self.bayer_thresholds(size) if dither == 'bayer' else None
+        self.source_size = None
+        self.image = None
+        self.frames = None
+        self.plans = {}
+
+    @classmethod
+    def bayer_thresholds(cls, size):
+        """An image of the ordered dithering thresholds for each pixel"""
+        levels = bytes(int((v + 0.5) * 4) for row in cls.BAYER for v in row)
+        tile = Image.frombytes('L', (8, 8), levels)
+        row = Image.new('L', (size[0], 8))
+        for x in range(0, size[0], 8):
+            row.paste(tile, (x, 0))
+        thresholds = Image.new('L', size)
+        for y in range(0, size[1], 8):
+            thresholds.paste(row, (0, y))
+        return thresholds
+
+    def quantize(self, image, box):
+        """Turn the part of the frame at `box` into 1-bit"""
+        if image.mode != 'L':
+            image = image.convert('L')
+        if self.dither == 'threshold':
+            return image.point(self.threshold_table, '1')
+        if self.dither == 'bayer':
+            # white where the pixel is lighter than its threshold
+            return ImageChops.subtract(image, self.bayer.crop(box)).point([0] + [255] * 255, '1')
+        return image.convert('1')
+
+    def setup(self, source_size):
+        """Work out the geometry for frames of this size"""
+        self.source_size = source_size
+        self.plans = {}
+        width, height = source_size
+        self.rotated_size = (height, width) if self.rotate in (90, 270) else source_size
+        self.scale = (self.size[0] / self.rotated_size[0], self.size[1] / self.rotated_size[1])
+        # a changed source pixel can affect destination pixels this far away,
+        # going by the support of the bicubic filter
+        self.margin = tuple(int(math.ceil(2 * max(1, 1 / s) * s)) + 1 for s in self.scale)
+        self.rotated = None
+        self.image = None
+        self.frames = FrameDiff() if self.rotate and not self.transpose else None
+
+    def full(self, image):
+        """Transform a whole frame, return it rotated and completely transformed"""
+        if not self.rotate:
+            image = image.copy()
+        elif self.transpose:
+            image = image.transpose(self.transpose)
+        else:
+            image = image.rotate(self.rotate, expand=True)
+        rotated = image
+        if image.size != self.size:
+            image = image.resize(self.size)
+        if self.table:
+            image = image.point(self.table * len(image.getbands()))
+        if self.dither:
+            image = self.quantize(image, (0, 0) + self.size)
+        if image is rotated:
+            image = image.copy()
+        return rotated, image
+
+    def rotate_box(self, box):
+        left, top, right, bottom = box
+        width, height = self.source_size
+        if self.rotate == 90:
+            return (top, width - right, bottom, width - left)
+        if self.rotate == 180:
+            return (width - right, height - bottom, width - left, height - top)
+        if self.rotate == 270:
+            return (height - bottom, left, height - top, right)
+        return box
+
+    def plan(self, box):
+        """Where a source tile goes: its box after rotation and the destination box
+        it affects. Cached per tile, so there are only as many as there are tiles."""
+        if box not in self.plans:
+            rotated = self.rotate_box(box)
+            (sx, sy), (mx, my) = self.scale, self.margin
+            target = (max(0, int(math.floor(rotated[0] * sx)) - mx), max(0, int(math.floor(rotated[1] * sy)) - my),
+                      min(self.size[0], int(math.ceil(rotated[2] * sx)) + mx), min(self.size[1], int(math.ceil(rotated[3] * sy)) + my))
+            self.plans[box] = (rotated, target)
+        return self.plans[box]
+
+    def region_plan(self, first, last):
+        """The plan of a region from those of its top left and bottom right tiles,
+        and the (fractional) region of the rotated frame that is scaled into it"""
+        union = DirtyRegionTracker.union
+        (first_rotated, first_target), (last_rotated, last_target) = self.plan(first), self.plan(last)
+        rotated, target = union(first_rotated, last_rotated), union(first_target, last_target)
+        (sx, sy) = self.scale
+        return rotated, target, (target[0] / sx, target[1] / sy, target[2] / sx, target[3] / sy)
+
+    def apply(self, image, tiles=None):
+        """Transform the changed tiles of a frame into `image`. Returns the boxes of
+        `image` which changed, or None if it was redrawn completely (eg. the first frame)."""
+        if image.size != self.source_size:
+            self.setup(image.size)
+            tiles = None
+        if self.frames:
+            self.rotated, self.image = self.full(image)
+            return self.frames.diff(self.image)
+        if tiles is None or self.image is None:
+            self.rotated, self.image = self.full(image)
+            return None
+        boxes = []
+        firsts = {tile[:2]: tile for tile in tiles}
+        lasts = {tile[2:]: tile for tile in tiles}
+        for box in FrameDiff.regions(tiles):
+            rotated, target, region = self.region_plan(firsts[box[:2]], lasts[box[2:]])
+            if self.transpose:
+                self.rotated.paste(image.crop(box).transpose(self.transpose), rotated[:2])
+            else:
+                self.rotated.paste(image.crop(box), rotated[:2])
+            if self.rotated.size == self.size:
+                target = rotated
+                part = self.rotated.crop(target)
+            else:
+                part = self.rotated.resize((target[2] - target[0], target[3] - target[1]), box=region)
+            if self.table:
+                part = part.point(self.table * len(part.getbands()))
+            if self.dither:
+                part = self.quantize(part, target)
+            self.image.paste(part, target[:2])
+            boxes.append(target)
+        return boxes
+
+
 class PaperTTY:
     """The main class - handles various settings and showing text on the display"""
     defaultfont = os.path.join(RESOURCE_PATH, "tom-thumb.pil")
@@ -70,13 +888,16 @@ class PaperTTY:
     cols = None
     is_truetype = None
     fontfile = None
+    glyphs = None
     enable_a2 = True
     enable_1bpp = True
     mhz = None
 
-    def __init__(self, driver, font=defaultfont, fontsize=defaultsize, partial=None, encoding='utf-8', spacing=0, cursor=None, vcom=None, enable_a2=True, enable_1bpp=True, mhz=None):
+    def __init__(self, driver, font=defaultfont, fontsize=defaultsize, partial=None, encoding='utf-8', spacing=0, cursor=None, vcom=None, enable_a2=True, enable_1bpp=True, mhz=None, spi_chunk_size=None):
         """Create a PaperTTY with the chosen driver and settings"""
         self.driver = get_drivers()[driver]['class']()
+        if spi_chunk_size:
+            self.driver.spi_chunk_size = spi_chunk_size
         self.spacing = spacing
         self.fontsize = fontsize
         self.font = self.load_font(font) if font else None
@@ -144,6 +965,33 @@ class PaperTTY:
         """Return the bounding box of differences between two images"""
         return ImageChops.difference(img1, img2).getbbox()
 
+    def draw_full_refresh(self, image):
+        """Draw a whole mirrored frame for a periodic full refresh. Dithered frames
+        stay 1-bit - so that IT8951 keeps its image memory in the 1bpp layout the
+        tile updates use - and GC16 is asked for, which clears the ghosting the
+        A2 updates leave behind."""
+        gc16 = getattr(self.driver, 'DISPLAY_UPDATE_MODE_GC16', None)
+        if image.mode == '1' and gc16 is not None:
+            self.driver.draw(0, 0, image.copy(), gc16)
+        else:
+            self.driver.draw(0, 0, image.copy())
+
+    # at most this many separate regions are drawn from the tiles of a frame
+    max_tile_regions = 8
+
+    def draw_tiles(self, image, tiles):
+        """Draw the changed tiles of a frame, in as few regions as the driver can draw at once"""
+        regions = DirtyRegionTracker(self.driver)
+        if self.driver.supports_multi_draw:
+            boxes = regions.merge(FrameDiff.regions(tiles), max_regions=self.max_tile_regions)
+            self.driver.draw_multi([{"x": box[0], "y": box[1], "image": image.crop(box)} for box in boxes])
+        else:
+            # a single region is the bounding box of the tiles
+            bbox = (min(tile[0] for tile in tiles), min(tile[1] for tile in tiles),
+                    max(tile[2] for tile in tiles), max(tile[3] for tile in tiles))
+            for box in regions.merge([bbox], max_regions=1):
+                self.driver.draw(box[0], box[1], image.crop(box))
+
     @staticmethod
     def ttydev(vcsa):
         """Return associated tty for vcsa device, ie. /dev/vcsa1 -> /dev/tty1"""
@@ -243,6 +1091,13 @@ class PaperTTY:
             # pil fonts don't seem to have metrics, but all
             # characters seem to have the same height
             self.font_height = font.getsize('a')[1] + self.spacing
+        # the cached glyphs depend on the font and its dimensions, so start over
+        self.glyphs = GlyphAtlas(font, self.fontfile, self.fontsize, self.font_width, self.font_height)
+
+    def draw_text(self, image, draw, xy, text, fill):
+        """Draw a line of text, from the glyph atlas if the font allows it"""
+        if not self.glyphs.draw_text(image, xy, text, fill):
+            draw.text(xy, text, font=self.font, fill=fill, spacing=self.spacing)
 
     def init_display(self):
         """Initialize the display - call the driver's init method"""
@@ -287,73 +1142,52 @@ class PaperTTY:
         draw.rectangle([upper_left, lower_right], fill=self.white)
         return ImageChops.logical_xor(image, mask)
 
-    def showfb(self, fb_num, rotate=None, invert=False, sleep=1, full_interval=100):
+    def showfb(self, fb_num, rotate=None, invert=False, sleep=1, full_interval=100, dither=None, threshold=128):
         """Render the framebuffer - basically a copy-paste of showvnc at this point"""
-        def _get_fb_info(fb_num):
-            config_dir = "/sys/class/graphics/fb%d/" % fb_num
-            size = None
-            bpp = None
-            with open(config_dir + "/virtual_size", "r") as f:
-                size = tuple([int(t) for t in f.read().strip().split(",")])
-            with open(config_dir + "/bits_per_pixel", "r") as f:
-                bpp = int(f.read().strip())
-            return (size,bpp)
-
-        def _get_fb_img(fb_num):
-            size, bpp = _get_fb_info(fb_num)
-            with open("/dev/fb%d" % fb_num, "rb") as f:
-                mode = "BGRX" if bpp == 32 else "BGR;16"
-                return Image.frombytes("RGB", size, f.read(), "raw", mode).convert("L")
-
-        previous_fb_img = None
-        diff_bbox = None
+        source = FramebufferSource.open(fb_num)
+        # rotation, inversion and rescaling, applied to the changed tiles only
+        transform = FrameTransform((self.driver.width, self.driver.height), rotate, invert, dither, threshold)
         # number of updates; when it's 0, do a full refresh
         updates = 0
         while True:
-            new_fb_img = _get_fb_img(fb_num)
-            # apply rotation if any
-            if rotate:
-                new_fb_img = new_fb_img.rotate(rotate, expand=True)
-            # apply invert
-            if invert:
-                new_fb_img = ImageOps.invert(new_fb_img)
-            # rescale image if needed
-            if new_fb_img.size != (self.driver.width, self.driver.height):
-                new_fb_img = new_fb_img.resize((self.driver.width, self.driver.height))
-            # if at least two frames have been processed, get a bounding box of their difference region
-            if new_fb_img and previous_fb_img:
-                diff_bbox = self.band(self.img_diff(new_fb_img, previous_fb_img))
+            # nothing to do if no part of the framebuffer changed
+            tiles = source.read()
+            if tiles == []:
+                time.sleep(float(sleep))
+                continue
+            # if at least two frames have been processed, get the regions which differ
+            tiles = transform.apply(source.image, tiles)
+            new_fb_img = transform.image
             # frames differ, so we should update the display
-            if diff_bbox:
+            if tiles:
                 # increment update counter
                 updates = (updates + 1) % full_interval
                 # if partial update is supported and it's not time for a full refresh,
-                # draw just the different region
+                # draw just the different tiles
                 if updates > 0 and (self.driver.supports_partial and self.partial):
-                    print("partial ({}): {}".format(updates, diff_bbox))
-                    self.driver.draw(diff_bbox[0], diff_bbox[1], new_fb_img.crop(diff_bbox))
+                    print("partial ({}): {} tiles".format(updates, len(tiles)))
+                    self.draw_tiles(new_fb_img, tiles)
                 # if partial update is not possible or desired, do a full refresh
                 else:
                     print("full ({}): {}".format(updates, new_fb_img.size))
                     old_partial = self.partial
                     self.partial = False
-                    self.driver.draw(0, 0, new_fb_img)
+                    self.draw_full_refresh(new_fb_img)
                     self.partial = old_partial
             # otherwise this is the first frame, so run a full refresh to get things going
-            else:
-                if updates == 0:
-                    updates = (updates + 1) % full_interval
-                    print("initial ({}): {}".format(updates, new_fb_img.size))
-                    self.driver.draw(0, 0, new_fb_img)
-            previous_fb_img = new_fb_img.copy()
+            elif tiles is None:
+                updates = 1 % full_interval
+                print("initial ({}): {}".format(updates, new_fb_img.size))
+                self.driver.draw(0, 0, new_fb_img.copy())
             time.sleep(float(sleep))
 
 
 
-    def showvnc(self, host, display, password=None, rotate=None, invert=False, sleep=1, full_interval=100):
+    def showvnc(self, host, display, password=None, rotate=None, invert=False, sleep=1, full_interval=100, dither=None, threshold=128):
         with api.connect(':'.join([host, display]), password=password) as client:
-            previous_vnc_image = None
-            diff_bbox = None
+            frames = FrameDiff()
+            # rotation, inversion and rescaling, applied to the changed tiles only
+            transform = FrameTransform((self.driver.width, self.driver.height), rotate, invert, dither, threshold)
             # number of updates; when it's 0, do a full refresh
             updates = 0
             client.timeout = 30
@@ -364,43 +1198,32 @@ class PaperTTY:
                     print("Timeout to server {}:{}".format(host, display))
                     client.disconnect()
                     sys.exit(1)
-                new_vnc_image = client.screen
-                # apply rotation if any
-                if rotate:
-                    new_vnc_image = new_vnc_image.rotate(rotate, expand=True)
-                # apply invert
-                if invert:
-                    new_vnc_image = ImageOps.invert(new_vnc_image)
-                # rescale image if needed
-                if new_vnc_image.size != (self.driver.width, self.driver.height):
-                    new_vnc_image = new_vnc_image.resize((self.driver.width, self.driver.height))
-                # if at least two frames have been processed, get a bounding box of their difference region
-                if new_vnc_image and previous_vnc_image:
-                    diff_bbox = self.band(self.img_diff(new_vnc_image, previous_vnc_image))
+                # if at least two frames have been processed, get the regions which differ
+                tiles = transform.apply(client.screen, frames.diff(client.screen))
+                new_vnc_image = transform.image
                 # frames differ, so we should update the display
-                if diff_bbox:
+                if tiles:
                     # increment update counter
                     updates = (updates + 1) % full_interval
                     # if partial update is supported and it's not time for a full refresh,
-                    # draw just the different region
+                    # draw just the different tiles
                     if updates > 0 and (self.driver.supports_partial and self.partial):
-                        print("partial ({}): {}".format(updates, diff_bbox))
-                        self.driver.draw(diff_bbox[0], diff_bbox[1], new_vnc_image.crop(diff_bbox))
+                        print("partial ({}): {} tiles".format(updates, len(tiles)))
+                        self.draw_tiles(new_vnc_image, tiles)
                     # if partial update is not possible or desired, do a full refresh
                     else:
                         print("full ({}): {}".format(updates, new_vnc_image.size))
-                        self.driver.draw(0, 0, new_vnc_image)
+                        self.draw_full_refresh(new_vnc_image)
                 # otherwise this is the first frame, so run a full refresh to get things going
-                else:
-                    if updates == 0:
-                        updates = (updates + 1) % full_interval
-                        print("initial ({}): {}".format(updates, new_vnc_image.size))
-                        self.driver.draw(0, 0, new_vnc_image)
-                previous_vnc_image = new_vnc_image.copy()
+                elif tiles is None:
+                    updates = 1 % full_interval
+                    print("initial ({}): {}".format(updates, new_vnc_image.size))
+                    self.driver.draw(0, 0, new_vnc_image.copy())
                 time.sleep(float(sleep))
 
-    def showtext(self, text, fill, cursor=None, portrait=False, flipx=False, flipy=False, oldimage=None, oldtext=None, oldcursor=None):
-        """Draw a string on the screen"""
+    def showtext(self, text, fill, cursor=None, portrait=False, flipx=False, flipy=False, oldimage=None, oldtext=None, oldcursor=None, dirty_rows=None):
+        """Draw a string on the screen.
+           `dirty_rows` optionally lists the rows which may differ from `oldtext`"""
         if self.ready():
             
             #If partial updates are supported, run partialdraw_showtext() instead
@@ -410,7 +1233,7 @@ class PaperTTY:
                 if oldtext is None:
                     oldtext = ""
 
-                return self.partialdraw_showtext(text=text, fill=fill, cursor=cursor, portrait=portrait, flipx=flipx, flipy=flipy, oldimage=oldimage, oldtext=oldtext, oldcursor=oldcursor)
+                return self.partialdraw_showtext(text=text, fill=fill, cursor=cursor, portrait=portrait, flipx=flipx, flipy=flipy, oldimage=oldimage, oldtext=oldtext, oldcursor=oldcursor, dirty_rows=dirty_rows)
 
             # set order of h, w according to orientation
             image = Image.new('1', (self.driver.width, self.driver.height) if portrait else (
@@ -425,7 +1248,7 @@ class PaperTTY:
             for i, line in enumerate(lines):
                 if line:
                     y = i * self.font_height
-                    draw.text((0, y), line, font=self.font, fill=fill, spacing=self.spacing)
+                    self.draw_text(image, draw, (0, y), line, fill)
 
             # if we want a cursor, draw it - the most convoluted part
             if cursor and self.cursor:
@@ -464,7 +1287,7 @@ class PaperTTY:
 
 
 
-    def partialdraw_showtext(self, text, fill, cursor, portrait, flipx, flipy, oldimage, oldtext, oldcursor):
+    def partialdraw_showtext(self, text, fill, cursor, portrait, flipx, flipy, oldimage, oldtext, oldcursor, dirty_rows=None):
 
         """Draw a string on the screen one line at a time.
            This function serves as an alternative to showtext() and aims to be more efficient
@@ -490,8 +1313,8 @@ class PaperTTY:
         driverHeight = self.driver.height if portrait else self.driver.width
         driverWidth = self.driver.width if portrait else self.driver.height
         
-        #First, run through each row and build a list of strings to potentially draw
-        changedLines = self.partialdraw_get_changed_lines(cursor, oldcursor, oldlines, newlines)
+        #First, run through the rows which may have changed and build a list of strings to draw
+        changedLines = self.partialdraw_get_changed_lines(cursor, oldcursor, oldlines, newlines, dirty_rows)
 
 
         #If this panel doesn't support multiple draws in a single refresh, then we
@@ -508,7 +1331,7 @@ class PaperTTY:
         if not self.driver.supports_multi_draw:
             maxRedraw = 1
             blocks = self.partialdraw_get_text_blocks(changedLines)
-            self.partialdraw_merge_text_blocks(blocks, maxRedraw, changedLines)
+            self.partialdraw_merge_text_blocks(blocks, maxRedraw, changedLines, newlines)
         
 
         #For each line in `changedLines`, figure out its coordinates and other information
@@ -589,20 +1412,33 @@ class PaperTTY:
 
         return oldimage
     
-    def partialdraw_get_changed_lines(self, cursor, oldcursor, oldlines, newlines):
+    def partialdraw_get_changed_lines(self, cursor, oldcursor, oldlines, newlines, dirty_rows=None):
 
         """This function compares two strings arrays, oldlines and newlines, and
             figures out which lines of text in those arrays are different.
             It also takes cursor position into consideration when figuring out if
-            the text has "changed" or not."""
+            the text has "changed" or not.
+            If `dirty_rows` is given, only those rows (and the rows the cursor is or
+            was on) are compared. Only the lines which need drawing are returned."""
 
         #List of lines of text which have changed
         changedLines = []
 
-        for i in range(self.rows):
-            
-            newval = newlines[i] if i < len(newlines) else ''
-            oldval = oldlines[i] if i < len(oldlines) else ''
+        #Figure out which rows could possibly need drawing
+        if dirty_rows is None:
+            dirty_rows = [i for i in range(self.rows) if self.partialdraw_get_line(oldlines, i) != self.partialdraw_get_line(newlines, i)]
+        rows = set(dirty_rows)
+        if cursor and self.cursor:
+            rows.add(cursor[1])
+        if oldcursor:
+            rows.add(oldcursor[1])
+
+        for i in sorted(rows):
+            if i >= self.rows:
+                break
+
+            newval = self.partialdraw_get_line(newlines, i)
+            oldval = self.partialdraw_get_line(oldlines, i)
 
             #Use these variables to check if the cursor has moved
             cursorIsOnThisLine = False
@@ -633,17 +1469,25 @@ class PaperTTY:
             #Draw this line if either the cursor has moved, or the text has changed
             drawThisLine = cursorMovedHorizontally or cursorIsOnThisLine != cursorWasOnThisLine or oldval != newval
 
-            lineToDraw = {
-                "drawThisLine":drawThisLine,
-                "newval":newval,
-                "cursorIsOnThisLine":cursorIsOnThisLine,
-                "oldval":oldval,
-                "cursorWasOnThisLine":cursorWasOnThisLine
-            }
-            changedLines.append(lineToDraw)
+            if drawThisLine:
+                changedLines.append(self.partialdraw_line_entry(i, newval, oldval, cursorIsOnThisLine, cursorWasOnThisLine))
 
         return changedLines
 
+    @staticmethod
+    def partialdraw_get_line(lines, i):
+        return lines[i] if i < len(lines) else ''
+
+    @staticmethod
+    def partialdraw_line_entry(row, newval, oldval, cursorIsOnThisLine=False, cursorWasOnThisLine=False):
+        return {
+            "row":row,
+            "newval":newval,
+            "cursorIsOnThisLine":cursorIsOnThisLine,
+            "oldval":oldval,
+            "cursorWasOnThisLine":cursorWasOnThisLine
+        }
+
     def partialdraw_get_text_blocks(self, changedLines):
 
         """This function takes the result of partialdraw_get_changed_lines and
@@ -652,29 +1496,20 @@ class PaperTTY:
         #Array of grouped text blocks
         blocks = []
 
-        #Used in the loop to keep track of whether the previous line was flagged for
-        #drawing or not
-        drawLastLine = False
-        
-        for i, arr in enumerate(changedLines):
+        for arr in changedLines:
             
-            drawThisLine = arr["drawThisLine"]
-
-            #If this line is to be drawn, and so was the previous line, group them
-            #together in the same block.
-            #If this line is to be drawn, but the previous one wasn't, then start a
-            #new block instead.
-            if drawThisLine:
-                if drawLastLine:
-                    blocks[-1]["end"] = i
-                else:
-                    blocks.append({"start":i, "end":i})
+            i = arr["row"]
 
-            drawLastLine = drawThisLine
+            #If the previous row is to be drawn as well, group them together in the
+            #same block. Otherwise start a new block instead.
+            if blocks and blocks[-1]["end"] == i - 1:
+                blocks[-1]["end"] = i
+            else:
+                blocks.append({"start":i, "end":i})
 
         return blocks
 
-    def partialdraw_merge_text_blocks(self, blocks, maxRedraw, changedLines):
+    def partialdraw_merge_text_blocks(self, blocks, maxRedraw, changedLines, newlines):
 
         """This function takes the result of partialdraw_get_text_blocks
             and merges the text blocks together until the total number of block
@@ -682,8 +1517,7 @@ class PaperTTY:
 
         #If the number of blocks to draw is more than we want to redraw separately
         #(`maxRedraw`), then batch them together.
-        #We do this by setting `drawThisLine` to True for the lines in between separate
-        #blocks.
+        #We do this by adding the lines in between separate blocks to `changedLines`.
         #This causes the "block" to be made bigger artificially by drawing lines we
         #don't need to, which in turn leverages the "append" behavior in the drawing loop.
         #
@@ -721,17 +1555,19 @@ class PaperTTY:
                 blockToMerge = blocks.pop(smallestGapIndex+1)
                 blocks[smallestGapIndex]["end"] = blockToMerge["end"]
 
-            #Next, iterate through all of the lines of text we were going to draw
-            #(or not draw) and reassess whether to draw them or not based on whether
-            #they're in one of the calculated text blocks.
-            #Setting drawThisLine to True means that line of text will be
-            #flagged for merging in the drawing loop elsewhere in the code.
+            #Next, fill in the unchanged lines inside the calculated text blocks
+            #so they get merged with their neighbours in the drawing loop
+            #elsewhere in the code.
 
-            for i, arr in enumerate(changedLines):
-                for block in blocks:
-                    if i >= block["start"] and i <= block["end"]:
-                        changedLines[i]["drawThisLine"] = True
-                        break
+            lines = {arr["row"]: arr for arr in changedLines}
+            changedLines[:] = []
+            for block in blocks:
+                for i in range(block["start"], block["end"] + 1):
+                    if i in lines:
+                        changedLines.append(lines[i])
+                    else:
+                        newval = self.partialdraw_get_line(newlines, i)
+                        changedLines.append(self.partialdraw_line_entry(i, newval, newval))
 
     def partialdraw_get_lines_to_draw(self, changedLines, height, flipy, driverHeight):
 
@@ -749,8 +1585,11 @@ class PaperTTY:
 
         linesToDraw = []
 
-        for i, arr in enumerate(changedLines):
-            drawThisLine = arr["drawThisLine"]
+        #Row of the previous line in `changedLines`
+        lastRow = None
+
+        for arr in changedLines:
+            i = arr["row"]
             newval = arr["newval"]
             cursorIsOnThisLine = arr["cursorIsOnThisLine"]
             oldval = arr["oldval"]
@@ -777,90 +1616,95 @@ class PaperTTY:
             else:
                 y = i * height
 
-            if not drawThisLine:
-
-                #If the cursor hasn't moved to/from this line and the text hasn't changed,
-                #then don't add this line to the `linesToDraw` array.
-                #Just set append to false, since we aren't drawing this line and thus can't
-                #append to it
+            #If the previous row isn't being drawn, then we can't append to it
+            if lastRow != i - 1:
                 append = False
+            lastRow = i
 
-            else:
-                firstChanged = -1
-                lastChanged = 0
-                oldlen = len(oldval)
-                newlen = len(newval)
-                smallerLen = min(oldlen, newlen)
-
-                #Iterate through the old text value and the new text value char by char
-                #in order to find the first non-matching character.
-                #Or, if either string is empty, set firstChanged to 0.
-                if oldlen == 0 or newlen == 0:
-                    firstChanged = 0
-                else:
-                    for j in range(smallerLen):
-                        oldChar = oldval[j]
-                        newChar = newval[j]
-                        if oldChar != newChar:
-                            firstChanged = j
-                            break
-
-                #firstChanged might not be set if one line completely encapsulates the other.
-                #eg. if the line changed from "test" to "testing" then they are identical
-                #until the last char of the old string, so firstChanged would never be set.
-                #In that case, set firstChanged to be the final character of whichever line
-                #is shorter.
-                if firstChanged == -1:
-                    firstChanged = min(oldlen, newlen) - 1
-
-                #Next, try to find the LAST non-matching character.
-                #If the line length has changed, then the last char won't match, so just
-                #set it to that. Otherwise, iterate char by char again.
-                if newlen != oldlen:
-                    lastChanged = max(oldlen, newlen) - 1
-                else:
-                    for j in range(newlen):
-                        oldChar = oldval[j]
-                        newChar = newval[j]
-                        if oldChar != newChar:
-                            lastChanged = j
-
-                #Set the x coordinate to start at `firstChanged` since we won't draw
-                #anything before that.
-                x = firstChanged * self.font_width
-
-                #`subsequentLines` is a list of lines which come after the current line,
-                #but should be drawn in the same image as this line.
-                #This is so we can draw consecutive altered lines into a single image and
-                #minimize the number of SPI writes.
-                subsequentLines = []
-
-                lineToDraw = {
-                    "x":x,
-                    "y":y,
-                    "newval":newval,
-                    "cursorIsOnThisLine":cursorIsOnThisLine,
-                    "subsequentLines":subsequentLines,
-                    "firstChanged":firstChanged,
-                    "lastChanged":lastChanged,
-                    "cursorWasOnThisLine":cursorWasOnThisLine
-                }
-
-                #If append is true, that means this line and the previous line were both altered.
-                #So we're going to take the current line and append it to the previous line and
-                #draw them together.
-                if append:
-
-                    lastIndex = len(linesToDraw) - 1
-                    linesToDraw[lastIndex]["subsequentLines"].append(lineToDraw)
+            #Find the first and last characters which differ between the old and new text
+            firstChanged, lastChanged = self.partialdraw_get_changed_span(oldval, newval)
 
-                else:
+            #Set the x coordinate to start at `firstChanged` since we won't draw
+            #anything before that.
+            x = firstChanged * self.font_width
 
-                    linesToDraw.append(lineToDraw)
-                    append = True
+            #`subsequentLines` is a list of lines which come after the current line,
+            #but should be drawn in the same image as this line.
+            #This is so we can draw consecutive altered lines into a single image and
+            #minimize the number of SPI writes.
+            subsequentLines = []
+
+            lineToDraw = {
+                "x":x,
+                "y":y,
+                "newval":newval,
+                "cursorIsOnThisLine":cursorIsOnThisLine,
+                "subsequentLines":subsequentLines,
+                "firstChanged":firstChanged,
+                "lastChanged":lastChanged,
+                "cursorWasOnThisLine":cursorWasOnThisLine
+            }
+
+            #If append is true, that means this line and the previous line were both altered.
+            #So we're going to take the current line and append it to the previous line and
+            #draw them together.
+            if append:
+
+                lastIndex = len(linesToDraw) - 1
+                linesToDraw[lastIndex]["subsequentLines"].append(lineToDraw)
+
+            else:
+
+                linesToDraw.append(lineToDraw)
+                append = True
 
         return linesToDraw
 
+    @staticmethod
+    def partialdraw_common_length(a, b, suffix=False):
+
+        """Length of the common prefix (or suffix) of two strings.
+            Found with a binary search over slice comparisons, which are done
+            in C, instead of comparing the strings char by char."""
+
+        low, high = 0, min(len(a), len(b))
+        while low < high:
+            mid = (low + high + 1) // 2
+            if (a[-mid:] == b[-mid:]) if suffix else (a[:mid] == b[:mid]):
+                low = mid
+            else:
+                high = mid - 1
+        return low
+
+    def partialdraw_get_changed_span(self, oldval, newval):
+
+        """Returns the indexes of the first and last characters which differ
+            between the old and new text of a line."""
+
+        oldlen = len(oldval)
+        newlen = len(newval)
+        smallerLen = min(oldlen, newlen)
+
+        #If either string is empty, the line changed from the start.
+        #Otherwise find the first non-matching character.
+        #If one line completely encapsulates the other (eg. "test" changed to "testing")
+        #then they are identical until the last char of the shorter string, so use that.
+        if oldlen == 0 or newlen == 0:
+            firstChanged = 0
+        else:
+            firstChanged = min(self.partialdraw_common_length(oldval, newval), smallerLen - 1)
+
+        #If the line length has changed, then the last char won't match, so just
+        #use that. Otherwise find the last non-matching character (if any).
+        if newlen != oldlen:
+            lastChanged = max(oldlen, newlen) - 1
+        elif oldval == newval:
+            lastChanged = 0
+        else:
+            lastChanged = newlen - 1 - self.partialdraw_common_length(oldval, newval, suffix=True)
+
+        return (firstChanged, lastChanged)
+
     def partialdraw_get_images_to_draw(self, linesToDraw, cursor, oldcursor, height, fill, flipx, flipy, driverWidth):
 
         """This function takes the result of partialdraw_get_lines_to_draw and turns
@@ -1021,7 +1865,7 @@ class PaperTTY:
             newval = chunk["newval"]
             cursorIsOnThisLine = chunk["cursorIsOnThisLine"]
 
-            draw.text((x, y), newval, font=self.font, fill=fill, spacing=self.spacing)
+            self.draw_text(image, draw, (x, y), newval, fill)
 
             #Draw the cursor, if it's on this line
             if cursorIsOnThisLine:
@@ -1033,6 +1877,8 @@ class PaperTTY:
                 newcursor = (cursor_x, cursor_y, cursor[2])
                 if self.cursor == 'block':
                     image = self.draw_block_cursor(newcursor, image)
+                    # the cursor creates a new image, so keep drawing on that one
+                    draw = ImageDraw.Draw(image)
                 else:
                     self.draw_line_cursor(newcursor, draw)
 
@@ -1082,7 +1928,8 @@ def get_drivers():
 
                   driver_it8951.IT8951,
 
-                  drivers_base.Dummy, drivers_base.Bitmap]
+                  drivers_base.Dummy, drivers_base.Bitmap,
+                  driver_it8951.SimulatedIT8951, driver_4in2.SimulatedEPD4in2]
     for driver in driverlist:
         driverdict[driver.__name__] = {'desc': driver.__doc__, 'class': driver}
     return driverdict
@@ -1146,8 +1993,9 @@ def display_image(driver, image, stretch=False, no_resize=False, fill_color="whi
 @click.option('--driver', default=None, help='Select display driver')
 @click.option('--nopartial', is_flag=True, default=False, help="Don't use partial updates even if display supports it")
 @click.option('--encoding', default='latin_1', help='Encoding to use for the buffer', show_default=True)
+@click.option('--spi-chunk', 'spi_chunk', default=None, type=int, help='Bytes per SPI transfer (default: spidev bufsiz)')
 @click.pass_context
-def cli(ctx, driver, nopartial, encoding):
+def cli(ctx, driver, nopartial, encoding, spi_chunk):
     """Display stdin or TTY on a Waveshare e-Paper display"""
     if not driver:
         PaperTTY.error(
@@ -1157,7 +2005,9 @@ def cli(ctx, driver, nopartial, encoding):
         matched_drivers = [n for n in get_drivers() if n.lower() == driver.lower()]
         if not matched_drivers:
             PaperTTY.error('Invalid driver selection, choose from:\n{}'.format(get_driver_list()))
-        ctx.obj = Settings(driver=matched_drivers[0], partial=not nopartial, encoding=encoding)
+        if spi_chunk is not None and spi_chunk <= 0:
+            PaperTTY.error('SPI chunk size must be a positive number of bytes')
+        ctx.obj = Settings(driver=matched_drivers[0], partial=not nopartial, encoding=encoding, spi_chunk_size=spi_chunk)
     pass
 
 
@@ -1250,16 +2100,20 @@ def image(settings, image_location, stretch, no_resize, fill_color, mirror, flip
 @click.option('--invert', default=False, is_flag=True, help="Invert colors")
 @click.option('--sleep', default=1, show_default=True, help="Refresh interval (s)", type=float)
 @click.option('--fullevery', default=50, show_default=True, help="# of partial updates between full updates")
+@click.option('--dither', default=None, type=click.Choice(FrameTransform.DITHERS), help="Convert to black and white with this method (enables 1bpp and A2 on IT8951)")
+@click.option('--threshold', default=128, show_default=True, type=click.IntRange(0, 255), help="Gray level that turns white with --dither threshold")
 @click.pass_obj
-def vnc(settings, host, display, password, rotate, invert, sleep, fullevery):
+def vnc(settings, host, display, password, rotate, invert, sleep, fullevery, dither, threshold):
     """Display a VNC desktop"""
     
-    #Disable 1bpp and a2 by default if not using terminal mode
-    settings.args['enable_a2'] = False
-    settings.args['enable_1bpp'] = False
+    #Disable 1bpp and a2 by default if not using terminal mode,
+    #unless the frames are dithered to black and white
+    if not dither:
+        settings.args['enable_a2'] = False
+        settings.args['enable_1bpp'] = False
 
     ptty = settings.get_init_tty()
-    ptty.showvnc(host, display, password, int(rotate) if rotate else None, invert, sleep, fullevery)
+    ptty.showvnc(host, display, password, int(rotate) if rotate else None, invert, sleep, fullevery, dither, threshold)
 
 
 @click.command()
@@ -1268,11 +2122,13 @@ def vnc(settings, host, display, password, rotate, invert, sleep, fullevery):
 @click.option('--invert', default=False, is_flag=True, help="Invert colors")
 @click.option('--sleep', default=1, show_default=True, help="Refresh interval (s)", type=float)
 @click.option('--fullevery', default=50, show_default=True, help="# of partial updates between full updates")
+@click.option('--dither', default=None, type=click.Choice(FrameTransform.DITHERS), help="Convert to black and white with this method (enables 1bpp and A2 on IT8951)")
+@click.option('--threshold', default=128, show_default=True, type=click.IntRange(0, 255), help="Gray level that turns white with --dither threshold")
 @click.pass_obj
-def fb(settings, fb_num, rotate, invert, sleep, fullevery):
+def fb(settings, fb_num, rotate, invert, sleep, fullevery, dither, threshold):
     """Display the framebuffer"""
     ptty = settings.get_init_tty()
-    ptty.showfb(int(fb_num), int(rotate) if rotate else None, invert, sleep, fullevery)
+    ptty.showfb(int(fb_num), int(rotate) if rotate else None, invert, sleep, fullevery, dither, threshold)
 
 
 @click.command()
@@ -1298,9 +2154,10 @@ def fb(settings, fb_num, rotate, invert, sleep, fullevery):
 @click.option('--disable_a2', is_flag=True, default=False, help='Disable fast A2 panel refresh for black and white images')
 @click.option('--disable_1bpp', is_flag=True, default=False, help='Disable fast 1bpp mode')
 @click.option('--mhz', default=None, help='Set SPI speed in MHz')
+@click.option('--pipeline', is_flag=True, default=False, help='Prepare the next frame while the display is busy drawing')
 @click.pass_obj
 def terminal(settings, vcsa, font, fontsize, noclear, nocursor, cursor, sleep, ttyrows, ttycols, portrait, flipx, flipy,
-             spacing, apply_scrub, autofit, attributes, interactive, vcom, disable_a2, disable_1bpp, mhz):
+             spacing, apply_scrub, autofit, attributes, interactive, vcom, disable_a2, disable_1bpp, mhz, pipeline):
     """Display virtual console on an e-Paper display, exit with Ctrl-C."""
     settings.args['font'] = font
     settings.args['fontsize'] = fontsize
@@ -1345,11 +2202,15 @@ def terminal(settings, vcsa, font, fontsize, noclear, nocursor, cursor, sleep, t
 
     if apply_scrub:
         ptty.driver.scrub()
+    if pipeline:
+        ptty.driver = DrawPipeline(ptty.driver)
     oldbuff = ''
     oldimage = None
     oldcursor = None
     # dirty - should refactor to make this cleaner
     flags = {'scrub_requested': False, 'show_menu': False, 'clear': False}
+    # waits for the console to change, created once the vcsa device has been validated
+    watcher = None
     
     # handle SIGINT from `systemctl stop` and Ctrl-C
     def sigint_handler(sig, frame):
@@ -1361,11 +2222,15 @@ def terminal(settings, vcsa, font, fontsize, noclear, nocursor, cursor, sleep, t
         else:
              print('Showing menu, please wait ...')
              flags['show_menu'] = True
+             if watcher:
+                 watcher.wake()
 
     # toggle scrub flag when SIGUSR1 received
     def sigusr1_handler(sig, frame):
         print("Scrubbing display (SIGUSR1)...")
         flags['scrub_requested'] = True
+        if watcher:
+            watcher.wake()
 
     signal.signal(signal.SIGINT, sigint_handler)
     signal.signal(signal.SIGUSR1, sigusr1_handler)
@@ -1389,6 +2254,10 @@ def terminal(settings, vcsa, font, fontsize, noclear, nocursor, cursor, sleep, t
         else:
             print("Started displaying {}, minimum update interval {} s, exit with Ctrl-C".format(vcsa, sleep))
         character_width, vcsudev = ptty.vcsudev(vcsa)
+        snapshot = ConsoleSnapshot(vcsa, vcsudev, character_width, ptty.encoding)
+        watcher = ConsoleWatcher(vcsa, sleep)
+        if not watcher.event_driven:
+            print("Console change notifications not supported by the kernel, polling {} instead.".format(vcsa))
         while True:
             if flags['show_menu']:
                 flags['show_menu'] = False
@@ -1472,36 +2341,25 @@ def terminal(settings, vcsa, font, fontsize, noclear, nocursor, cursor, sleep, t
                 oldbuff = ''
                 flags['scrub_requested'] = False
             
-            with open(vcsa, 'rb') as f:
-                with open(vcsudev, 'rb') as vcsu:
-                    # read the first 4 bytes to get the console attributes
-                    attributes = f.read(4)
-                    rows, cols, x, y = list(map(ord, struct.unpack('cccc', attributes)))
-
-                    # read from the text buffer 
-                    buff = vcsu.read()
-                    if character_width == 4:
-                        # work around weird bug
-                        buff = buff.replace(b'\x20\x20\x20\x20', b'\x20\x00\x00\x00')
-                    # find character under cursor (in case using a non-fixed width font)
-                    char_under_cursor = buff[character_width * (y * rows + x):character_width * (y * rows + x + 1)]
-                    encoding = 'utf_32' if character_width == 4 else ptty.encoding
-                    cursor = (x, y, char_under_cursor.decode(encoding, 'ignore'))
-                    # add newlines per column count
-                    buff = ''.join([r.decode(encoding, 'replace') + '\n' for r in ptty.split(buff, cols * character_width)])
-                    # do something only if content has changed or cursor was moved
-                    if buff != oldbuff or cursor != oldcursor:
-                        # show new content
-                        oldimage = ptty.showtext(buff, fill=ptty.black, cursor=cursor if not nocursor else None,
-                                                oldimage=oldimage,
-                                                oldtext=oldbuff,
-                                                oldcursor=oldcursor,
-                                                **textargs)
-                        oldbuff = buff
-                        oldcursor = cursor
-                    else:
-                        # delay before next update check
-                        time.sleep(float(sleep))
+            snapshot.read()
+            buff = snapshot.text
+            cursor = snapshot.cursor
+            # do something only if content has changed or cursor was moved
+            changed = buff != oldbuff or cursor != oldcursor
+            if changed:
+                # the rows which changed are only known if the last snapshot was displayed
+                dirty_rows = snapshot.dirty_rows if oldbuff is snapshot.previous_text else None
+                # show new content
+                oldimage = ptty.showtext(buff, fill=ptty.black, cursor=cursor if not nocursor else None,
+                                        oldimage=oldimage,
+                                        oldtext=oldbuff,
+                                        oldcursor=oldcursor,
+                                        dirty_rows=dirty_rows,
+                                        **textargs)
+                oldbuff = buff
+                oldcursor = cursor
+            # wait until the console changes before checking it again
+            watcher.wait(changed)
 
 
 # add all the CLI commands
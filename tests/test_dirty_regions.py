@@ -0,0 +1,129 @@
+import random
+import time
+
+from PIL import Image, ImageChops, ImageDraw
+
+from papertty.papertty import DirtyRegionTracker, PaperTTY
+
+
+class Panel:
+    """Just the attributes DirtyRegionTracker reads from a driver"""
+    width = 1872
+    height = 1404
+    white = 255
+    supports_1bpp = True
+    enable_1bpp = True
+    align_1bpp_width = 32
+    align_1bpp_height = 16
+    supports_multi_draw = True
+
+
+def scattered_boxes(count, seed=1):
+    rng = random.Random(seed)
+    boxes = []
+    for _ in range(count):
+        x, y = rng.randrange(0, 1800), rng.randrange(0, 1380)
+        boxes.append((x, y, x + rng.randrange(1, 70), y + rng.randrange(1, 30)))
+    return boxes
+
+
+def test_merge_covers_all_boxes_without_overlap():
+    tracker = DirtyRegionTracker(Panel())
+    boxes = scattered_boxes(400)
+    regions = tracker.merge(boxes, max_regions=8)
+
+    assert len(regions) <= 8
+    for i, a in enumerate(regions):
+        for b in regions[i + 1:]:
+            assert not DirtyRegionTracker.overlap(a, b)
+    for box in boxes:
+        box = PaperTTY.band(box, xdiv=32, ydiv=16)
+        assert any(r[0] <= box[0] and r[1] <= box[1] and r[2] >= min(box[2], Panel.width)
+                   and r[3] >= min(box[3], Panel.height) for r in regions)
+
+
+def test_merge_single_region_is_bounding_box():
+    tracker = DirtyRegionTracker(Panel())
+    assert tracker.merge([(40, 20, 50, 30), (100, 200, 130, 210)], max_regions=1) == [(32, 16, 160, 224)]
+
+
+def test_merge_hundreds_of_boxes_is_fast():
+    tracker = DirtyRegionTracker(Panel())
+    boxes = scattered_boxes(400)
+    start = time.monotonic()
+    tracker.merge(boxes, max_regions=8)
+    tracker.merge(boxes, max_regions=1)
+    # took tens of seconds when every union restarted a pairwise search
+    assert time.monotonic() - start < 2
+
+
+class RecordingPanel:
+    """A single-draw driver which keeps the image the panel would show"""
+    width = 64
+    height = 64
+    white = 255
+    supports_1bpp = False
+    supports_multi_draw = False
+
+    def __init__(self):
+        self.image = Image.new('1', (self.width, self.height), self.white)
+        self.draws = []
+
+    def draw(self, x, y, image):
+        self.draws.append((x, y, image.size))
+        self.image.paste(image, (x, y))
+
+    def draw_multi(self, imageArray):
+        self.draws.append([(item["x"], item["y"], item["image"].size) for item in imageArray])
+        for item in imageArray:
+            self.image.paste(item["image"], (item["x"], item["y"]))
+
+
+def text_frame(panel):
+    frame = Image.new('1', (panel.width, panel.height), panel.white)
+    ImageDraw.Draw(frame).rectangle((0, 8, 63, 55), fill=0)
+    return frame
+
+
+def test_coalesced_frames_keep_the_rows_between_them():
+    panel = RecordingPanel()
+    tracker = DirtyRegionTracker(panel)
+    frame = text_frame(panel)
+    tracker.add(0, 0, frame)
+    tracker.flush()
+    # two frames changing the first and the last row, drawn together
+    tracker.add(0, 0, Image.new('1', (8, 8), 0))
+    tracker.add(0, 56, Image.new('1', (8, 8), 0))
+    tracker.flush()
+
+    assert panel.draws[-1] == (0, 0, (8, 64))
+    frame.paste(0, (0, 0, 8, 8))
+    frame.paste(0, (0, 56, 8, 64))
+    assert ImageChops.difference(panel.image, frame).getbbox() is None
+
+
+def test_unknown_content_is_not_drawn_white():
+    panel = RecordingPanel()
+    panel.image = text_frame(panel)
+    tracker = DirtyRegionTracker(panel)
+    tracker.add(0, 0, Image.new('1', (8, 8), 0))
+    tracker.add(0, 56, Image.new('1', (8, 8), 0))
+    tracker.flush()
+
+    assert panel.draws == [(0, 0, (8, 8)), (0, 56, (8, 8))]
+    assert panel.image.getpixel((0, 30)) == 0
+
+
+def test_multi_draw_regions_are_bounded():
+    panel = RecordingPanel()
+    panel.supports_multi_draw = True
+    tracker = DirtyRegionTracker(panel, max_regions=3)
+    tracker.add(0, 0, Image.new('1', (64, 64), 255))
+    tracker.flush()
+    for i in range(8):
+        tracker.add(i * 8, i * 8, Image.new('1', (4, 4), 0))
+    tracker.flush()
+
+    assert len(panel.draws[-1]) == 3
+    for i in range(8):
+        assert panel.image.getpixel((i * 8, i * 8)) == 0
@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+from PIL import Image, ImageChops
+
+import papertty.papertty
+from papertty.papertty import DrawPipeline
+
+
+class SlowPanel:
+    """A single-draw driver which takes a while for each draw"""
+    width = 64
+    height = 64
+    white = 255
+    supports_1bpp = False
+    supports_multi_draw = False
+    partial_refresh = True
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.image = Image.new('1', (self.width, self.height), self.white)
+        self.draws = 0
+        self.fail = None
+        self.busy = threading.Event()
+
+    def draw(self, x, y, image):
+        self.busy.set()
+        time.sleep(self.delay)
+        if self.fail:
+            raise self.fail
+        self.image.paste(image, (x, y))
+        self.draws += 1
+
+
+@pytest.fixture
+def exit_handlers(monkeypatch):
+    handlers = []
+    monkeypatch.setattr(papertty.papertty.atexit, "register", handlers.append)
+    return handlers
+
+
+def test_queued_frames_are_coalesced(exit_handlers):
+    panel = SlowPanel()
+    pipeline = DrawPipeline(panel)
+    pipeline.draw(0, 0, Image.new('1', (64, 64), 255))
+    panel.busy.wait()
+    expected = Image.new('1', (64, 64), 255)
+    for row in range(4):
+        block = Image.new('1', (8, 8), 0)
+        pipeline.draw(0, row * 16, block)
+        expected.paste(block, (0, row * 16))
+    pipeline.flush()
+
+    assert ImageChops.difference(panel.image, expected).getbbox() is None
+    # the full frame, then the blocks which piled up while it was drawn
+    assert panel.draws < 5
+
+
+def test_display_thread_errors_are_raised(exit_handlers):
+    panel = SlowPanel(delay=0)
+    panel.fail = ValueError("SPI transfer failed")
+    pipeline = DrawPipeline(panel)
+    pipeline.draw(0, 0, Image.new('1', (8, 8), 0))
+    with pytest.raises(ValueError):
+        pipeline.flush()
+    # raised once, and the pipeline keeps working
+    panel.fail = None
+    pipeline.draw(0, 0, Image.new('1', (8, 8), 0))
+    pipeline.flush()
+    assert panel.draws == 1
+
+
+def test_queue_is_drawn_at_exit(exit_handlers):
+    panel = SlowPanel()
+    pipeline = DrawPipeline(panel)
+    assert exit_handlers == [pipeline.flush]
+    for i in range(3):
+        pipeline.draw(i * 8, 0, Image.new('1', (8, 8), 0))
+    exit_handlers[0]()
+    assert pipeline.queue.unfinished_tasks == 0
+    assert all(panel.image.getpixel((i * 8, 0)) == 0 for i in range(3))
+
+
+def test_setting_attributes_waits_and_reaches_the_driver(exit_handlers):
+    panel = SlowPanel()
+    pipeline = DrawPipeline(panel)
+    pipeline.draw(0, 0, Image.new('1', (8, 8), 0))
+    pipeline.partial_refresh = False
+    assert panel.draws == 1
+    assert panel.partial_refresh is False
+    assert 'partial_refresh' not in vars(pipeline)
@@ -0,0 +1,122 @@
+from PIL import Image
+
+from papertty.drivers.drivers_partial import EPD2in13v4
+
+
+class RamModel:
+    """The two RAMs of the controller, with its address window and counter"""
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.stride = driver.width // 8
+        self.ram = {0x24: bytearray(self.stride * driver.height), 0x26: bytearray(self.stride * driver.height)}
+        self.window = (0, self.stride - 1, 0, driver.height - 1)
+        self.pointer = (0, 0)
+        self.command = None
+        self.args = []
+        self.written = {0x24: 0, 0x26: 0}
+        self.refreshes = 0
+        driver.send_command = self.send_command
+        driver.send_data = self.send_data
+        driver.send_data_multi = self.send_data
+        driver.digital_write = lambda pin, value: None
+        driver.delay_ms = lambda ms: None
+        driver.wait_until_idle = lambda: None
+
+    def send_command(self, command):
+        self.command, self.args = command, []
+        if command == self.driver.MASTER_ACTIVATION:
+            self.refreshes += 1
+
+    def send_data(self, data):
+        data = [data] if isinstance(data, int) else list(data)
+        if self.command in self.ram:
+            self.write(self.command, data)
+            return
+        self.args += data
+        args, driver = self.args, self.driver
+        if self.command == driver.SET_RAM_X_ADDRESS_START_END_POSITION and len(args) == 2:
+            self.x_range = tuple(args)
+        elif self.command == driver.SET_RAM_Y_ADDRESS_START_END_POSITION and len(args) == 4:
+            self.window = self.x_range + (args[0] | args[1] << 8, args[2] | args[3] << 8)
+        elif self.command == driver.SET_RAM_X_ADDRESS_COUNTER and len(args) == 1:
+            self.pointer = (args[0], self.pointer[1])
+        elif self.command == driver.SET_RAM_Y_ADDRESS_COUNTER and len(args) == 2:
+            self.pointer = (self.pointer[0], args[0] | args[1] << 8)
+
+    def write(self, ram, data):
+        # the counter wraps around within the window, and isn't moved by writes
+        x0, x1, y0, y1 = self.window
+        x, y = self.pointer
+        for value in data:
+            self.ram[ram][y * self.stride + x] = value
+            self.written[ram] += 1
+            x += 1
+            if x > x1:
+                x, y = x0, y + 1
+
+    def image(self, ram):
+        return bytes(self.ram[ram])
+
+
+def partial_panel():
+    driver = EPD2in13v4()
+    model = RamModel(driver)
+    driver.partial_refresh = True
+    return driver, model
+
+
+def screen(*blocks):
+    image = Image.new('1', (128, 250), 255)
+    for block in blocks:
+        image.paste(0, block)
+    return image.tobytes()
+
+
+def test_changed_window_and_buffers():
+    driver, model = partial_panel()
+    driver.cached_buffer = bytearray(screen())
+    # 8x4 black pixels from x=20, inside a larger white image
+    image = Image.new('1', (40, 20), 255)
+    image.paste(0, (10, 5, 18, 9))
+    old, new, box = driver.update_cached_buffer(10, 5, image)
+
+    assert box == (16, 10, 32, 14)
+    assert old == b'\xff' * 8
+    assert new == b'\xf0\x0f' * 4
+    assert bytes(driver.cached_buffer) == screen((20, 10, 28, 14))
+    assert driver.update_cached_buffer(10, 5, image) is None
+
+
+def test_partial_draw_writes_only_the_window_of_both_rams():
+    driver, model = partial_panel()
+    driver.draw(0, 0, Image.new('1', (128, 250), 255))
+    assert model.image(0x24) == model.image(0x26) == screen()
+
+    model.written = {0x24: 0, 0x26: 0}
+    image = Image.new('1', (8, 4), 0)
+    driver.draw(20, 10, image)
+
+    assert model.written == {0x24: 8, 0x26: 8}
+    assert model.image(0x24) == screen((20, 10, 28, 14))
+    # the base image the panel compares against is what it was showing
+    assert model.image(0x26) == screen()
+
+
+def test_unchanged_draw_sends_nothing():
+    driver, model = partial_panel()
+    driver.draw(20, 10, Image.new('1', (8, 4), 0))
+    written, refreshes = dict(model.written), model.refreshes
+    driver.draw(20, 10, Image.new('1', (8, 4), 0))
+    assert (model.written, model.refreshes) == (written, refreshes)
+
+
+def test_ram_window_is_restored_after_partial_draw():
+    driver, model = partial_panel()
+    driver.draw(20, 10, Image.new('1', (8, 4), 0))
+
+    assert model.window == (0, 15, 0, 249)
+    assert model.pointer == (0, 0)
+    # so that a clear covers the whole screen again
+    driver.clear()
+    assert model.image(0x24) == screen()
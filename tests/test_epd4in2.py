@@ -0,0 +1,95 @@
+from PIL import Image
+
+import papertty.drivers.drivers_base
+from papertty.drivers.drivers_4in2 import EPD4in2, SimulatedEPD4in2
+
+
+class Recorder:
+    """Collects the partial windows and the data EPD4in2 sends"""
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.windows = []
+        self.data = []
+        driver.send_command = lambda command: None
+        driver.send_data = lambda data: None
+        driver.send_data_multi = lambda data: self.data.append(bytes(data))
+        driver.set_setting = self.set_setting
+        driver.delay_ms = lambda ms: None
+        driver.turn_on_display = lambda: None
+        driver.partial_set_lut = lambda: None
+
+    def set_setting(self, command, data):
+        if command == self.driver.PARTIAL_WINDOW:
+            x0, x1 = data[0] << 8 | data[1], (data[2] << 8 | data[3]) + 1
+            y0, y1 = data[4] << 8 | data[5], (data[6] << 8 | data[7]) + 1
+            self.windows.append((x0, y0, x1, y1))
+
+
+def synced_panel():
+    driver = EPD4in2()
+    recorder = Recorder(driver)
+    driver.partial_refresh = True
+    driver.draw(0, 0, Image.new('1', (400, 300), 255))
+    assert driver.synced
+    recorder.windows, recorder.data = [], []
+    return driver, recorder
+
+
+def screen(*blocks):
+    image = Image.new('1', (400, 300), 255)
+    for block in blocks:
+        image.paste(0, block)
+    return image
+
+
+def test_changed_window():
+    driver = EPD4in2()
+    driver.frame_buffer[:] = screen().tobytes()
+    driver.synced = True
+    image = Image.new('1', (40, 20), 255)
+    image.paste(0, (3, 2, 6, 5))
+
+    assert driver.set_frame_buffer(10, 5, image) == (8, 7, 16, 10)
+    assert bytes(driver.frame_buffer) == screen((13, 7, 16, 10)).tobytes()
+    assert driver.set_frame_buffer(10, 5, image) is None
+
+
+def test_unsynced_panel_refreshes_the_drawn_area():
+    driver = EPD4in2()
+    image = Image.new('1', (40, 20), 255)
+    # the buffer starts out black, so everything but the edge bytes changes
+    assert driver.set_frame_buffer(10, 5, image) == (8, 5, 56, 25)
+
+
+def test_partial_draw_sends_the_window_only():
+    driver, recorder = synced_panel()
+    driver.draw(13, 7, Image.new('1', (3, 3), 0))
+
+    assert recorder.windows == [(8, 7, 16, 10)]
+    window = screen((13, 7, 16, 10)).crop((8, 7, 16, 10)).tobytes()
+    assert recorder.data == [window, bytes(255 - b for b in window)]
+
+
+def test_unchanged_draws_send_nothing():
+    driver, recorder = synced_panel()
+    driver.draw(13, 7, Image.new('1', (3, 3), 255))
+    driver.draw(0, 0, Image.new('1', (400, 300), 255))
+    assert recorder.windows == []
+    assert recorder.data == []
+
+
+def test_simulator_charges_the_changed_window(monkeypatch):
+    # no report on exit
+    monkeypatch.setattr(papertty.drivers.drivers_base.atexit, "register", lambda handler: None)
+    simulator = SimulatedEPD4in2()
+    simulator.init(partial=True)
+    simulator.draw(0, 0, Image.new('1', (400, 300), 255))
+    assert simulator.stats['bytes'] == 2 * 400 * 300 // 8 + simulator.command_bytes
+
+    simulator.reset_stats()
+    simulator.draw(0, 0, Image.new('1', (400, 300), 255))
+    assert simulator.stats['draws'] == 0
+    simulator.draw(13, 7, Image.new('1', (3, 3), 0))
+    assert simulator.stats['bytes'] == 2 * 1 * 3 + simulator.command_bytes
+    assert simulator.stats['refreshes'] == {'partial': 1}
@@ -0,0 +1,64 @@
+import random
+
+import pytest
+from PIL import Image, ImageChops
+
+from papertty.papertty import FrameDiff, FrameTransform
+
+SOURCE = (128, 64)
+
+
+def noise(size, seed):
+    rng = random.Random(seed)
+    return Image.frombytes("RGB", size, bytes(rng.getrandbits(8) for _ in range(size[0] * size[1] * 3)))
+
+
+def changed_frame(image):
+    image = image.copy()
+    # a couple of separate changes, one of them across a tile boundary
+    image.paste(noise((10, 6), 2), (3, 4))
+    image.paste(noise((20, 20), 3), (90, 10))
+    return image
+
+
+@pytest.mark.parametrize("rotate", [None, 90, 180, 270])
+@pytest.mark.parametrize("invert,dither", [(False, None), (True, None), (False, "threshold"), (True, "bayer")])
+def test_tiles_match_full_transform(rotate, invert, dither):
+    size = SOURCE[::-1] if rotate in (90, 270) else SOURCE
+    transform = FrameTransform(size, rotate, invert, dither)
+    frames = FrameDiff()
+    first = noise(SOURCE, 1)
+    assert transform.apply(first, frames.diff(first)) is None
+
+    second = changed_frame(first)
+    tiles = frames.diff(second)
+    assert tiles
+    boxes = transform.apply(second, tiles)
+
+    reference = FrameTransform(size, rotate, invert, dither)
+    reference.setup(SOURCE)
+    expected = reference.full(second)[1]
+    assert transform.image.mode == expected.mode
+    assert ImageChops.difference(transform.image, expected).getbbox() is None
+    # nothing outside the returned boxes changed
+    before = FrameTransform(size, rotate, invert, dither)
+    before.setup(SOURCE)
+    untouched = before.full(first)[1]
+    for box in boxes:
+        untouched.paste(expected.crop(box), box[:2])
+    assert ImageChops.difference(untouched, expected).getbbox() is None
+
+
+def test_plans_are_kept_per_tile():
+    transform = FrameTransform((64, 128), 90)
+    frames = FrameDiff()
+    image = noise(SOURCE, 1)
+    transform.apply(image, frames.diff(image))
+    rng = random.Random(4)
+    for seed in range(30):
+        image = image.copy()
+        x, y = rng.randrange(0, SOURCE[0] - 40), rng.randrange(0, SOURCE[1] - 20)
+        image.paste(noise((rng.randrange(1, 40), rng.randrange(1, 20)), seed + 10), (x, y))
+        transform.apply(image, frames.diff(image))
+    tiles = (SOURCE[0] // 32) * (SOURCE[1] // 16)
+    assert len(transform.plans) <= tiles
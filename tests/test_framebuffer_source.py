@@ -0,0 +1,49 @@
+import random
+
+import pytest
+from PIL import Image, ImageChops
+
+import papertty.papertty
+from papertty.papertty import FramebufferSource
+
+WIDTH, HEIGHT = 100, 40
+
+
+def expected(data, bpp, stride):
+    mode = "BGRX" if bpp == 32 else "BGR;16"
+    return Image.frombytes("RGB", (WIDTH, HEIGHT), bytes(data), "raw", mode, stride).convert("L")
+
+
+@pytest.fixture(params=["numpy", "bytes"])
+def compare(request, monkeypatch):
+    if request.param == "bytes":
+        monkeypatch.setattr(papertty.papertty, "numpy", None)
+    elif papertty.papertty.numpy is None:
+        pytest.skip("NumPy is not installed")
+
+
+@pytest.mark.parametrize("bpp,stride", [(16, WIDTH * 2), (32, WIDTH * 4), (16, WIDTH * 2 + 8)])
+def test_only_changed_tiles_are_dirty(tmp_path, compare, bpp, stride):
+    rng = random.Random(bpp + stride)
+    data = bytearray(rng.getrandbits(8) for _ in range(stride * HEIGHT))
+    path = tmp_path / "fb0"
+    path.write_bytes(data)
+    source = FramebufferSource(str(path), (WIDTH, HEIGHT), bpp, stride)
+    try:
+        assert source.read() is None
+        assert ImageChops.difference(source.image, expected(data, bpp, stride)).getbbox() is None
+        assert source.read() == []
+
+        pixel_size = bpp // 8
+        # one pixel in the first tile, and one in the partial tile at the bottom right
+        for x, y in [(5, 3), (97, 38)]:
+            offset = y * stride + x * pixel_size
+            data[offset:offset + pixel_size] = bytes(255 - b for b in data[offset:offset + pixel_size])
+        with open(str(path), "r+b") as f:
+            f.write(data)
+
+        assert sorted(source.read()) == [(0, 0, 32, 16), (96, 32, 100, 40)]
+        assert ImageChops.difference(source.image, expected(data, bpp, stride)).getbbox() is None
+        assert source.read() == []
+    finally:
+        source.close()
@@ -0,0 +1,87 @@
+from papertty.drivers.driver_it8951 import IT8951Waveforms
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+CELL = (0, 0, IT8951Waveforms.CELL_WIDTH, IT8951Waveforms.CELL_HEIGHT)
+
+
+def scheduler(bpp=1):
+    clock = Clock()
+    waveforms = IT8951Waveforms(256, 128, clock=clock)
+    waveforms.loaded((0, 0, 256, 128), bpp)
+    return waveforms, clock
+
+
+def test_choose_by_content_and_heat():
+    waveforms, clock = scheduler()
+    assert waveforms.choose(CELL, binary=False, a2=True) == "GC16"
+    assert waveforms.choose(CELL, binary=True, a2=True) == "DU"
+    for _ in range(IT8951Waveforms.HOT - 1):
+        waveforms.refreshed(CELL, "DU")
+    assert waveforms.choose(CELL, binary=True, a2=True) == "A2"
+    assert waveforms.choose(CELL, binary=True, a2=False) == "DU"
+    # the heat decays
+    clock.now += 10 * IT8951Waveforms.HALF_LIFE
+    assert waveforms.choose(CELL, binary=True, a2=True) == "DU"
+
+
+def test_cleanup_waits_for_budget_and_cooling():
+    waveforms, clock = scheduler()
+    for _ in range(IT8951Waveforms.BUDGET - 1):
+        waveforms.refreshed(CELL, "DU")
+    clock.now += 10 * IT8951Waveforms.HALF_LIFE
+    assert waveforms.cleanup() == []
+
+    waveforms.refreshed(CELL, "DU")
+    # over budget, but still hot
+    assert waveforms.cleanup() == []
+    clock.now += 10 * IT8951Waveforms.HALF_LIFE
+    assert waveforms.cleanup() == [CELL]
+    # ...and clean after that
+    assert waveforms.cleanup() == []
+
+
+def test_cleanup_of_hot_cells_at_hard_limit():
+    waveforms, clock = scheduler()
+    for _ in range(IT8951Waveforms.HARD_LIMIT // IT8951Waveforms.GHOSTING["A2"] - 1):
+        waveforms.refreshed(CELL, "A2")
+    assert waveforms.cleanup() == []
+    waveforms.refreshed(CELL, "A2")
+    assert waveforms.cleanup() == [CELL]
+
+
+def test_gc16_clears_ghosting():
+    waveforms, clock = scheduler()
+    for _ in range(IT8951Waveforms.HARD_LIMIT):
+        waveforms.refreshed(CELL, "DU")
+    waveforms.refreshed(CELL, "GC16")
+    assert waveforms.cleanup() == []
+
+
+def test_cleanup_joins_cells():
+    waveforms, clock = scheduler()
+    box = (0, 0, 2 * IT8951Waveforms.CELL_WIDTH, 2 * IT8951Waveforms.CELL_HEIGHT)
+    for _ in range(IT8951Waveforms.HARD_LIMIT):
+        waveforms.refreshed(box, "DU")
+    assert waveforms.cleanup() == [box]
+
+
+def test_cleanup_only_in_the_loaded_bpp_mode():
+    waveforms, clock = scheduler()
+    # a gray image loaded over part of the cell
+    waveforms.loaded((8, 8, 24, 24), 4)
+    for _ in range(IT8951Waveforms.HARD_LIMIT):
+        waveforms.refreshed(CELL, "DU")
+    assert waveforms.cleanup(1) == []
+    assert waveforms.cleanup(4) == []
+    # reloading the whole cell in 1bpp makes it safe to clean up again
+    waveforms.loaded(CELL, 1)
+    assert waveforms.cleanup(4) == []
+    assert waveforms.cleanup(1) == [CELL]